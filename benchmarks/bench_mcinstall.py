@@ -0,0 +1,415 @@
+#! /usr/bin/env python3
+
+"""
+Offline benchmarks for the download and orchestration paths of mcinstall.
+
+This serves a fake Miniconda installer of configurable size from a local
+HTTP server, optionally with added latency per request and a bandwidth cap
+per connection. The fake installer is a shell script creating stub ``conda``
+and ``pip`` executables which only sleep for a scripted delay and print
+some output, so what is measured is the overhead of ``mcinstall`` itself.
+
+The results are written as JSON, e.g.::
+
+    python benchmarks/bench_mcinstall.py --size 64M --latency 0.02 \\
+        --bandwidth 20M --connections 1,4 --output bench.json
+
+Benchmarks:
+
+- ``download``: ``download_file()`` with each number of ``--connections``,
+  reporting throughput, the peak of Python memory allocations (tracemalloc)
+  and the peak RSS of the process.
+- ``revalidate``: ``fetch_installer()`` with a cached ``latest`` installer,
+  i.e. one conditional request.
+- ``provision``: all provisioning steps with ``--parallel 1`` and with
+  ``--parallel N``, reporting the time per step and, for the sequential run,
+  the overhead, i.e. the time not spent downloading the installer or
+  waiting for child processes.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+import mcinstall  # noqa: E402
+from mcinstall import (  # noqa: E402
+    MinicondaInstaller,
+    config,
+    make_parser,
+    parse_size,
+    plan_provisioning,
+)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+BLOB_NAME = "Miniconda3-latest-Linux-x86_64.sh"
+
+INSTALLER = """#!/bin/bash
+# Fake Miniconda installer made by bench_mcinstall.py.
+while getopts "bfp:" opt; do
+    case $opt in p) PREFIX=$OPTARG;; esac
+done
+mkdir -p "$PREFIX/bin" "$PREFIX/conda-meta"
+cat > "$PREFIX/bin/conda" <<'STUB'
+@CONDA@
+STUB
+cat > "$PREFIX/bin/pip" <<'STUB'
+@PIP@
+STUB
+chmod +x "$PREFIX/bin/conda" "$PREFIX/bin/pip"
+sleep @DELAY@
+exit 0
+"""
+
+CONDA_STUB = """#!@PYTHON@
+import sys, time
+time.sleep(@DELAY@)
+print("Collecting package metadata (current_repodata.json): done")
+print("Solving environment: done")
+print("Executing transaction: done")
+"""
+
+PIP_STUB = """#!@PYTHON@
+import sys, time
+args = sys.argv[2:]
+skip = False
+for arg in args:
+    if skip or arg.startswith("-"):
+        skip = arg in ("-r", "-d", "--find-links", "--index-url")
+        continue
+    print("Collecting %s" % arg)
+    print("  Downloading %s-1.0-py3-none-any.whl (1.0 MB)" % arg)
+    time.sleep(@DELAY@)
+print("Successfully installed %s" % " ".join(args))
+"""
+
+
+def make_installer_blob(path: Path, size: int, delay: float):
+    """Write a fake installer script, padded to ``size`` bytes.
+
+    :param path: The path to write to.
+    :param size: The size of the blob in bytes.
+    :param delay: The delay of the installer and each stub call in seconds.
+    """
+    def stub(text):
+        return text.replace("@PYTHON@", sys.executable).replace(
+            "@DELAY@", str(delay))
+
+    script = INSTALLER.replace("@CONDA@", stub(CONDA_STUB).strip())
+    script = script.replace("@PIP@", stub(PIP_STUB).strip())
+    script = script.replace("@DELAY@", str(delay)).encode("utf8")
+    with path.open("wb") as f:
+        f.write(script)
+        # Never read by bash, which stops at "exit".
+        remaining = max(0, size - len(script))
+        block = os.urandom(min(remaining, 2 ** 20) or 1)
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+class BlobHandler(BaseHTTPRequestHandler):
+    """Serve the blob file for any path, honouring ``Range`` requests.
+
+    Every response is delayed by the server's ``latency`` and sent at no
+    more than its ``bandwidth`` bytes per second, if set.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(self.server.size))
+        self.send_header("ETag", self.server.etag)
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        time.sleep(server.latency)
+        if self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start, end = 0, server.size - 1
+        rng = self.headers.get("Range")
+        if rng:
+            first, _, last = rng.split("=")[1].partition("-")
+            start = int(first)
+            end = int(last) if last else end
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes %d-%d/%d" % (start, end, server.size)
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", server.etag)
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.end_headers()
+        try:
+            self.send_range(start, end + 1 - start)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_range(self, start: int, length: int):
+        rate = self.server.bandwidth
+        started = time.monotonic()
+        sent = 0
+        with open(self.server.path, "rb") as f:
+            f.seek(start)
+            while sent < length:
+                data = f.read(min(64 * 1024, length - sent))
+                self.wfile.write(data)
+                sent += len(data)
+                if rate:
+                    delay = sent / rate - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+
+
+class BlobServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, path: Path, latency: float, bandwidth: int):
+        super().__init__(("127.0.0.1", 0), BlobHandler)
+        self.path = str(path)
+        self.size = path.stat().st_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        # Not hashing the content, which would skew the RSS measured.
+        self.etag = '"%x-%x"' % (self.size, path.stat().st_mtime_ns)
+        self.requests = 0
+        self.url = "http://127.0.0.1:%d/" % self.server_port
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+def max_rss() -> int:
+    """Return the peak RSS of this process in bytes (0 if unknown).
+    """
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def summarize(name: str, runs: list, **extra) -> dict:
+    """Return a result with the median and all run times in seconds.
+    """
+    return dict(
+        extra,
+        benchmark=name,
+        seconds=statistics.median(runs),
+        runs=runs,
+    )
+
+
+def bench_download(work: Path, server: BlobServer, connections: int,
+                   repeat: int) -> dict:
+    """Benchmark ``download_file()`` with some number of connections.
+    """
+    runs = []
+    python_peak = 0
+    for i in range(repeat):
+        inst = MinicondaInstaller(
+            str(work / "dest"), download_connections=connections
+        )
+        path = work / ("blob-%d.sh" % i)
+        tracemalloc.start()
+        started = time.monotonic()
+        inst.download_file(server.url + BLOB_NAME, path)
+        runs.append(time.monotonic() - started)
+        python_peak = max(python_peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        inst.close()
+        path.unlink()
+    seconds = statistics.median(runs)
+    return summarize(
+        "download",
+        runs,
+        connections=connections,
+        bytes=server.size,
+        throughput_mib_s=server.size / 2 ** 20 / seconds,
+        python_peak_bytes=python_peak,
+        max_rss_bytes=max_rss(),
+    )
+
+
+def bench_revalidate(work: Path, server: BlobServer, repeat: int) -> dict:
+    """Benchmark ``fetch_installer()`` with a cached ``latest`` installer.
+    """
+    inst = MinicondaInstaller(str(work / "dest"))
+    inst.fetch_installer()
+    runs = []
+    for i in range(repeat):
+        started = time.monotonic()
+        inst.fetch_installer()
+        runs.append(time.monotonic() - started)
+    inst.close()
+    return summarize("revalidate", runs)
+
+
+def bench_provision(work: Path, parallel: int, packages: int,
+                    repeat: int) -> dict:
+    """Benchmark all provisioning steps against the stub executables.
+    """
+    runs = []
+    steps = {}
+    child_seconds = []
+    pip_deps = ",".join("pkg%d" % i for i in range(packages))
+    conda_deps = ",".join("cpkg%d" % i for i in range(packages))
+    for i in range(repeat):
+        dest = work / ("mc3-%d-%d" % (parallel, i))
+        # Start without a cached installer, so the fetch step is included.
+        shutil.rmtree(str(work / "dl"), ignore_errors=True)
+        args = make_parser().parse_args([
+            str(dest),
+            "--parallel", str(parallel),
+            "--pip-dependencies", pip_deps,
+            "--conda-dependencies", conda_deps,
+        ])
+        inst = MinicondaInstaller(str(dest))
+        started = time.monotonic()
+        timings = plan_provisioning(inst, args).run()
+        runs.append(time.monotonic() - started)
+        child_seconds.append(
+            sum(r.duration for r in inst.results) + timings.get("fetch", 0)
+        )
+        for name, seconds in timings.items():
+            steps.setdefault(name, []).append(seconds)
+        inst.close()
+        shutil.rmtree(str(dest))
+    result = summarize(
+        "provision",
+        runs,
+        parallel=parallel,
+        packages=packages,
+        steps=dict(
+            (name, statistics.median(times)) for name, times in steps.items()
+        ),
+    )
+    if parallel == 1:
+        result["overhead_seconds"] = statistics.median(
+            [wall - child for wall, child in zip(runs, child_seconds)]
+        )
+    return result
+
+
+def make_bench_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
+        description="Benchmark mcinstall offline against a local server."
+    )
+    p.add_argument(
+        "--size", metavar="SIZE", type=parse_size, default=parse_size("64M"),
+        help="Size of the fake installer, e.g. 64M (default).",
+    )
+    p.add_argument(
+        "--latency", metavar="SECONDS", type=float, default=0.0,
+        help="Delay added to every HTTP response.",
+    )
+    p.add_argument(
+        "--bandwidth", metavar="SIZE", type=parse_size, default=0,
+        help="Bandwidth cap per connection in bytes per second, e.g. 20M.",
+    )
+    p.add_argument(
+        "--connections", metavar="LIST", default="1,4",
+        help="Comma-separated numbers of download connections to compare.",
+    )
+    p.add_argument(
+        "--stub-delay", metavar="SECONDS", type=float, default=0.1,
+        help="Delay of the fake installer and each stub conda/pip call.",
+    )
+    p.add_argument(
+        "--packages", metavar="N", type=int, default=5,
+        help="Number of fake pip and conda dependencies each.",
+    )
+    p.add_argument(
+        "--parallel", metavar="N", type=int, default=4,
+        help="Parallel steps for the second provisioning benchmark.",
+    )
+    p.add_argument(
+        "--repeat", metavar="N", type=int, default=3,
+        help="Number of runs per benchmark, the median is reported.",
+    )
+    p.add_argument(
+        "--output", metavar="PATH",
+        help="Write the JSON results to this file instead of stdout.",
+    )
+    return p
+
+
+def main(argv=None):
+    args = make_bench_parser().parse_args(argv)
+    work = Path(tempfile.mkdtemp(prefix="mcinstall-bench-"))
+    config.update(
+        log_path=str(work / "mcinstall.log"),
+        events_path=str(work / "mcinstall-events.jsonl"),
+        downloads_dir=str(work / "dl"),
+        mc_blob_name=BLOB_NAME,
+        mc_index_url=None,
+    )
+    blob_path = work / "blob.sh"
+    make_installer_blob(blob_path, args.size, args.stub_delay)
+    results = []
+    try:
+        with BlobServer(blob_path, args.latency, args.bandwidth) as server:
+            config["mc_base_url"] = server.url
+            for connections in args.connections.split(","):
+                results.append(bench_download(
+                    work, server, int(connections), args.repeat))
+            results.append(bench_revalidate(work, server, args.repeat))
+            if platform.system() != "Windows":
+                for parallel in sorted({1, args.parallel}):
+                    results.append(bench_provision(
+                        work, parallel, args.packages, args.repeat))
+    finally:
+        shutil.rmtree(str(work), ignore_errors=True)
+
+    report = dict(
+        mcinstall=mcinstall.__version__,
+        python=platform.python_version(),
+        system=platform.system(),
+        settings=dict(
+            (k, v) for k, v in vars(args).items() if k != "output"
+        ),
+        results=results,
+    )
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,14 +14,58 @@ For additional information please read the README! ;)
 """
 
 import argparse
+import hashlib
+import hmac
+import io
+import ipaddress
+import json
+import mmap
+import multiprocessing
 import os
 import platform
 import re
+import secrets
+import shutil
+import socket
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from fnmatch import fnmatch
+from functools import partial
+from http.client import HTTPConnection, HTTPException
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from pathlib import Path
-from subprocess import PIPE, Popen, check_output
-from typing import List, Optional
+from socketserver import ThreadingMixIn
+from stat import S_ISSOCK
+from subprocess import PIPE, CalledProcessError, Popen, TimeoutExpired
+from typing import Callable, List, Optional, Sequence, Tuple
 from urllib import request
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    from socketserver import UnixStreamServer
+except ImportError:  # Windows
+    UnixStreamServer = None
 
 __version__ = "0.3.1"
 __license__ = "MIT"
@@ -30,12 +74,44 @@ __license__ = "MIT"
 # config data
 config = dict(
     mc_base_url="https://repo.continuum.io/miniconda/",
+    mc_index_url="https://repo.continuum.io/miniconda/",
     mc_name="Miniconda3",
     mc_version="latest",
     machine=platform.machine(),
     system=platform.system(),
     downloads_dir="~/Downloads",
     log_path="./mcinstall.log",
+    events_path="./mcinstall-events.jsonl",
+    user_agent=(
+        "Mozilla / 5.0 (X11 Linux x86_64) AppleWebKit / 537.36 "
+        "(KHTML, like Gecko) Chrome / 52.0.2743.116 Safari / 537.36"
+    ),
+    download_chunk_size=256 * 1024,
+    download_timeout=60,
+    download_retries=3,
+    progress_interval=1.0,
+    cache_dir_name="mcinstall-cache",
+    cache_max_bytes=2 * 1024 ** 3,
+    wheelhouse_name="mcinstall-wheels",
+    dedup_min_bytes=1024,
+    verify_report=10,
+    bundles_dir_name="mcinstall-bundles",
+    state_file_name=".mcinstall-state.json",
+    repo_index_ttl=24 * 3600,
+    micromamba_url="https://micro.mamba.pm/api/micromamba/%s/latest",
+    micromamba_channel="conda-forge",
+    mirror_ttl=3600,
+    mirror_probe_bytes=64 * 1024,
+    mirror_probe_timeout=5,
+    stall_timeout=15,
+    serve_address=(
+        "~/.mcinstall.sock" if hasattr(socket, "AF_UNIX") else "127.0.0.1:8765"
+    ),
+    serve_token_path="~/.mcinstall-token",
+    serve_poll_interval=0.5,
+    serve_keep_jobs=100,
+    pypi_index_url="https://pypi.org/simple",
+    conda_channel_url="https://conda.anaconda.org/",
 )
 
 # derived config data
@@ -58,6 +134,8 @@ if config["system"] in known_systems:
         )
         config["mc_name"] = "Berryconda3"
         config["mc_version"] = "2.0.0"
+        # GitHub releases have no listing with checksums.
+        config["mc_index_url"] = None
 
     config["mc_blob_name"] = "%s-%s-%s-%s.%s" % (
         config["mc_name"],
@@ -68,366 +146,5238 @@ if config["system"] in known_systems:
     )
 
 
-class MinicondaInstaller:
-    """A tiny installer to bring you up to Python/Pip/Conda speed in seconds.
+def _validators(headers) -> dict:
+    """Extract HTTP cache validators from response headers.
 
-    This is mainly meant to install a fresh Miniconda distribution. It also
-    allows to provision the installed base environment with additional packages
-    via ``pip`` or ``conda``.
+    :param headers: The headers of an HTTP response.
+    :returns: A dict with ``etag`` and ``last_modified`` (either may be
+        ``None``).
+    """
+    return dict(
+        etag=headers.get("ETag"),
+        last_modified=headers.get("Last-Modified"),
+    )
 
-    N.B.:
 
-    - Dependencies specified via ``conda`` environment files will not be
-      available together with dependencies specified separately via ``pip``!
+def parse_size(value: str) -> int:
+    """Parse a byte size like ``"500M"`` or ``"2G"`` into a number of bytes.
+
+    :param value: A number with an optional ``K``, ``M`` or ``G`` suffix.
+    :returns: The number of bytes.
+    :raises ValueError: Is raised for malformed values.
     """
+    m = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMG]?)i?B?\s*$", value, re.I)
+    if not m:
+        raise ValueError("Invalid size: %s" % value)
+    number, unit = m.groups()
+    return int(float(number) * 1024 ** " KMG".index(unit.upper() or " "))
 
-    def __init__(self, dest_path: str, verbose: bool = False):
-        self.dest_path = dest_path
-        self.verbose = verbose
-        self.installed_ok = False
-        self.clean_dest_path = Path(dest_path).expanduser().absolute()
-        self.download_path = (
-            Path(config["downloads_dir"]).expanduser().absolute()
-        )
 
-    def __del__(self):
-        if self.verbose and self.installed_ok:
-            if config["system"] == "Windows":
-                cmd = r"%s\condabin\activate" % self.clean_dest_path
-            else:
-                cmd = "source %s/bin/activate" % self.clean_dest_path
-            print('Run this to start using your fresh Miniconda: "%s".' % cmd)
+class InstallerCache:
+    """A content-addressed cache for installer blobs.
 
-    def log(self, command: str):
-        """Logger method to log results to ``log_path`` from ``config``.
+    Blobs are stored by SHA-256 under ``<path>/blobs`` and a JSON index
+    maps each blob name (like ``Miniconda3-latest-Linux-x86_64.sh``) to its
+    URL, ETag, Last-Modified, size, SHA-256 and time of last use. The index
+    allows conditional revalidation of moving targets like ``latest`` and
+    least-recently-used eviction beyond ``max_bytes``.
+    """
 
-        :param command: The shell command to add to the logfile.
-        """
-        log_path = Path(config["log_path"]).expanduser().absolute()
-        with log_path.open("a") as f:
-            f.write("%s\n" % command)
+    index_name = "index.json"
 
-    def download(self):
-        """Download Miniconda locally at desired destination.
-        """
-        if not self.clean_dest_path.exists():
-            if self.verbose:
-                print("Making directory %s." % self.clean_dest_path)
-            self.clean_dest_path.mkdir(parents=True)
+    def __init__(self, path: Path, max_bytes: Optional[int] = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.index_path = path / self.index_name
+        self.lock = threading.Lock()
 
-        if not self.download_path.exists():
-            if self.verbose:
-                print("Making directory %s." % self.download_path)
-            self.download_path.mkdir()
+    def _load(self) -> dict:
+        try:
+            return json.loads(self.index_path.read_text())
+        except (OSError, ValueError):
+            return {}
 
-    def install_miniconda(self):
-        """Install Miniconda locally at desired destination.
+    def _save(self, index: dict):
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_name(
+            "%s.%d.%d.tmp" % (
+                self.index_name, os.getpid(), threading.get_ident()
+            )
+        )
+        tmp_path.write_text(json.dumps(index, indent=2, sort_keys=True))
+        tmp_path.replace(self.index_path)
 
-        :raises ValueError: Is raised if the download fails.
+    def blob_path(self, name: str, sha256: str) -> Path:
+        """Return the storage path for a blob, keeping its file extension.
+
+        :param name: The blob name.
+        :param sha256: The hex SHA-256 digest of the blob.
         """
-        dest_path = self.clean_dest_path
-        mc_blob_path = self.download_path / config["mc_blob_name"]
-        if not mc_blob_path.exists():
-            url = config["mc_base_url"] + config["mc_blob_name"]
-            if self.verbose:
-                print("Downloading %s ..." % url)
-            user_agent = "Mozilla / 5.0 (X11 Linux x86_64) AppleWebKit / 537.36 (KHTML, like Gecko) Chrome / 52.0.2743.116 Safari / 537.36"
-            headers = {"User-Agent": user_agent}
-            req = request.Request(url, headers=headers)
-            resp = request.urlopen(req)
-            self.log("wget %s" % url)
-            if resp.status >= 400:
-                msg = "Cannot download %s. Verify URL components!" % url
-                raise ValueError(msg)
-            mc_blob = resp.read()
-            if self.verbose:
-                print("Copying to %s ..." % mc_blob_path)
-            mc_blob_path.write_bytes(mc_blob)
-            self.log("mv %s %s" % (config["mc_blob_name"], mc_blob_path))
+        return self.path / "blobs" / (sha256 + Path(name).suffix)
 
-        if not (
-            (dest_path / "bin" / "conda").exists()
-            or (dest_path / "condabin" / "conda.bat").exists()
-        ):
-            if config["system"] == "Windows":
-                cmd = (
-                    'start /wait "" %s /InstallationType=JustMe /RegisterPython=0 /S /D=%s'
-                    % (mc_blob_path, dest_path)
-                )
-                with open("temp.bat", "w") as fh:
-                    fh.write(cmd)
-                p = Popen("temp.bat", stdout=PIPE)
-                stdout, stderr = p.communicate()
-                print(p.returncode)
-                if p.returncode != 0:
-                    self.log(str(stdout))
-                    self.log(str(stderr))
-                    raise ValueError("Installation failed...")
-                else:
-                    os.remove("temp.bat")
-            else:
-                cmd = "bash %s -b -f -p %s" % (mc_blob_path, dest_path)
-                if self.verbose:
-                    print("Running command: %s" % cmd)
-                output = check_output(cmd.split())
-                print(output.decode("utf8"))
-            self.log(cmd)
-        if config["system"] == "Windows":
-            cmd = r"%s\condabin\activate" % dest_path
-        else:
-            cmd = "source %s/bin/activate" % dest_path
-        self.log(cmd)
+    def get(self, name: str) -> Optional[dict]:
+        """Return the index entry for a blob name if the blob is present.
 
-        self.installed_ok = True
+        :param name: The blob name.
+        """
+        entry = self._load().get(name)
+        if entry and self.blob_path(name, entry["sha256"]).exists():
+            return entry
+        return None
 
-    def update_miniconda_base(self):
+    def touch(self, name: str):
+        """Mark a blob as used now.
+
+        :param name: The blob name.
         """
-        Update conda post installation.
+        with self.lock:
+            index = self._load()
+            if name in index:
+                index[name]["last_used"] = time.time()
+                self._save(index)
+
+    def add(self, name: str, path: Path, entry: dict) -> Path:
+        """Move a downloaded file into the cache and record it in the index.
+
+        :param name: The blob name.
+        :param path: The downloaded file, which will be moved.
+        :param entry: The index entry, must contain at least ``sha256``.
+        :returns: The path of the cached blob.
         """
-        if config["system"] == "Windows":
-            cmd = r"%s\condabin\conda update -y -n base -c defaults conda" \
-                  % self.clean_dest_path
-            if self.verbose:
-                print("Running command: %s" % cmd)
-            output = check_output(cmd.split(), shell=True)
-        else:
-            cmd = r"%s/bin/conda update -y -n base -c defaults conda" % self.clean_dest_path
-            if self.verbose:
-                print("Running command: %s" % cmd)
-            output = check_output(cmd.split())
-        self.log(cmd)
-        print(output.decode("utf8"))
+        blob_path = self.blob_path(name, entry["sha256"])
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        path.replace(blob_path)
+        with self.lock:
+            index = self._load()
+            entry = dict(entry, size=blob_path.stat().st_size)
+            entry["last_used"] = time.time()
+            index[name] = entry
+            self._save(index)
+        self.evict(keep=name)
+        return blob_path
 
-    def install_pip(
-        self,
-        dependencies: Optional[List[str]] = None,
-        dependencies_path: Optional[str] = None,
-        index_url: Optional[str] = None,
-        extra_index_url: Optional[List[str]] = None
-    ):
-        """Pip-install dependencies.
+    def blob_lock(self, name: str) -> "FileLock":
+        """Return a lock for downloading and adding a blob by name.
 
-        Dependencies can be specified in a list of package names or
-        a dependencies file.
+        :param name: The blob name.
+        """
+        return FileLock(self.path / (name + ".lock"))
 
-        :param dependencies: A list of dependency names.
-        :param dependencies_path: A file path with one dependency name per line.
-        :param index_url: URL for package index.
-        :param extra_index_url: Additional URL for package index.
+    def evict(self, keep: Optional[str] = None) -> List[str]:
+        """Remove least-recently-used blobs until the cache fits ``max_bytes``.
+
+        :param keep: A blob name never to evict.
+        :returns: The evicted blob names.
         """
-        dep_path = dependencies_path
-        dest_path = self.clean_dest_path
-        pip_cmd = "pip install"
-        if index_url:
-            pip_cmd = r"%s --index-url %s" % (pip_cmd, index_url)
-        if extra_index_url:
-            extra_index_urls = extra_index_url.split(",")
-            print(str(extra_index_urls))
-            for url in extra_index_urls:
-                pip_cmd = r"%s --extra-index-url %s" % (pip_cmd, url)
+        if self.max_bytes is None:
+            return []
+        evicted = []
+        with self.lock:
+            index = self._load()
+            blob_sizes = {}
+            for entry in index.values():
+                blob_sizes[entry["sha256"]] = entry.get("size") or 0
+            total = sum(blob_sizes.values())
+            by_age = sorted(index, key=lambda n: index[n].get("last_used", 0))
+            for name in by_age:
+                if total <= self.max_bytes:
+                    break
+                if name == keep:
+                    continue
+                entry = index.pop(name)
+                evicted.append(name)
+                sha256 = entry["sha256"]
+                if all(e["sha256"] != sha256 for e in index.values()):
+                    blob_path = self.blob_path(name, sha256)
+                    if blob_path.exists():
+                        blob_path.unlink()
+                    total -= blob_sizes.pop(sha256)
+            if evicted:
+                self._save(index)
+        return evicted
 
-        for dep in dependencies or []:
-            # This will give output earlier when installed individually.
-            if config["system"] == "Windows":
-                cmd = r"%s\condabin\activate && %s %s" % (
-                    dest_path,
-                    pip_cmd,
-                    dep,
-                )
-                output = check_output(cmd.split(), shell=True)
-            else:
-                cmd = "%s/bin/%s %s" % (dest_path, pip_cmd, dep)
-                output = check_output(cmd.split())
-            if self.verbose:
-                print("Running command: %s" % cmd)
-            self.log(cmd)
-            print(output.decode("utf8"))
 
-        if dependencies_path:
-            if config["system"] == "Windows":
-                cmd = r"%s\condabin\activate && %s -r %s" % (
-                    dest_path,
-                    pip_cmd,
-                    dep_path,
-                )
-                output = check_output(cmd.split(), shell=True)
-            else:
-                cmd = "%s/bin/%s -r %s" % (dest_path, pip_cmd, dep_path)
-                output = check_output(cmd.split())
-            if self.verbose:
-                print("Running command: %s" % cmd)
-            self.log(cmd)
-            print(output.decode("utf8"))
+def parse_repo_index(html: str) -> dict:
+    """Parse a Miniconda repository listing into a table of installers.
 
-    def install_conda(
-        self,
-        channel: str = "conda-forge",
-        dependencies: Optional[List[str]] = None,
-        dependencies_path: Optional[str] = None,
-        environment_path: Optional[str] = None,
-    ):
-        """Conda-install dependencies.
+    The listing is an HTML table with a row per file, with columns for the
+    name, size (like ``89.0M``), modification time and checksum (SHA-256,
+    or MD5 on older listings).
 
-        Dependencies can be specified in a list of package names or
-        a dependencies file or a conda environment file (which will
-        create a new environment).
+    :param html: The listing as served at ``mc_index_url`` from ``config``.
+    :returns: A dict mapping file names to dicts with the ``version`` (like
+        ``py39_4.9.2`` or ``latest``), approximate ``size`` in bytes,
+        ``modified`` time, and ``sha256`` or ``md5`` digest.
+    """
+    index = {}
+    row = re.compile(
+        r"<tr>\s*<td>\s*<a href=\"([^\"/]+)\">[^<]*</a>\s*</td>"
+        r"\s*<td[^>]*>\s*([^<]*?)\s*</td>"
+        r"\s*<td[^>]*>\s*([^<]*?)\s*</td>"
+        r"\s*<td[^>]*>\s*([0-9a-f]{64}|[0-9a-f]{32})\s*</td>",
+        re.I,
+    )
+    for name, size, modified, digest in row.findall(html):
+        m = re.match(r"^[A-Za-z]+\d*-(.+?)-(?:Linux|MacOSX|Windows)-", name)
+        try:
+            size = parse_size(size)
+        except ValueError:
+            size = None
+        entry = dict(
+            version=m.group(1) if m else None,
+            size=size,
+            modified=modified,
+        )
+        entry["sha256" if len(digest) == 64 else "md5"] = digest.lower()
+        index[name] = entry
+    return index
 
-        :param channel: The conda channel to fetch the packages from.
-        :param dependencies: A list of dependency names.
-        :param dependencies_path: A file path with one dependency name per line.
-        :param environment_path: A file path for a conda environment file.
-        """
-        dep_path = dependencies_path
-        env_path = environment_path
-        dest_path = self.clean_dest_path
 
-        for dep in dependencies or []:
-            # This will give output earlier when installed individually.
-            if config["system"] == "Windows":
-                cmd = r"%s\condabin\conda install -y %s" % (dest_path, dep)
-                output = check_output(cmd.split(), shell=True)
-            else:
-                cmd = "%s/bin/conda install -y -c %s %s" % (
-                    dest_path,
-                    channel,
-                    dep,
-                )
-                output = check_output(cmd.split())
-            if self.verbose:
-                print("Running command: %s" % cmd)
-            self.log(cmd)
-            print(output.decode("utf8"))
+def resolve_installer(index: dict, name: str) -> Tuple[str, Optional[dict]]:
+    """Resolve an installer name to a pinned version using a repo index.
 
-        if dependencies_path:
-            if config["system"] == "Windows":
-                cmd = r"%s\condabin\conda install -y --file %s" % (
-                    dest_path,
-                    dep_path,
-                )
-                output = check_output(cmd.split(), shell=True)
-            else:
-                cmd = "%s/bin/conda install -y --file %s" % (
-                    dest_path,
-                    dep_path,
-                )
-                output = check_output(cmd.split())
-            if self.verbose:
-                print("Running command: cmd" % cmd)
-            self.log(cmd)
-            print(output.decode("utf8"))
+    A ``latest`` installer is resolved to the versioned one with the same
+    checksum in the index, e.g. ``Miniconda3-latest-Linux-x86_64.sh`` to
+    ``Miniconda3-py39_4.9.2-Linux-x86_64.sh``.
 
-        if environment_path:
-            if config["system"] == "Windows":
-                cmd = r"%s\condabin\conda env create --file %s" % (
-                    dest_path,
-                    env_path,
-                )
-                output = check_output(cmd.split(), shell=True)
-            else:
-                cmd = "%s/bin/conda env create --file %s" % (
-                    dest_path,
-                    env_path,
-                )
-                output = check_output(cmd.split())
-            if self.verbose:
-                print("Running command: %s" % cmd)
-            self.log(cmd)
-            print(output.decode("utf8"))
+    :param index: The index as returned by ``parse_repo_index()``.
+    :param name: The installer name.
+    :returns: The resolved name and its index entry (``None`` if the name
+        is not in the index).
+    """
+    entry = index.get(name)
+    if entry is None:
+        return name, None
+    if "latest" in name:
+        key = "sha256" if "sha256" in entry else "md5"
+        for other in sorted(index):
+            if "latest" not in other and index[other].get(key) == entry[key]:
+                return other, index[other]
+    return name, entry
 
 
-def main():
-    """Main function called when used on the command-line.
+class RepoIndex:
+    """A repository listing parsed with ``parse_repo_index()``, cached on disk.
+
+    The parsed index is kept in a JSON file for ``ttl`` seconds. When it
+    cannot be fetched again later, e.g. when offline, the stale copy is
+    used.
     """
-    systems = ", ".join(known_systems)
-    desc = "Quick-install/provision a fresh Miniconda for %s." % systems
-    p = argparse.ArgumentParser(description=desc)
 
-    p.add_argument(
-        "path",
-        metavar="DEST_DIR",
-        help="The destination directory (will be created if needed).",
-    )
-    p.add_argument(
-        "--verbose", action="store_true", help="Output additional information."
-    )
-    p.add_argument(
-        "--pip-dependencies",
-        metavar="LIST",
-        default="",
-        help="Comma-separated list of pip requirements.",
-    )
-    p.add_argument(
-        "--pip-dependencies-path",
-        metavar="PATH",
-        help="Path of a pip requirements file, usually named requirements.txt.",
-    )
-    p.add_argument(
-        "--pip-index-url",
-        metavar="URL",
-        help="Base URL of the Python Package Index",
-    )
-    p.add_argument(
-        "--pip-extra-index-url",
-        metavar="URL",
-        help="Extra URLs of package indexes to use in addition to --pip-index-url",
-    )
-    p.add_argument(
-        "--conda-dependencies",
-        metavar="LIST",
-        default="",
-        help="Comma-separated list of conda requirements.",
-    )
-    p.add_argument(
-        "--conda-dependencies-path",
-        metavar="PATH",
-        help=(
-            "Path of a conda dependencies file, usually named requirements.txt. "
-            "(This is not for creating a conda environment "
-            "with something like environment.yml!)"
-        ),
-    )
-    p.add_argument(
-        "--conda-environment-path",
-        metavar="PATH",
-        help="Path of a conda environment file, usually named environment.yml.",
+    def __init__(self, path: Path, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.memory = {}
+
+    def _load(self) -> dict:
+        try:
+            return json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, source: str, read: Callable) -> dict:
+        """Return the index of a listing, reading it if the cache is stale.
+
+        Indexes read or loaded are kept in ``memory`` as well, so a
+        long-lived instance reads the JSON file only once per ``ttl``.
+
+        :param source: The URL or path of the listing.
+        :param read: A callable returning the listing of a source as text.
+        :returns: The index, empty if it is neither cached nor readable.
+        """
+        with self.lock:
+            cached = self.memory.get(source)
+            if cached and time.time() - cached["time"] < self.ttl:
+                return cached["index"]
+            cached = self._load().get(source)
+            if cached:
+                self.memory[source] = cached
+            if cached and time.time() - cached["time"] < self.ttl:
+                return cached["index"]
+            try:
+                index = parse_repo_index(read(source))
+            except (
+                OSError, ValueError, HTTPException, URLError, socket.timeout
+            ):
+                return cached["index"] if cached else {}
+            if not index:
+                return cached["index"] if cached else {}
+            indexes = self._load()
+            indexes[source] = self.memory[source] = dict(
+                time=time.time(), index=index)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(
+                "%s.%d.%d.tmp" % (
+                    self.path.name, os.getpid(), threading.get_ident()
+                )
+            )
+            tmp_path.write_text(json.dumps(indexes, indent=2, sort_keys=True))
+            tmp_path.replace(self.path)
+            return index
+
+
+def probe_mirror(url: str) -> dict:
+    """Measure the latency and throughput of a mirror with a range request.
+
+    This fetches the first ``mirror_probe_bytes`` bytes from ``config`` of
+    ``url``. The latency is the time to the response headers, the
+    throughput the rate of the body.
+
+    :param url: The URL of a file on the mirror.
+    :returns: A dict with the ``url``, ``ok``, ``latency`` in seconds,
+        ``throughput`` in bytes per second and a ``score``, the estimated
+        seconds to fetch 1 MiB (lower is better, ``None`` if not ok).
+    """
+    size = config["mirror_probe_bytes"]
+    headers = {
+        "User-Agent": config["user_agent"],
+        "Range": "bytes=0-%d" % (size - 1),
+    }
+    req = request.Request(url, headers=headers)
+    result = dict(url=url, ok=False, latency=None, throughput=None, score=None)
+    started = time.monotonic()
+    try:
+        with request.urlopen(req, timeout=config["mirror_probe_timeout"]) as resp:
+            latency = time.monotonic() - started
+            data = resp.read(size)
+    except (HTTPException, URLError, socket.timeout, ConnectionError) as err:
+        result["error"] = str(err)
+        return result
+    elapsed = max(time.monotonic() - started - latency, 1e-6)
+    throughput = len(data) / elapsed
+    result.update(
+        ok=True,
+        latency=latency,
+        throughput=throughput,
+        score=latency + 2 ** 20 / max(throughput, 1),
     )
+    return result
 
-    if config["system"] not in known_systems:
-        msg = (
-            """Don't know how to handle operating system %s'. Want to provide a patch?"""
-            % config["system"]
-        )
-        print(msg)
-        sys.exit(0)
 
-    args = p.parse_args()
+class MirrorRanking:
+    """Mirrors ranked by probing them concurrently, cached for a TTL.
 
-    if args.path:
-        inst = MinicondaInstaller(dest_path=args.path, verbose=args.verbose)
-        inst.download()
-        inst.install_miniconda()
-        inst.update_miniconda_base()
-        if args.pip_dependencies or args.pip_dependencies_path:
-            inst.install_pip(
-                dependencies=args.pip_dependencies.split(",")
-                if args.pip_dependencies
-                else None,
-                dependencies_path=args.pip_dependencies_path,
-                index_url=args.pip_index_url,
-                extra_index_url=args.pip_extra_index_url
+    The rankings are kept in a JSON file, keyed by the probed URLs, so that
+    later runs within ``ttl`` seconds need no probing.
+    """
+
+    def __init__(self, path: Path, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def _load(self) -> dict:
+        try:
+            return json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def rank(self, urls: Sequence[str]) -> List[dict]:
+        """Return probe results for some URLs, fastest first.
+
+        Mirrors failing the probe are kept last, in the given order, as a
+        last resort.
+
+        :param urls: The URLs of the same file on different mirrors.
+        :returns: The ``probe_mirror()`` results.
+        """
+        key = "\n".join(urls)
+        with self.lock:
+            cached = self._load().get(key)
+        if cached and time.time() - cached["time"] < self.ttl:
+            return cached["ranking"]
+        with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+            results = list(pool.map(probe_mirror, urls))
+        ranking = sorted(
+            [r for r in results if r["ok"]], key=lambda r: r["score"]
+        ) + [r for r in results if not r["ok"]]
+        with self.lock:
+            rankings = self._load()
+            now = time.time()
+            rankings = dict(
+                (k, v) for k, v in rankings.items()
+                if now - v["time"] < self.ttl
             )
-        if (
-            args.conda_dependencies
-            or args.conda_dependencies_path
-            or args.conda_environment_path
-        ):
-            inst.install_conda(
-                dependencies=args.conda_dependencies.split(",")
-                if args.conda_dependencies
-                else None,
-                dependencies_path=args.conda_dependencies_path,
-                environment_path=args.conda_environment_path,
+            rankings[key] = dict(time=now, ranking=ranking)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(
+                "%s.%d.%d.tmp" % (
+                    self.path.name, os.getpid(), threading.get_ident()
+                )
             )
+            tmp_path.write_text(json.dumps(rankings, indent=2, sort_keys=True))
+            tmp_path.replace(self.path)
+        return ranking
+
+
+class FileLock:
+    """An exclusive advisory lock on a file, usable as a context manager.
+
+    This uses ``fcntl.flock()`` on POSIX and ``msvcrt.locking()`` on
+    Windows, and blocks until the lock is acquired.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.fh = None
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fh = self.path.open("a+")
+        if fcntl is not None:
+            fcntl.flock(self.fh.fileno(), fcntl.LOCK_EX)
+        else:
+            import msvcrt
+
+            while True:
+                try:
+                    msvcrt.locking(self.fh.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self.fh.fileno(), fcntl.LOCK_UN)
+        else:
+            import msvcrt
+
+            msvcrt.locking(self.fh.fileno(), msvcrt.LK_UNLCK, 1)
+        self.fh.close()
+
+
+# ioctl request number to clone a file on Linux (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+def _reflink(src: Path, dest: Path) -> bool:
+    """Try to make ``dest`` a copy-on-write clone of ``src``.
+
+    :returns: ``True`` on success, ``False`` if not supported.
+    """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    with src.open("rb") as fsrc, dest.open("wb") as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            ok = False
+        else:
+            ok = True
+    if ok:
+        shutil.copystat(str(src), str(dest))
+    else:
+        dest.unlink()
+    return ok
+
+
+def _binary_replace(data: bytes, old: bytes, new: bytes) -> bytes:
+    """Replace a prefix in NUL-terminated strings of binary data.
+
+    Like conda does it, each string starting with ``old`` keeps its length,
+    padded with NUL bytes. A longer ``new`` prefix fits if the string is
+    followed by enough NUL bytes (as left by conda's long placeholder).
+
+    :raises ValueError: Is raised if ``new`` does not fit.
+    """
+    def replace(match):
+        rest, nuls = match.group(1), match.group(2)
+        padding = len(old) - len(new) + len(nuls)
+        if padding < 1:
+            raise ValueError("New prefix too long for binary relocation.")
+        return new + rest + b"\0" * padding
+
+    return re.sub(re.escape(old) + b"([^\0]*?)(\0+)", replace, data)
+
+
+def _relocate_data(
+    data: bytes, old: bytes, new: bytes, conda_binary: bool
+) -> bytes:
+    """Replace the prefix ``old`` with ``new`` in the content of a file.
+
+    Text files (without NUL bytes) are relocated by plain replacement,
+    binaries registered by conda with ``_binary_replace()`` and other
+    binaries (like ``.pyc`` files) are left as they are, like conda does it.
+
+    :param conda_binary: If conda registered the file as a binary file.
+    :raises ValueError: Is raised if a binary cannot be relocated.
+    """
+    if b"\0" not in data:
+        return data.replace(old, new)
+    if conda_binary:
+        return _binary_replace(data, old, new)
+    return data
+
+
+def _file_contains(path: Path, data: bytes) -> bool:
+    """Return if a file contains some bytes, without reading it into memory.
+    """
+    with path.open("rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm.find(data) != -1
+        except ValueError:  # empty file
+            return False
+
+
+def _conda_binary_paths(prefix: Path) -> set:
+    """Return relative paths conda registered as binaries with a prefix.
+
+    :param prefix: The conda installation to inspect.
+    """
+    paths = set()
+    for meta_path in (prefix / "conda-meta").glob("*.json"):
+        try:
+            meta = json.loads(meta_path.read_text())
+        except ValueError:
+            continue
+        for entry in meta.get("paths_data", {}).get("paths", []):
+            if entry.get("file_mode") == "binary":
+                paths.add(os.path.normpath(entry["_path"]))
+    return paths
+
+
+# Files of an installation changed in place later on, relative to it.
+MUTABLE_PATHS = [".condarc", "pip.conf", "pip.ini", "conda-meta/history"]
+
+
+def clone_prefix(src: Path, dest: Path, verbose: bool = False) -> dict:
+    """Clone the installation at ``src`` to ``dest``, relocating it.
+
+    Files not containing the ``src`` path are reflinked where the
+    filesystem supports it, else hardlinked, else copied. Files containing
+    it are copied and rewritten with ``_relocate_data()``. The state file
+    and the ``MUTABLE_PATHS`` are always copied, so changing them in the
+    clone leaves ``src`` alone.
+
+    :param src: The installation to clone.
+    :param dest: The destination, must not exist or be empty.
+    :param verbose: Print a summary.
+    :returns: Counts of ``reflinked``, ``hardlinked``, ``copied`` and
+        ``relocated`` files.
+    :raises ValueError: Is raised if a binary cannot be relocated.
+    """
+    old, new = str(src).encode("utf8"), str(dest).encode("utf8")
+    binary_paths = _conda_binary_paths(src)
+    mutable_paths = set(
+        os.path.normpath(p) for p in MUTABLE_PATHS + [config["state_file_name"]]
+    )
+    counts = dict(reflinked=0, hardlinked=0, copied=0, relocated=0)
+    can_reflink = can_hardlink = True
+    for root, dirs, files in os.walk(str(src)):
+        rel_root = os.path.relpath(root, str(src))
+        dest_root = dest / rel_root
+        dest_root.mkdir(parents=True, exist_ok=True)
+        shutil.copymode(root, str(dest_root))
+        for name in dirs + files:
+            src_path = Path(root) / name
+            dest_path = dest_root / name
+            if src_path.is_symlink():
+                target = os.readlink(str(src_path))
+                if target.startswith(str(src)):
+                    target = str(dest) + target[len(str(src)):]
+                os.symlink(target, str(dest_path))
+                continue
+            if name in dirs:
+                continue
+            rel_path = os.path.normpath(os.path.join(rel_root, name))
+            if _file_contains(src_path, old):
+                data = _relocate_data(
+                    src_path.read_bytes(), old, new, rel_path in binary_paths
+                )
+                dest_path.write_bytes(data)
+                shutil.copystat(str(src_path), str(dest_path))
+                counts["relocated"] += 1
+            elif rel_path in mutable_paths:
+                shutil.copy2(str(src_path), str(dest_path))
+                counts["copied"] += 1
+            elif can_reflink and _reflink(src_path, dest_path):
+                counts["reflinked"] += 1
+            else:
+                # Don't retry a filesystem without support for each file.
+                can_reflink = False
+                if can_hardlink:
+                    try:
+                        os.link(str(src_path), str(dest_path))
+                        counts["hardlinked"] += 1
+                        continue
+                    except OSError:
+                        can_hardlink = False
+                shutil.copy2(str(src_path), str(dest_path))
+                counts["copied"] += 1
+    if verbose:
+        print("Cloned %s to %s: %s." % (src, dest, ", ".join(
+            "%d %s" % (n, k) for k, n in sorted(counts.items()))))
+    return counts
+
+
+def tree_size(path: Path) -> int:
+    """Return the bytes used by the files below a path, counting each once.
+
+    Symlinks are not followed and hardlinked files are counted once.
+    """
+    total = 0
+    seen = set()
+    for root, _, files in os.walk(str(path)):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+
+def dedup_hardlinks(root: Path, jobs: Optional[int] = None) -> dict:
+    """Replace identical files below ``root`` by hardlinks to one of them.
+
+    Only files of the same size are hashed, on ``jobs`` threads, and only
+    files with the same digest and mode are linked, so permissions stay as
+    they are. Files of less than ``dedup_min_bytes`` from ``config`` are
+    left alone.
+
+    :param root: The directory to deduplicate.
+    :param jobs: The number of threads hashing files (default: all cores).
+    :returns: Counts of ``files`` replaced and ``bytes`` saved.
+    """
+    by_size = {}
+    for dirpath, _, files in os.walk(str(root)):
+        for name in files:
+            path = os.path.join(dirpath, name)
+            stat = os.lstat(path)
+            if stat.st_size >= config["dedup_min_bytes"] and (
+                stat.st_mode & 0o170000 == 0o100000
+            ):
+                by_size.setdefault(stat.st_size, []).append((path, stat))
+    candidates = [
+        item for items in by_size.values() if len(items) > 1 for item in items
+    ]
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        digests = pool.map(lambda item: _file_digest(item[0]), candidates)
+        groups = OrderedDict()
+        for (path, stat), digest in zip(candidates, digests):
+            key = (stat.st_size, digest, stat.st_mode, stat.st_dev)
+            groups.setdefault(key, []).append((path, stat))
+    counts = dict(files=0, bytes=0)
+    for (size, _, _, _), items in groups.items():
+        first_path, first_stat = items[0]
+        for path, stat in items[1:]:
+            if stat.st_ino == first_stat.st_ino:
+                continue
+            tmp_path = path + ".mcinstall-link"
+            try:
+                os.link(first_path, tmp_path)
+            except OSError:
+                break
+            os.replace(tmp_path, path)
+            counts["files"] += 1
+            if stat.st_nlink == 1:
+                counts["bytes"] += size
+    return counts
+
+
+SNAPSHOT_CODECS = [
+    # (suffix, compress command, decompress command)
+    (".tar.zst", ["zstd", "-q", "-T0", "-c"], ["zstd", "-q", "-d", "-c"]),
+    (".tar.gz", ["pigz", "-c"], ["pigz", "-d", "-c"]),
+]
+
+
+def _snapshot_codec(suffix: Optional[str] = None) -> tuple:
+    """Return the best available multi-core compressor for snapshots.
+
+    :param suffix: Only consider codecs for this file suffix.
+    :returns: A tuple of suffix, compress and decompress command, with
+        ``None`` commands meaning single-core ``gzip`` in Python.
+    :raises ValueError: Is raised if no codec can handle ``suffix``.
+    """
+    for codec in SNAPSHOT_CODECS:
+        if suffix in (None, codec[0]) and shutil.which(codec[1][0]):
+            return codec
+    if suffix in (None, ".tar.gz"):
+        return ".tar.gz", None, None
+    raise ValueError("No decompressor found for %s snapshots." % suffix)
+
+
+def save_snapshot(prefix: Path, path: Path) -> Path:
+    """Save an installation as a compressed tarball in a streaming pass.
+
+    The tar stream is piped through ``zstd -T0`` or ``pigz`` when available
+    to compress on all cores, else through Python's ``gzip``. A JSON file
+    next to the snapshot records the original prefix for relocation.
+
+    :param prefix: The installation to save.
+    :param path: The snapshot path without suffix.
+    :returns: The path of the snapshot.
+    :raises ValueError: Is raised if the compressor fails.
+    """
+    suffix, compress, _ = _snapshot_codec()
+    snapshot_path = path.with_name(path.name + suffix)
+    part_path = snapshot_path.with_name(snapshot_path.name + ".part")
+    snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+    with part_path.open("wb") as out:
+        if compress:
+            proc = Popen(compress, stdin=PIPE, stdout=out)
+            with tarfile.open(fileobj=proc.stdin, mode="w|") as tar:
+                tar.add(str(prefix), arcname=".")
+            proc.stdin.close()
+            if proc.wait() != 0:
+                raise ValueError("Compressing %s failed." % snapshot_path)
+        else:
+            with tarfile.open(fileobj=out, mode="w|gz") as tar:
+                tar.add(str(prefix), arcname=".")
+    part_path.replace(snapshot_path)
+    meta_path = path.with_name(path.name + ".json")
+    meta_path.write_text(json.dumps(dict(
+        prefix=str(prefix),
+        snapshot=snapshot_path.name,
+        size=snapshot_path.stat().st_size,
+        created=time.time(),
+    ), indent=2))
+    return snapshot_path
+
+
+def find_snapshot(path: Path) -> Optional[dict]:
+    """Return the metadata of a snapshot saved with ``save_snapshot()``.
+
+    :param path: The snapshot path without suffix.
+    :returns: The metadata with the absolute snapshot ``path`` added, or
+        ``None`` if there is no such snapshot.
+    """
+    meta_path = path.with_name(path.name + ".json")
+    try:
+        meta = json.loads(meta_path.read_text())
+    except (OSError, ValueError):
+        return None
+    meta["path"] = str(path.with_name(meta["snapshot"]))
+    if not os.path.exists(meta["path"]):
+        return None
+    return meta
+
+
+def _relative_path(name: str, what: str) -> str:
+    """Return ``name`` normalized, if it stays below the directory it is in.
+
+    :param name: A relative path from an untrusted archive.
+    :param what: The archive, for the error message.
+    :returns: The normalized path.
+    :raises ValueError: Is raised for absolute paths and ``..`` components.
+    """
+    path = os.path.normpath(name)
+    if os.path.isabs(path) or path.split(os.sep)[0] == "..":
+        raise ValueError("Unsafe path in %s: %s" % (what, name))
+    return path
+
+
+def _is_below(path: str, root: str) -> bool:
+    """Return whether ``path`` resolves to ``root`` or a path below it.
+    """
+    path = os.path.realpath(path)
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def restore_snapshot(meta: dict, dest: Path) -> dict:
+    """Unpack a snapshot to ``dest`` in a streaming pass and relocate it.
+
+    While files are written, they are scanned for the original prefix, and
+    only files containing it are rewritten afterwards, see
+    ``_relocate_data()``.
+
+    Members are only written to paths resolving below ``dest``, so not
+    through symlinks pointing elsewhere, and links must point below
+    ``dest`` as well.
+
+    :param meta: The snapshot metadata as returned by ``find_snapshot()``.
+    :param dest: The destination, created if needed.
+    :returns: Counts of ``files`` unpacked and ``relocated``.
+    :raises ValueError: Is raised for unsafe members or failed relocation.
+    """
+    old, new = meta["prefix"].encode("utf8"), str(dest).encode("utf8")
+    snapshot_path = Path(meta["path"])
+    suffix = "".join(snapshot_path.suffixes[-2:])
+    _, _, decompress = _snapshot_codec(suffix)
+    chunk_size = config["download_chunk_size"]
+    dest.mkdir(parents=True, exist_ok=True)
+    root = os.path.realpath(str(dest))
+    counts = dict(files=0, relocated=0)
+    to_relocate = []
+    dir_modes = []
+
+    with snapshot_path.open("rb") as fin:
+        proc = None
+        if decompress:
+            proc = Popen(decompress, stdin=fin, stdout=PIPE)
+            stream = tarfile.open(fileobj=proc.stdout, mode="r|")
+        else:
+            stream = tarfile.open(fileobj=fin, mode="r|gz")
+        with stream as tar:
+            for member in tar:
+                name = _relative_path(member.name, "snapshot")
+                if name == ".":
+                    continue
+                target = dest / name
+                if not _is_below(str(target.parent), root):
+                    raise ValueError("Unsafe path in snapshot: %s" % name)
+                if target.is_symlink():
+                    target.unlink()  # Not to write through it.
+                if member.isdir():
+                    target.mkdir(parents=True, exist_ok=True)
+                    dir_modes.append((target, member.mode))
+                elif member.issym():
+                    link = member.linkname
+                    if link.startswith(meta["prefix"]):
+                        link = str(dest) + link[len(meta["prefix"]):]
+                    if not _is_below(str(target.parent / link), root):
+                        raise ValueError("Unsafe link in snapshot: %s -> %s"
+                                         % (name, member.linkname))
+                    os.symlink(link, str(target))
+                elif member.islnk():
+                    source = dest / _relative_path(member.linkname, "snapshot")
+                    if not _is_below(str(source), root):
+                        raise ValueError("Unsafe link in snapshot: %s -> %s"
+                                         % (name, member.linkname))
+                    os.link(str(source), str(target))
+                elif member.isfile():
+                    src = tar.extractfile(member)
+                    found = False
+                    tail = b""
+                    with target.open("wb") as fout:
+                        for chunk in iter(lambda: src.read(chunk_size), b""):
+                            fout.write(chunk)
+                            if not found:
+                                found = old in tail + chunk
+                                tail = (tail + chunk)[-len(old):]
+                    os.chmod(str(target), member.mode)
+                    os.utime(str(target), (member.mtime, member.mtime))
+                    counts["files"] += 1
+                    if found:
+                        to_relocate.append(name)
+        if proc is not None:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise ValueError("Decompressing %s failed." % snapshot_path)
+
+    binary_paths = _conda_binary_paths(dest)
+    for name in to_relocate:
+        path = dest / name
+        stat = path.stat()
+        try:
+            data = _relocate_data(
+                path.read_bytes(), old, new, name in binary_paths
+            )
+        except ValueError as err:
+            raise ValueError("Cannot relocate %s: %s" % (path, err))
+        os.chmod(str(path), stat.st_mode | 0o200)
+        path.write_bytes(data)
+        os.chmod(str(path), stat.st_mode)
+        os.utime(str(path), (stat.st_atime, stat.st_mtime))
+        counts["relocated"] += 1
+    for path, mode in reversed(dir_modes):
+        os.chmod(str(path), mode)
+    return counts
+
+
+CommandResult = namedtuple(
+    "CommandResult", "cmd returncode duration tail peak_rss"
+)
+CommandResult.__doc__ = """The result of ``run_command()``.
+
+The ``tail`` holds the last lines of the combined stdout and stderr, and
+``peak_rss`` the peak resident set size of the child in bytes, if known.
+"""
+
+
+def _read_peak_rss(pid: int) -> Optional[int]:
+    """Return the peak resident set size of a running process in bytes.
+
+    This reads ``VmHWM`` from ``/proc`` and returns ``None`` where that is
+    not available.
+    """
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _children_max_rss() -> int:
+    """Return the largest resident set size of any finished child in bytes.
+    """
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class CommandError(CalledProcessError):
+    """A command run with ``run_command()`` failed.
+
+    :param result: The ``CommandResult`` of the command.
+    """
+
+    def __init__(self, result: CommandResult):
+        super().__init__(
+            result.returncode, result.cmd, output="\n".join(result.tail)
+        )
+        self.result = result
+
+
+def run_command(
+    cmd,
+    shell: bool = False,
+    env: Optional[dict] = None,
+    timeout: Optional[float] = None,
+    on_line: Optional[Callable] = None,
+    tail_lines: int = 20,
+) -> CommandResult:
+    """Run a command, streaming its output line by line, and return a result.
+
+    Unlike ``check_output()`` this does not hold the output in memory but
+    passes each line of stdout and stderr to ``on_line(line, stream_name)``
+    as soon as it arrives, keeping only the last ``tail_lines``. The output
+    is read by one thread per stream, with ``on_line()`` called by one of
+    them at a time, so it can be called from any thread. The peak RSS of
+    the child process is sampled while it runs.
+
+    :param cmd: The command as a list of arguments or, with ``shell``, a
+        string.
+    :param shell: Run the command through the shell.
+    :param env: The environment for the command.
+    :param timeout: Kill the command after this many seconds.
+    :param on_line: A callable taking a line and ``"stdout"`` or
+        ``"stderr"``.
+    :param tail_lines: Number of last output lines to keep in the result.
+    :returns: The ``CommandResult``.
+    :raises CommandError: Is raised if the command fails.
+    :raises TimeoutExpired: Is raised if the command times out.
+    """
+    tail = deque(maxlen=tail_lines)
+    peak = dict(rss=None)
+    lock = threading.Lock()
+    children_rss = _children_max_rss()
+    started = time.monotonic()
+    proc = Popen(cmd, shell=shell, env=env, stdout=PIPE, stderr=PIPE)
+
+    def pump(stream, name):
+        with stream:
+            for line in iter(stream.readline, b""):
+                text = line.decode("utf8", "replace").rstrip("\r\n")
+                with lock:
+                    tail.append(text)
+                    if on_line:
+                        on_line(text, name)
+
+    def sample():
+        rss = _read_peak_rss(proc.pid)
+        if rss:
+            peak["rss"] = max(peak["rss"] or 0, rss)
+
+    readers = [
+        threading.Thread(target=pump, args=(proc.stdout, "stdout")),
+        threading.Thread(target=pump, args=(proc.stderr, "stderr")),
+    ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    try:
+        while True:
+            sample()
+            try:
+                proc.wait(timeout=0.2)
+                break
+            except TimeoutExpired:
+                if timeout is not None and (
+                    time.monotonic() - started > timeout
+                ):
+                    proc.kill()
+                    proc.wait()
+                    for reader in readers:
+                        # Grandchildren may still hold the pipes open.
+                        reader.join(1)
+                    with lock:
+                        output = "\n".join(tail)
+                    raise TimeoutExpired(cmd, timeout, output=output)
+    except KeyboardInterrupt:
+        proc.kill()
+        proc.wait()
+        raise
+    for reader in readers:
+        reader.join()
+    peak_rss = peak["rss"]
+    if peak_rss is None and _children_max_rss() > children_rss:
+        # Too short-lived to be sampled, but a new high-water mark.
+        peak_rss = _children_max_rss()
+    result = CommandResult(
+        cmd, proc.returncode, time.monotonic() - started, list(tail), peak_rss
+    )
+    if proc.returncode != 0:
+        raise CommandError(result)
+    return result
+
+
+class CondaBackend:
+    """The classic ``conda`` of an installation, running its own solver.
+
+    Backends build the command lines for conda operations on the base
+    environment at ``prefix``. Subclasses use faster solvers and register
+    in ``CONDA_BACKENDS`` by ``name``.
+
+    :param prefix: The path of the installation.
+    """
+
+    name = "classic"
+    # Packages to install into base along with conda to enable the backend.
+    base_packages = []
+    # Bootstraps itself instead of running the Miniconda installer.
+    standalone = False
+
+    def __init__(self, prefix: Path):
+        self.prefix = prefix
+
+    def executable(self) -> str:
+        if config["system"] == "Windows":
+            return r"%s\condabin\conda" % self.prefix
+        return "%s/bin/conda" % self.prefix
+
+    def is_ready(self) -> bool:
+        """Return if the backend can be used, i.e. its packages are there.
+        """
+        return True
+
+    def command(self, args: str) -> str:
+        """Return the command line to run conda with some arguments.
+
+        :param args: The conda arguments, like ``install -y numpy``.
+        """
+        return "%s %s" % (self.executable(), args)
+
+    def update_args(self) -> Optional[str]:
+        """Return the arguments updating conda in base, if needed at all.
+        """
+        if self.base_packages:
+            return "install -y -n base -c defaults --update-specs conda %s" % (
+                " ".join(self.base_packages))
+        return "update -y -n base -c defaults conda"
+
+
+class LibmambaBackend(CondaBackend):
+    """Conda with the libmamba solver from ``conda-libmamba-solver``.
+    """
+
+    name = "libmamba"
+    base_packages = ["conda-libmamba-solver"]
+    solving_commands = {"install", "update", "create", "remove"}
+
+    def is_ready(self) -> bool:
+        return any(
+            (self.prefix / "conda-meta").glob("conda-libmamba-solver-*.json")
+        )
+
+    def command(self, args: str) -> str:
+        words = args.split()
+        if words and words[0] in self.solving_commands:
+            words.insert(1, "--solver=libmamba")
+        return super().command(" ".join(words))
+
+
+class MambaBackend(CondaBackend):
+    """The ``mamba`` drop-in replacement for conda, installed into base.
+    """
+
+    name = "mamba"
+    base_packages = ["mamba"]
+
+    def executable(self) -> str:
+        if config["system"] == "Windows":
+            return r"%s\Scripts\mamba" % self.prefix
+        return "%s/bin/mamba" % self.prefix
+
+    def is_ready(self) -> bool:
+        exe = Path(self.executable())
+        return exe.exists() or exe.with_suffix(".exe").exists()
+
+
+class MicromambaBackend(CondaBackend):
+    """A standalone ``micromamba`` managing the installation as root prefix.
+
+    This skips the Miniconda installer: the installation is created by
+    micromamba with Python and pip, see
+    ``MinicondaInstaller.install_miniconda()``, and has no conda to update.
+    """
+
+    name = "micromamba"
+    standalone = True
+    platforms = {
+        ("Linux", "x86_64"): "linux-64",
+        ("Linux", "aarch64"): "linux-aarch64",
+        ("Linux", "ppc64le"): "linux-ppc64le",
+        ("MacOSX", "x86_64"): "osx-64",
+        ("MacOSX", "arm64"): "osx-arm64",
+        ("Windows", "x86_64"): "win-64",
+    }
+
+    @classmethod
+    def platform(cls) -> str:
+        """Return the conda platform name of this host.
+
+        :raises ValueError: Is raised for hosts without micromamba builds.
+        """
+        key = (config["system"], config["machine"])
+        if key not in cls.platforms:
+            raise ValueError("No micromamba available for %s %s." % key)
+        return cls.platforms[key]
+
+    @staticmethod
+    def binary_name() -> str:
+        """Return the path of the binary in micromamba archives and prefixes.
+        """
+        if config["system"] == "Windows":
+            return "Library/bin/micromamba.exe"
+        return "bin/micromamba"
+
+    def executable(self) -> str:
+        return str(self.prefix / self.binary_name())
+
+    def command(self, args: str) -> str:
+        words = [w for w in args.split() if w != "--update-specs"]
+        if words[:2] == ["env", "create"]:
+            words = ["create", "-y"] + words[2:]
+        words += ["-r", str(self.prefix)]
+        if words[0] in ("install", "update", "remove", "list") and not (
+            {"-n", "-p", "--name", "--prefix"} & set(words)
+        ):
+            words += ["-n", "base"]
+        return super().command(" ".join(words))
+
+    def update_args(self) -> Optional[str]:
+        return None
+
+
+CONDA_BACKENDS = OrderedDict(
+    (cls.name, cls)
+    for cls in [CondaBackend, LibmambaBackend, MambaBackend, MicromambaBackend]
+)
+
+
+# Keys of conda-meta records to put into repodata.json of bundle channels.
+REPODATA_KEYS = [
+    "build",
+    "build_number",
+    "constrains",
+    "depends",
+    "license",
+    "md5",
+    "name",
+    "noarch",
+    "sha256",
+    "size",
+    "subdir",
+    "timestamp",
+    "version",
+]
+
+
+class MinicondaInstaller:
+    """A tiny installer to bring you up to Python/Pip/Conda speed in seconds.
+
+    This is mainly meant to install a fresh Miniconda distribution. It also
+    allows to provision the installed base environment with additional packages
+    via ``pip`` or ``conda``.
+
+    N.B.:
+
+    - Dependencies specified via ``conda`` environment files will not be
+      available together with dependencies specified separately via ``pip``!
+
+    Installers in a long-running process, like ``mcinstall serve``, can
+    pass the same ``shared`` dict to share their ``InstallerCache``,
+    ``MirrorRanking`` and ``RepoIndex`` objects, including their locks and
+    in-memory state, and an ``on_log`` callable to receive each line logged.
+    """
+
+    def __init__(
+        self,
+        dest_path: str,
+        verbose: bool = False,
+        download_connections: int = 1,
+        cache_max_bytes: Optional[int] = None,
+        shared_cache: Optional[str] = None,
+        revalidate: bool = True,
+        command_timeout: Optional[float] = None,
+        mirrors: Optional[List[str]] = None,
+        pip_index_mirrors: Optional[List[str]] = None,
+        conda_channel_mirrors: Optional[List[str]] = None,
+        mirror_ttl: Optional[float] = None,
+        repo_index: Optional[str] = None,
+        conda_backend: str = "classic",
+        pip_backend: str = "pip",
+        shared: Optional[dict] = None,
+        on_log: Optional[Callable] = None,
+        skip_satisfied: bool = True,
+    ):
+        self.dest_path = dest_path
+        self.verbose = verbose
+        self.download_connections = max(1, download_connections)
+        self.revalidate = revalidate
+        self.command_timeout = command_timeout
+        self.results = []
+        self.events = []
+        self._log_files = {}
+        self._log_lock = threading.Lock()
+        self._local = threading.local()
+        self.installed_ok = False
+        self.clean_dest_path = Path(dest_path).expanduser().absolute()
+        self.download_path = (
+            Path(config["downloads_dir"]).expanduser().absolute()
+        )
+        self.on_log = on_log
+        self.skip_satisfied = skip_satisfied
+
+        def make_shared(cls, *args):
+            if shared is None:
+                return cls(*args)
+            return shared.setdefault((cls.__name__,) + tuple(
+                str(arg) for arg in args), cls(*args))
+
+        if cache_max_bytes is None:
+            cache_max_bytes = config["cache_max_bytes"]
+        self.cache = make_shared(
+            InstallerCache,
+            self.download_path / config["cache_dir_name"],
+            cache_max_bytes,
+        )
+        self.wheelhouse_path = self.download_path / config["wheelhouse_name"]
+        self.mirrors = list(mirrors or [])
+        self.pip_index_mirrors = list(pip_index_mirrors or [])
+        self.conda_channel_mirrors = list(conda_channel_mirrors or [])
+        self.conda_channel_args = {}
+        if mirror_ttl is None:
+            mirror_ttl = config["mirror_ttl"]
+        self.mirror_ranking = make_shared(
+            MirrorRanking, self.cache.path / "mirrors.json", mirror_ttl
+        )
+        self._chosen_mirrors = {}
+        self.repo_index = repo_index
+        self.repo_index_cache = make_shared(
+            RepoIndex,
+            self.cache.path / "repo-index.json",
+            config["repo_index_ttl"],
+        )
+        self.env = {}
+        self.shared_cache_path = None
+        if shared_cache:
+            self.shared_cache_path = Path(shared_cache).expanduser().absolute()
+            self.wheelhouse_path = self.shared_cache_path / "wheels"
+            self.env.update(
+                CONDA_PKGS_DIRS=str(self.shared_cache_path / "pkgs"),
+                PIP_CACHE_DIR=str(self.shared_cache_path / "pip"),
+                UV_CACHE_DIR=str(self.shared_cache_path / "uv"),
+            )
+        if conda_backend not in CONDA_BACKENDS:
+            raise ValueError("Unknown conda backend: %s" % conda_backend)
+        self.conda_backend = CONDA_BACKENDS[conda_backend](self.clean_dest_path)
+        if pip_backend not in ("pip", "uv"):
+            raise ValueError("Unknown pip backend: %s" % pip_backend)
+        self.pip_backend = pip_backend
+        self._uv_path = None
+        self.cache_stats = dict(conda=[0, 0], pip=[0, 0])
+        self.state_path = self.clean_dest_path / config["state_file_name"]
+        self.state_lock = threading.Lock()
+        self.mc_blob_name = config.get("mc_blob_name")
+        self.mc_blob_path = None
+        self.mc_blob_sha256 = None
+        self.bundle = None
+
+    def __del__(self):
+        if self.verbose and self.installed_ok:
+            if config["system"] == "Windows":
+                cmd = r"%s\condabin\activate" % self.clean_dest_path
+            else:
+                cmd = "source %s/bin/activate" % self.clean_dest_path
+            print('Run this to start using your fresh Miniconda: "%s".' % cmd)
+        self.close()
+
+    def close(self):
+        """Close the logfile and the events file.
+        """
+        with self._log_lock:
+            for f in self._log_files.values():
+                f.close()
+            self._log_files.clear()
+
+    def _write_line(self, key: str, line: str):
+        """Append a line to the file at ``config[key]``, kept open for reuse.
+        """
+        with self._log_lock:
+            path = Path(config[key]).expanduser().absolute()
+            f = self._log_files.get(key)
+            if f is None or f.name != str(path):
+                if f is not None:
+                    f.close()
+                f = self._log_files[key] = path.open("a", buffering=1)
+            f.write("%s\n" % line)
+
+    def log(self, command: str):
+        """Logger method to log results to ``log_path`` from ``config``.
+
+        :param command: The shell command to add to the logfile.
+        """
+        self._write_line("log_path", command)
+        if self.on_log:
+            self.on_log(command)
+
+    def _account(self, nbytes: int = 0, peak_rss: Optional[int] = None):
+        """Add downloaded bytes and a peak RSS to the current measurement.
+
+        Measurements are per thread, see ``measure()``.
+        """
+        record = getattr(self._local, "record", None)
+        if record is None:
+            return
+        record["bytes"] += nbytes
+        if peak_rss:
+            record["peak_rss"] = max(record["peak_rss"] or 0, peak_rss)
+
+    def measure(self, kind: str, name: str, func: Callable, *args, **kwargs):
+        """Call a function and emit a timing event for it.
+
+        The event is a JSON object appended as one line to ``events_path``
+        from ``config`` and to ``events``, with the ``kind`` (like
+        ``"step"`` or ``"pip"``), ``name``, ``prefix``, wall-clock ``start``
+        and ``end`` timestamps, ``duration`` in seconds, ``bytes``
+        downloaded, ``throughput`` in bytes per second, exit ``status`` and
+        the ``peak_rss`` of child processes in bytes. Measurements can be
+        nested, the inner ones count towards the outer ones.
+
+        :param kind: The kind of the event.
+        :param name: The name of the step or package(s).
+        :param func: The callable, called with the remaining arguments.
+        :returns: The return value of ``func``.
+        """
+        outer = getattr(self._local, "record", None)
+        record = self._local.record = dict(bytes=0, peak_rss=None)
+        start = time.time()
+        started = time.monotonic()
+        event = dict(kind=kind, name=name, prefix=str(self.clean_dest_path))
+        status = 0
+        try:
+            return func(*args, **kwargs)
+        except CalledProcessError as err:
+            status = err.returncode
+            event["error"] = "%s: %s" % (type(err).__name__, err)
+            raise
+        except BaseException as err:
+            status = 1
+            event["error"] = "%s: %s" % (type(err).__name__, err)
+            raise
+        finally:
+            duration = time.monotonic() - started
+            self._local.record = outer
+            self._account(record["bytes"], record["peak_rss"])
+            event.update(
+                start=start,
+                end=start + duration,
+                duration=duration,
+                bytes=record["bytes"],
+                throughput=record["bytes"] / duration if duration else None,
+                status=status,
+                peak_rss=record["peak_rss"],
+            )
+            self.events.append(event)
+            self._write_line("events_path", json.dumps(event, sort_keys=True))
+
+    def _report_progress(
+        self, position: int, total: Optional[int], done: int, started: float
+    ):
+        """Report download progress to the console and the logfile.
+
+        :param position: Number of bytes available locally.
+        :param total: Expected total size in bytes, if known.
+        :param done: Number of bytes transferred in this session.
+        :param started: Start time of this session as returned by
+            ``time.monotonic()``.
+        """
+        elapsed = max(time.monotonic() - started, 1e-6)
+        rate = done / elapsed / 2 ** 20
+        if total:
+            msg = "Downloaded %.1f of %.1f MiB (%.1f MiB/s)" % (
+                position / 2 ** 20,
+                total / 2 ** 20,
+                rate,
+            )
+        else:
+            msg = "Downloaded %.1f MiB (%.1f MiB/s)" % (position / 2 ** 20, rate)
+        if self.verbose:
+            print(msg)
+        self.log("# %s" % msg)
+
+    def rank_mirrors(self, base_urls: List[str], probe_path: str) -> List[str]:
+        """Return mirror base URLs ranked by probing a file on each, see
+        ``MirrorRanking``.
+
+        :param base_urls: The base URLs of the mirrors, ending with ``/``.
+        :param probe_path: The path of the file to probe, relative to the
+            base URLs.
+        :returns: The base URLs, fastest first.
+        """
+        if len(base_urls) < 2:
+            return list(base_urls)
+        ranking = self.mirror_ranking.rank([u + probe_path for u in base_urls])
+        msg = "Mirrors ranked: %s" % ", ".join(
+            "%s (%.0f ms, %.1f MiB/s)" % (
+                r["url"], 1000 * r["latency"], r["throughput"] / 2 ** 20)
+            if r["ok"] else "%s (failed)" % r["url"]
+            for r in ranking
+        )
+        if self.verbose:
+            print(msg)
+        self.log("# %s" % msg)
+        return [r["url"][:len(r["url"]) - len(probe_path)] for r in ranking]
+
+    def _choose_mirror(self, url: str, mirrors: List[str], probe_path: str) -> str:
+        """Return the fastest of a URL and its mirrors, probing only once.
+        """
+        if not mirrors:
+            return url
+        key = (url, probe_path)
+        if key not in self._chosen_mirrors:
+            base_urls = [u.rstrip("/") + "/" for u in [url] + mirrors]
+            best = self.rank_mirrors(base_urls, probe_path)[0]
+            self._chosen_mirrors[key] = (
+                url if best == base_urls[0] else best.rstrip("/")
+            )
+        return self._chosen_mirrors[key]
+
+    def _pip_index(self, index_url: Optional[str]) -> Optional[str]:
+        """Return the fastest of a pip index and ``pip_index_mirrors``.
+
+        :param index_url: The pip index URL, ``None`` meaning PyPI.
+        """
+        if not self.pip_index_mirrors:
+            return index_url
+        url = index_url or config["pypi_index_url"]
+        best = self._choose_mirror(url, self.pip_index_mirrors, "pip/")
+        return None if best == url and not index_url else best
+
+    def _conda_channel(self, channel: str) -> str:
+        """Return the fastest of a conda channel and ``conda_channel_mirrors``.
+
+        :param channel: The channel name or URL.
+        """
+        if not self.conda_channel_mirrors:
+            return channel
+        url = channel
+        if "://" not in channel:
+            url = config["conda_channel_url"] + channel
+        best = self._choose_mirror(
+            url, self.conda_channel_mirrors, "noarch/repodata.json"
+        )
+        return channel if best == url else best
+
+    def _conda_channel_args(self, channel: Optional[str]) -> List[str]:
+        """Return the ``-c`` arguments for a channel, if any.
+
+        They are chosen once per channel, see ``_conda_channel()``, so
+        prefetching and installing offline see the same channels.
+
+        :param channel: The channel name or URL.
+        """
+        if not channel:
+            return []
+        if channel not in self.conda_channel_args:
+            self.conda_channel_args[channel] = [
+                "-c", self._conda_channel(channel)]
+        return self.conda_channel_args[channel]
+
+    def download_file(
+        self,
+        url: str,
+        path: Path,
+        meta: Optional[dict] = None,
+        mirrors: Sequence[str] = (),
+        checksum: Optional[str] = None,
+    ) -> str:
+        """Stream a remote file to ``path`` in chunks and return its SHA-256.
+
+        The data is written to a temporary ``<name>.part`` file next to
+        ``path`` and renamed when complete. The ``ETag`` (or else the
+        ``Last-Modified`` date) of the response is recorded next to it in
+        ``<name>.part.json``. An existing ``.part`` file left over by an
+        interrupted transfer is resumed with an HTTP ``Range`` request with
+        that validator in ``If-Range``, so the server sends the whole file
+        again if it changed in the meantime, and a transfer failing midway
+        is retried in the same way up to ``download_retries`` times. A
+        ``.part`` file without a recorded validator is not resumed.
+
+        With ``download_connections`` greater than one, fresh downloads from
+        servers advertising ``Accept-Ranges: bytes`` are split into byte
+        ranges fetched concurrently, see ``_download_segmented()``.
+
+        With mirrors, a transfer failing or stalling for ``stall_timeout``
+        seconds from ``config`` is resumed from the next mirror. As the
+        validator belongs to the URL it was recorded for, another mirror
+        is only resumed from if it reports the same size and either the
+        same ``Last-Modified`` date or the expected ``checksum`` is known,
+        in which case a mismatch starts the download over without resuming.
+
+        :param url: The URL to download.
+        :param path: The final destination path.
+        :param meta: An optional dict to fill with the ``etag``,
+            ``last_modified`` and ``size`` of the remote file.
+        :param mirrors: URLs of the same file on other mirrors.
+        :param checksum: The expected hex SHA-256 digest, if known.
+        :returns: The hex SHA-256 digest of the downloaded file.
+        :raises ValueError: Is raised if the download fails.
+        """
+        if meta is None:
+            meta = {}
+        urls = [url] + list(mirrors)
+        timeout = config["download_timeout"]
+        retries = config["download_retries"]
+        if mirrors:
+            timeout = min(timeout, config["stall_timeout"])
+            retries += len(mirrors)
+        part_path = path.with_name(path.name + ".part")
+        validator_path = path.with_name(path.name + ".part.json")
+        chunk_size = config["download_chunk_size"]
+
+        def drop_part():
+            for leftover in (part_path, validator_path):
+                if leftover.exists():
+                    leftover.unlink()
+
+        if self.verbose:
+            print("Downloading %s ..." % url)
+        self.log("wget %s" % url)
+
+        if self.download_connections > 1 and not part_path.exists():
+            size = self._probe_ranges(url, meta)
+            if size:
+                try:
+                    digest = self._download_segmented(
+                        urls, part_path, size, timeout
+                    )
+                except ValueError as err:
+                    self.log("# segmented download failed: %s" % err)
+                    if self.verbose:
+                        print("Segmented download failed (%s), "
+                              "using a single stream ..." % err)
+                    part_path.unlink()
+                else:
+                    self._account(size)
+                    part_path.replace(path)
+                    self.log("mv %s %s" % (part_path.name, path))
+                    self.log("# sha256 %s %s" % (digest, path.name))
+                    return digest
+
+        attempt = 0
+        known_total = None
+        while True:
+            url = urls[attempt % len(urls)]
+            sha256 = hashlib.sha256()
+            offset = part_path.stat().st_size if part_path.exists() else 0
+            record = {}
+            cross_resume = False
+            if offset:
+                try:
+                    record = json.loads(validator_path.read_text())
+                except (OSError, ValueError):
+                    pass
+                if record.get("url") == url and record.get("validator"):
+                    pass  # Resumed with If-Range.
+                elif record.get("size") and (
+                    checksum or record.get("last_modified")
+                ):
+                    # The validator is of another mirror, compare the
+                    # size and date or the checksum instead.
+                    cross_resume = True
+                else:
+                    # Maybe of another version of the file, start over.
+                    drop_part()
+                    offset = 0
+            if offset:
+                with part_path.open("rb") as f:
+                    for chunk in iter(lambda: f.read(chunk_size), b""):
+                        sha256.update(chunk)
+            headers = {"User-Agent": config["user_agent"]}
+            if offset:
+                headers["Range"] = "bytes=%d-" % offset
+                if not cross_resume:
+                    headers["If-Range"] = record["validator"]
+            req = request.Request(url, headers=headers)
+            done = 0
+            try:
+                resp = request.urlopen(req, timeout=timeout)
+                if resp.status >= 400:
+                    msg = "Cannot download %s. Verify URL components!" % url
+                    raise ValueError(msg)
+                if offset and resp.status != 206:
+                    # The server ignored the range or the file changed,
+                    # start from scratch.
+                    offset = 0
+                    cross_resume = False
+                    sha256 = hashlib.sha256()
+                length = resp.headers.get("Content-Length")
+                total = int(length) + offset if length else None
+                validators = _validators(resp.headers)
+                if cross_resume and (total != record["size"] or (
+                    not checksum
+                    and validators["last_modified"] != record["last_modified"]
+                )):
+                    # A mirror with a different file, start from scratch.
+                    resp.close()
+                    drop_part()
+                    continue
+                if not offset:
+                    etag = validators["etag"]
+                    if etag and etag.startswith("W/"):
+                        etag = None  # Weak ones are not allowed in If-Range.
+                    validator_path.write_text(json.dumps(dict(
+                        url=url,
+                        validator=etag or validators["last_modified"],
+                        last_modified=validators["last_modified"],
+                        size=total,
+                    )))
+                if offset and self.verbose:
+                    print("Resuming at byte %d ..." % offset)
+                if offset and known_total and total != known_total:
+                    # A mirror with a different file, start from scratch.
+                    resp.close()
+                    drop_part()
+                    continue
+                known_total = known_total or total
+                meta.update(_validators(resp.headers), size=total)
+                started = last_report = time.monotonic()
+                # read1() returns what has arrived, so a stalled transfer
+                # keeps all bytes received before the stall.
+                read = getattr(resp, "read1", resp.read)
+                with part_path.open("ab" if offset else "wb") as f:
+                    for chunk in iter(lambda: read(chunk_size), b""):
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        done += len(chunk)
+                        self._account(len(chunk))
+                        now = time.monotonic()
+                        if now - last_report >= config["progress_interval"]:
+                            self._report_progress(
+                                offset + done, total, done, started
+                            )
+                            last_report = now
+                resp.close()
+                if total is not None and offset + done != total:
+                    raise HTTPException(
+                        "Incomplete read: %d of %d bytes"
+                        % (offset + done, total)
+                    )
+            except HTTPError as err:
+                if err.code == 416 and offset:
+                    # The leftover part file cannot be resumed, start over.
+                    drop_part()
+                    continue
+                if attempt >= len(urls) - 1:
+                    msg = "Cannot download %s. Verify URL components!" % url
+                    raise ValueError(msg)
+                attempt += 1
+                self.log("# download failed: %s" % err)
+                continue
+            except (HTTPException, URLError, socket.timeout, ConnectionError) as err:
+                attempt += 1
+                self.log("# download interrupted: %s" % err)
+                if attempt > retries:
+                    msg = "Cannot download %s: %s" % (url, err)
+                    raise ValueError(msg)
+                if self.verbose:
+                    print("Download interrupted (%s), retrying ..." % err)
+                continue
+            if cross_resume and checksum and sha256.hexdigest() != checksum:
+                # Resumed with data of another file, start over.
+                self.log("# checksum mismatch after resuming from %s" % url)
+                drop_part()
+                continue
+            break
+
+        self._report_progress(offset + done, total, done, started)
+        if self.verbose:
+            print("Copying to %s ..." % path)
+        part_path.replace(path)
+        if validator_path.exists():
+            validator_path.unlink()
+        digest = sha256.hexdigest()
+        self.log("mv %s %s" % (part_path.name, path))
+        self.log("# sha256 %s %s" % (digest, path.name))
+        return digest
+
+    def _probe_ranges(
+        self, url: str, meta: Optional[dict] = None
+    ) -> Optional[int]:
+        """Return the size of a remote file if it can be fetched in ranges.
+
+        :param url: The URL to probe with a ``HEAD`` request.
+        :param meta: An optional dict to fill with the ``etag``,
+            ``last_modified`` and ``size`` of the remote file.
+        :returns: The ``Content-Length`` in bytes if the server advertises
+            ``Accept-Ranges: bytes``, else ``None``.
+        """
+        headers = {"User-Agent": config["user_agent"]}
+        req = request.Request(url, headers=headers, method="HEAD")
+        try:
+            with request.urlopen(req, timeout=config["download_timeout"]) as resp:
+                accept_ranges = resp.headers.get("Accept-Ranges", "")
+                length = resp.headers.get("Content-Length")
+                if meta is not None:
+                    meta.update(
+                        _validators(resp.headers),
+                        size=int(length) if length else None,
+                    )
+        except (HTTPException, URLError, socket.timeout, ConnectionError):
+            return None
+        if accept_ranges.strip().lower() != "bytes" or not length:
+            if self.verbose:
+                print("Server does not support ranges, using a single stream.")
+            return None
+        return int(length)
+
+    def _download_segmented(
+        self,
+        urls: Sequence[str],
+        part_path: Path,
+        size: int,
+        timeout: Optional[float] = None,
+    ) -> str:
+        """Fetch ``size`` bytes from ``urls`` into ``part_path`` in parallel.
+
+        The file is preallocated and split into one byte range per
+        connection, each fetched on a thread pool and written at its offset.
+        Failing ranges are resumed where they stopped, from the next of the
+        ``urls`` (mirrors of the same file), up to ``download_retries`` times
+        per URL.
+
+        :param urls: The URL to download and those of its mirrors.
+        :param part_path: The temporary file to assemble the data in.
+        :param size: The total size of the remote file in bytes.
+        :param timeout: The socket timeout in seconds.
+        :returns: The hex SHA-256 digest of the assembled file.
+        :raises ValueError: Is raised if a range cannot be fetched.
+        """
+        if timeout is None:
+            timeout = config["download_timeout"]
+        retries = config["download_retries"] + len(urls) - 1
+        chunk_size = config["download_chunk_size"]
+        connections = min(self.download_connections, max(1, size // chunk_size))
+        step = -(-size // connections)
+        ranges = [
+            (start, min(start + step, size) - 1)
+            for start in range(0, size, step)
+        ]
+        if self.verbose:
+            print("Downloading in %d ranges ..." % len(ranges))
+        self.log("# downloading %d bytes in %d ranges" % (size, len(ranges)))
+        with part_path.open("wb") as f:
+            f.truncate(size)
+
+        lock = threading.Lock()
+        progress = dict(done=0, last_report=time.monotonic())
+        started = time.monotonic()
+
+        def fetch(byte_range):
+            start, end = byte_range
+            attempt = 0
+            with part_path.open("r+b") as f:
+                while start <= end:
+                    headers = {
+                        "User-Agent": config["user_agent"],
+                        "Range": "bytes=%d-%d" % (start, end),
+                    }
+                    url = urls[attempt % len(urls)]
+                    req = request.Request(url, headers=headers)
+                    try:
+                        resp = request.urlopen(req, timeout=timeout)
+                        if resp.status != 206:
+                            resp.close()
+                            raise ValueError("Server ignored range request")
+                        f.seek(start)
+                        for chunk in iter(lambda: resp.read(chunk_size), b""):
+                            chunk = chunk[:end + 1 - start]
+                            f.write(chunk)
+                            start += len(chunk)
+                            with lock:
+                                progress["done"] += len(chunk)
+                                now = time.monotonic()
+                                interval = now - progress["last_report"]
+                                if interval >= config["progress_interval"]:
+                                    progress["last_report"] = now
+                                    self._report_progress(
+                                        progress["done"],
+                                        size,
+                                        progress["done"],
+                                        started,
+                                    )
+                        resp.close()
+                        if start <= end:
+                            raise HTTPException(
+                                "Incomplete range, %d bytes missing"
+                                % (end + 1 - start)
+                            )
+                    except HTTPError as err:
+                        raise ValueError("Cannot fetch range: %s" % err)
+                    except (
+                        HTTPException, URLError, socket.timeout, ConnectionError
+                    ) as err:
+                        attempt += 1
+                        self.log("# range download interrupted: %s" % err)
+                        if attempt > retries:
+                            raise ValueError("Cannot fetch range: %s" % err)
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            list(pool.map(fetch, ranges))
+        self._report_progress(size, size, size, started)
+
+        sha256 = hashlib.sha256()
+        with part_path.open("rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def download(self):
+        """Download Miniconda locally at desired destination.
+        """
+        if not self.clean_dest_path.exists():
+            if self.verbose:
+                print("Making directory %s." % self.clean_dest_path)
+            self.clean_dest_path.mkdir(parents=True)
+
+        if not self.download_path.exists():
+            if self.verbose:
+                print("Making directory %s." % self.download_path)
+            self.download_path.mkdir()
+
+    def _is_modified(self, url: str, entry: dict) -> bool:
+        """Revalidate a cached blob with a conditional GET request.
+
+        :param url: The URL the blob was downloaded from.
+        :param entry: The cache index entry of the blob.
+        :returns: ``False`` if the server answers ``304 Not Modified``,
+            cannot be reached or fails with another error than ``404`` or
+            ``410``, else ``True``.
+        :raises ValueError: Is raised if the blob is gone from the server.
+        """
+        headers = {"User-Agent": config["user_agent"]}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        if len(headers) == 1:
+            return True
+        req = request.Request(url, headers=headers)
+        try:
+            resp = request.urlopen(req, timeout=config["download_timeout"])
+        except HTTPError as err:
+            if err.code == 304:
+                return False
+            if err.code in (404, 410):
+                raise ValueError("Cannot revalidate %s: %s" % (url, err))
+            # Maybe transient, like 503, and the cached blob is still valid.
+            print("Warning: cannot revalidate %s (%s), using cache." % (
+                url, err))
+            self.log("# revalidation failed: %s" % err)
+            return False
+        except (HTTPException, URLError, socket.timeout, ConnectionError) as err:
+            if self.verbose:
+                print("Cannot revalidate %s (%s), using cache." % (url, err))
+            self.log("# revalidation failed: %s" % err)
+            return False
+        resp.close()
+        return resp.status != 304
+
+    def fetch_installer(self) -> Path:
+        """Return the path of the Miniconda installer, downloading if needed.
+
+        Installers are kept in an ``InstallerCache`` below ``download_path``.
+        Pinned versions are used from the cache as they are, while ``latest``
+        installers are revalidated with a conditional request first (unless
+        ``revalidate`` is false).
+
+        With ``mirrors`` (base URLs like ``mc_base_url`` from ``config``),
+        the installer is downloaded from the fastest one, see
+        ``rank_mirrors()``, failing over to the others.
+
+        If the repository listing is available, see ``load_repo_index()``,
+        ``latest`` is resolved to the pinned version it stands for (which
+        then needs no revalidation), and downloads are verified against the
+        published checksum.
+
+        Fetching holds a lock on the blob, see ``InstallerCache.blob_lock()``,
+        so concurrent jobs, e.g. of the daemon, download it only once.
+
+        :returns: The path of the cached installer blob.
+        :raises ValueError: Is raised if the download fails or does not
+            match the published checksum.
+        """
+        name, expected = resolve_installer(
+            self.load_repo_index(), config["mc_blob_name"]
+        )
+        if name != config["mc_blob_name"]:
+            msg = "Resolved %s to %s" % (config["mc_blob_name"], name)
+            if self.verbose:
+                print(msg)
+            self.log("# %s" % msg)
+        self.mc_blob_name = name
+        url = config["mc_base_url"] + name
+        # Daemon jobs share the cache, and the .part file of the blob.
+        with self.cache.blob_lock(name):
+            entry = self.cache.get(name)
+            if expected and entry and expected.get("sha256") not in (
+                None, entry["sha256"]
+            ):
+                entry = None
+            if entry and entry.get("url") == url:
+                if (
+                    "latest" not in name
+                    or not self.revalidate
+                    or not self._is_modified(entry.get("source", url), entry)
+                ):
+                    if self.verbose:
+                        print("Using cached %s." % name)
+                    self.log("# cache hit %s %s" % (entry["sha256"], name))
+                    self.cache.touch(name)
+                    self.mc_blob_sha256 = entry["sha256"]
+                    self.mc_blob_path = self.cache.blob_path(
+                        name, entry["sha256"])
+                    return self.mc_blob_path
+
+            self.cache.path.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.cache.path / name
+            meta = {}
+            base_urls = self.rank_mirrors(
+                [config["mc_base_url"]]
+                + [u.rstrip("/") + "/" for u in self.mirrors],
+                name,
+            )
+            source = base_urls[0] + name
+            sha256 = self.download_file(
+                source,
+                tmp_path,
+                meta,
+                [u + name for u in base_urls[1:]],
+                (expected or {}).get("sha256"),
+            )
+            if expected:
+                if "sha256" in expected:
+                    digest, published = sha256, expected["sha256"]
+                else:
+                    digest = _file_digest(str(tmp_path), "md5")
+                    published = expected["md5"]
+                if digest != published:
+                    tmp_path.unlink()
+                    raise ValueError(
+                        "Checksum mismatch for %s: expected %s, got %s"
+                        % (name, published, digest)
+                    )
+                self.log(
+                    "# verified %s against the published checksum" % name)
+            entry = dict(
+                url=url,
+                source=source,
+                sha256=sha256,
+                etag=meta.get("etag"),
+                last_modified=meta.get("last_modified"),
+            )
+            self.mc_blob_sha256 = sha256
+            self.mc_blob_path = self.cache.add(name, tmp_path, entry)
+            self.log("mv %s %s" % (tmp_path, self.mc_blob_path))
+            return self.mc_blob_path
+
+    def _read_listing(self, source: str) -> str:
+        """Return the repository listing at a URL or path as text.
+        """
+        if "://" not in source:
+            return Path(source).expanduser().read_text()
+        req = request.Request(source, headers={"User-Agent": config["user_agent"]})
+        with request.urlopen(req, timeout=config["download_timeout"]) as resp:
+            return resp.read().decode("utf8", "replace")
+
+    def load_repo_index(self) -> dict:
+        """Return the index of the Miniconda repository listing.
+
+        The listing is read from ``repo_index``, a local copy or URL, if
+        given, else from ``mc_index_url`` from ``config``, and cached for
+        ``repo_index_ttl`` seconds, see ``RepoIndex``.
+
+        :returns: The index as returned by ``parse_repo_index()``, empty if
+            not available.
+        """
+        source = self.repo_index or config["mc_index_url"]
+        if not source:
+            return {}
+        return self.repo_index_cache.get(source, self._read_listing)
+
+    def fetch_micromamba(self) -> Path:
+        """Return the path of the micromamba archive, downloading if needed.
+
+        The archive for this platform is kept in the ``InstallerCache``
+        like the Miniconda installer and revalidated like ``latest``
+        installers.
+
+        :returns: The path of the cached archive.
+        :raises ValueError: Is raised if the download fails.
+        """
+        platform_name = MicromambaBackend.platform()
+        name = "micromamba-latest-%s.tar.bz2" % platform_name
+        url = config["micromamba_url"] % platform_name
+        with self.cache.blob_lock(name):
+            entry = self.cache.get(name)
+            if entry and entry.get("url") == url:
+                if not self.revalidate or not self._is_modified(url, entry):
+                    self.log("# cache hit %s %s" % (entry["sha256"], name))
+                    self.cache.touch(name)
+                    self.mc_blob_sha256 = entry["sha256"]
+                    self.mc_blob_path = self.cache.blob_path(
+                        name, entry["sha256"])
+                    return self.mc_blob_path
+            self.cache.path.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.cache.path / name
+            meta = {}
+            sha256 = self.download_file(url, tmp_path, meta)
+            self.mc_blob_sha256 = sha256
+            self.mc_blob_path = self.cache.add(name, tmp_path, dict(
+                url=url,
+                sha256=sha256,
+                etag=meta.get("etag"),
+                last_modified=meta.get("last_modified"),
+            ))
+            self.log("mv %s %s" % (tmp_path, self.mc_blob_path))
+            return self.mc_blob_path
+
+    def fetch_base(self) -> Path:
+        """Fetch what installs the base environment for the conda backend.
+
+        This is the micromamba archive for standalone backends, see
+        ``fetch_micromamba()``, else the Miniconda installer, see
+        ``fetch_installer()``.
+        """
+        if self.conda_backend.standalone:
+            return self.fetch_micromamba()
+        return self.fetch_installer()
+
+    def is_installed(self) -> bool:
+        """Return if Miniconda is installed at the destination already.
+        """
+        dest_path = self.clean_dest_path
+        if self.conda_backend.standalone:
+            return Path(self.conda_backend.executable()).exists()
+        return (
+            (dest_path / "bin" / "conda").exists()
+            or (dest_path / "condabin" / "conda.bat").exists()
+        )
+
+    def load_state(self) -> dict:
+        """Return the state of the installation as recorded in its state file.
+
+        The state maps names of completed steps to fingerprints of their
+        inputs, see ``run_recorded()``.
+        """
+        try:
+            return json.loads(self.state_path.read_text())["steps"]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def is_step_current(self, name: str, fingerprint: str) -> bool:
+        """Return if a step was completed before with the same inputs.
+
+        :param name: The step name.
+        :param fingerprint: The fingerprint of the step inputs.
+        """
+        return self.load_state().get(name) == fingerprint
+
+    def run_recorded(self, name: str, fingerprint: str, func: Callable):
+        """Run a step and record it in the state file when it succeeds.
+
+        :param name: The step name.
+        :param fingerprint: The fingerprint of the step inputs.
+        :param func: The step callable.
+        """
+        func()
+        with self.state_lock:
+            steps = self.load_state()
+            steps[name] = fingerprint
+            # Replaced rather than written to, in case it is linked.
+            tmp_path = self.state_path.with_name(
+                "%s.%d.tmp" % (self.state_path.name, os.getpid()))
+            tmp_path.write_text(json.dumps(
+                dict(steps=steps, updated=time.time()), indent=2,
+                sort_keys=True))
+            tmp_path.replace(self.state_path)
+
+    def install_miniconda(self):
+        """Install Miniconda locally at desired destination.
+
+        :raises ValueError: Is raised if the download fails.
+        """
+        dest_path = self.clean_dest_path
+        if self.conda_backend.standalone:
+            if not self.is_installed():
+                self.bootstrap_micromamba()
+        elif not self.is_installed():
+            mc_blob_path = self.mc_blob_path or self.fetch_installer()
+            if config["system"] == "Windows":
+                cmd = (
+                    'start /wait "" %s /InstallationType=JustMe /RegisterPython=0 /S /D=%s'
+                    % (mc_blob_path, dest_path)
+                )
+                # One per installation, as fleet workers share the CWD.
+                bat_path = dest_path.with_name(dest_path.name + "-install.bat")
+                bat_path.write_text(cmd)
+                try:
+                    self.run('"%s"' % bat_path, shell=True)
+                except CommandError:
+                    raise ValueError("Installation failed...")
+                finally:
+                    bat_path.unlink()
+            else:
+                cmd = "bash %s -b -f -p %s" % (mc_blob_path, dest_path)
+                self.run(cmd)
+        if config["system"] == "Windows":
+            cmd = r"%s\condabin\activate" % dest_path
+        else:
+            cmd = "source %s/bin/activate" % dest_path
+        self.log(cmd)
+
+        self.installed_ok = True
+
+    def bootstrap_micromamba(self):
+        """Create the installation with micromamba instead of Miniconda.
+
+        The micromamba binary is unpacked next to its cached archive,
+        creates the installation with Python and pip from the
+        ``micromamba_channel`` from ``config`` (or with the conda packages
+        of an unpacked ``bundle``) as its root prefix, and is then copied
+        into it to manage it later.
+        """
+        archive_path = self.mc_blob_path or self.fetch_micromamba()
+        name = MicromambaBackend.binary_name()
+        binary_path = archive_path.with_name(archive_path.name + "-" + Path(
+            name).name)
+        if not binary_path.exists():
+            with tarfile.open(str(archive_path), "r:bz2") as tar:
+                member = tar.extractfile(name)
+                if member is None:
+                    raise ValueError("No %s in %s." % (name, archive_path))
+                tmp_path = binary_path.with_name(binary_path.name + ".tmp")
+                with tmp_path.open("wb") as f:
+                    shutil.copyfileobj(member, f)
+            tmp_path.chmod(0o755)
+            tmp_path.replace(binary_path)
+        dest_path = self.clean_dest_path
+        if self.bundle:
+            specs = "--offline --file %s" % (
+                Path(self.bundle["root"]) / "conda-explicit.txt")
+        else:
+            specs = "-c %s python pip" % config["micromamba_channel"]
+        self.run("%s create -y -p %s -r %s %s" % (
+            binary_path, dest_path, dest_path, specs))
+        target = Path(self.conda_backend.executable())
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(str(binary_path), str(target))
+        self.log("cp %s %s" % (binary_path, target))
+
+    def clone_from(self, golden_path: Path):
+        """Install by cloning an existing installation instead of installing.
+
+        :param golden_path: The installation to clone, see ``clone_prefix()``.
+        """
+        dest_path = self.clean_dest_path
+        if dest_path.exists() and any(dest_path.iterdir()):
+            raise ValueError("Cannot clone into non-empty %s." % dest_path)
+        if self.verbose:
+            print("Cloning %s to %s ..." % (golden_path, dest_path))
+        counts = clone_prefix(golden_path, dest_path, verbose=self.verbose)
+        self.log("# cloned %s to %s: %s" % (golden_path, dest_path, json.dumps(
+            counts, sort_keys=True)))
+        if config["system"] == "Windows":
+            cmd = r"%s\condabin\activate" % dest_path
+        else:
+            cmd = "source %s/bin/activate" % dest_path
+        self.log(cmd)
+        self.installed_ok = True
+
+    def restore_from(self, meta: dict):
+        """Install by unpacking a snapshot instead of installing.
+
+        :param meta: The snapshot metadata as returned by ``find_snapshot()``.
+        """
+        dest_path = self.clean_dest_path
+        if dest_path.exists() and any(dest_path.iterdir()):
+            raise ValueError("Cannot restore into non-empty %s." % dest_path)
+        if self.verbose:
+            print("Restoring snapshot %s to %s ..." % (meta["path"], dest_path))
+        started = time.monotonic()
+        counts = restore_snapshot(meta, dest_path)
+        self.log("# restored %s to %s in %.1f s: %s" % (
+            meta["path"], dest_path, time.monotonic() - started,
+            json.dumps(counts, sort_keys=True)))
+        if config["system"] == "Windows":
+            cmd = r"%s\condabin\activate" % dest_path
+        else:
+            cmd = "source %s/bin/activate" % dest_path
+        self.log(cmd)
+        self.installed_ok = True
+
+    def save_snapshot(self, path: Path):
+        """Save the installation as a snapshot, see ``save_snapshot()``.
+
+        :param path: The snapshot path without suffix.
+        """
+        if self.verbose:
+            print("Saving snapshot of %s ..." % self.clean_dest_path)
+        started = time.monotonic()
+        snapshot_path = save_snapshot(self.clean_dest_path, path)
+        msg = "Saved snapshot %s (%.1f MiB) in %.1f s" % (
+            snapshot_path,
+            snapshot_path.stat().st_size / 2 ** 20,
+            time.monotonic() - started,
+        )
+        if self.verbose:
+            print(msg)
+        self.log("# %s" % msg)
+
+    def run(
+        self, cmd: str, shell: bool = False, on_line: Optional[Callable] = None
+    ) -> CommandResult:
+        """Run a command with ``run_command()``, streaming its output.
+
+        Output lines go to the console and, as comments, to the logfile. The
+        command is killed after ``command_timeout`` seconds, if set, and its
+        result is appended to ``results``.
+
+        :param cmd: The command, split on whitespace unless run in a shell.
+        :param shell: Run the command through the shell.
+        :param on_line: An additional callable taking each output line.
+        :returns: The ``CommandResult``.
+        :raises CommandError: Is raised if the command fails.
+        :raises TimeoutExpired: Is raised if the command times out.
+        """
+        if self.verbose:
+            print("Running command: %s" % cmd)
+        self.log(cmd)
+
+        def handle_line(line, stream):
+            print(line)
+            self.log("# | %s" % line)
+            if on_line:
+                on_line(line)
+
+        try:
+            result = run_command(
+                cmd if shell else cmd.split(),
+                shell=shell,
+                env=self._child_env(),
+                timeout=self.command_timeout,
+                on_line=handle_line,
+            )
+        except CommandError as err:
+            self.results.append(err.result)
+            self._account(peak_rss=err.result.peak_rss)
+            self.log("# exit status %d after %.1f s" % (
+                err.result.returncode, err.result.duration))
+            raise
+        except TimeoutExpired:
+            self.log("# killed after %s s" % self.command_timeout)
+            raise
+        self.results.append(result)
+        self._account(peak_rss=result.peak_rss)
+        if self.verbose:
+            print("Finished in %.1f s." % result.duration)
+        return result
+
+    def _child_env(self) -> Optional[dict]:
+        """Return the environment for child processes, if it differs.
+        """
+        if not self.env:
+            return None
+        return dict(os.environ, **self.env)
+
+    def configure_shared_cache(self):
+        """Make the installation use the shared cache permanently.
+
+        This writes ``pkgs_dirs`` into the ``.condarc`` and ``cache-dir``
+        into the ``pip.conf`` (``pip.ini`` on Windows) of the installation,
+        so conda and pip share the cache also when used later on. Conda
+        hardlinks packages from the cache into the prefix where the
+        filesystem allows it.
+        """
+        if not self.shared_cache_path:
+            return
+        for name in ["pkgs", "pip", "uv", "wheels"]:
+            (self.shared_cache_path / name).mkdir(parents=True, exist_ok=True)
+        condarc_path = self.clean_dest_path / ".condarc"
+        lines = []
+        if condarc_path.exists():
+            lines = [
+                line for line in condarc_path.read_text().splitlines()
+                if not line.startswith("pkgs_dirs:")
+                and not line.startswith("  - %s" % self.shared_cache_path)
+            ]
+        lines += ["pkgs_dirs:", "  - %s" % self.env["CONDA_PKGS_DIRS"]]
+        condarc_path.write_text("\n".join(lines) + "\n")
+        pip_conf_name = "pip.ini" if config["system"] == "Windows" else "pip.conf"
+        pip_conf_path = self.clean_dest_path / pip_conf_name
+        pip_conf_path.write_text(
+            "[global]\ncache-dir = %s\n" % self.env["PIP_CACHE_DIR"]
+        )
+        self.log("# shared cache %s" % self.shared_cache_path)
+
+    def _count_cache_hits(self, tool: str, hits: int, total: int):
+        """Add to the cache statistics of a tool and report the hit rate.
+
+        :param tool: Either ``"conda"`` or ``"pip"``.
+        :param hits: Number of packages taken from the cache.
+        :param total: Number of packages needed.
+        """
+        if not total:
+            return
+        stats = self.cache_stats[tool]
+        stats[0] += hits
+        stats[1] += total
+        msg = "%s cache: %d of %d packages cached (%d%%), %d%% overall" % (
+            tool, hits, total, 100 * hits / total, 100 * stats[0] / stats[1])
+        if self.verbose:
+            print(msg.capitalize())
+        self.log("# %s" % msg)
+
+    def _run_conda(
+        self, args: str, on_line: Optional[Callable] = None
+    ) -> CommandResult:
+        """Run conda with some arguments, using the ``conda_backend``.
+
+        With a shared cache, the number of newly linked packages found in
+        the cache beforehand is reported as the cache hit rate.
+
+        :param args: The arguments, like ``install -y numpy``.
+        :param on_line: A callable taking each output line.
+        :returns: The ``CommandResult``.
+        :raises CommandError: Is raised if conda fails.
+        """
+        if self.shared_cache_path:
+            pkgs_path = Path(self.env["CONDA_PKGS_DIRS"])
+            meta_path = self.clean_dest_path / "conda-meta"
+            cached = set()
+            if pkgs_path.exists():
+                cached = set(os.listdir(str(pkgs_path)))
+            linked = set(meta_path.glob("*.json"))
+        backend = self.conda_backend
+        if not backend.is_ready():
+            # Until the update step has installed its packages.
+            backend = CondaBackend(self.clean_dest_path)
+        cmd = backend.command(args)
+        result = self.measure(
+            "conda",
+            args,
+            self.run,
+            cmd,
+            shell=config["system"] == "Windows",
+            on_line=on_line,
+        )
+        if self.shared_cache_path:
+            new = [p.stem for p in set(meta_path.glob("*.json")) - linked]
+            hits = len([name for name in new if name in cached])
+            self._count_cache_hits("conda", hits, len(new))
+        return result
+
+    def update_miniconda_base(self):
+        """
+        Update conda post installation.
+
+        This also installs the packages the ``conda_backend`` needs, if any.
+        """
+        args = self.conda_backend.update_args()
+        if args is None:
+            self.log("# no conda to update with %s" % self.conda_backend.name)
+            return
+        self._run_conda(args)
+
+    def _run_pip(self, pip_cmd: str, args: str) -> CommandResult:
+        """Run a ``pip`` command of the installation with some arguments.
+
+        With a shared cache, the cache hit rate is reported from the pip
+        output. The sizes of downloads reported by pip are accounted for in
+        the timing event of the call, see ``measure()``.
+
+        With the ``uv`` ``pip_backend``, ``pip install`` commands are run as
+        ``uv pip install`` for the Python of the installation instead, if
+        uv is found, see ``find_uv()``.
+
+        :param pip_cmd: The pip command with options, like ``pip install``.
+        :param args: The arguments to append, like package names.
+        :returns: The ``CommandResult``.
+        :raises CommandError: Is raised if pip fails.
+        """
+        dest_path = self.clean_dest_path
+        counts = dict(hits=0, misses=0)
+
+        def count(line):
+            if re.match(
+                r"\s*(Using cached|Processing|File was already downloaded) ",
+                line,
+            ):
+                counts["hits"] += 1
+            elif re.match(r"\s*Downloading ", line):
+                counts["misses"] += 1
+                size = re.search(r"\(([\d.]+)\s*([kMG]?)B\)", line)
+                if size:
+                    self._account(int(float(size.group(1)) * 1000 ** (
+                        " kMG".index(size.group(2) or " "))))
+
+        uv = None
+        if self.pip_backend == "uv" and pip_cmd.startswith("pip install"):
+            uv = self.find_uv()
+        if uv:
+            cmd = "%s pip install --python %s%s %s" % (
+                uv, self.python_path(), pip_cmd[len("pip install"):], args)
+            return self.measure(
+                "pip", args, self.run, cmd, shell=config["system"] == "Windows"
+            )
+        if config["system"] == "Windows":
+            cmd = r"%s\condabin\activate && %s %s" % (dest_path, pip_cmd, args)
+            result = self.measure(
+                "pip", args, self.run, cmd, shell=True, on_line=count
+            )
+        else:
+            cmd = "%s/bin/%s %s" % (dest_path, pip_cmd, args)
+            result = self.measure("pip", args, self.run, cmd, on_line=count)
+        if self.shared_cache_path:
+            self._count_cache_hits(
+                "pip", counts["hits"], counts["hits"] + counts["misses"]
+            )
+        return result
+
+    def find_uv(self) -> Optional[str]:
+        """Return the path of the ``uv`` executable, if there is one.
+
+        The installation itself is searched first, then the ``PATH``. If uv
+        is not found, a message is logged once and pip is used instead.
+        """
+        if self._uv_path is None:
+            names = ["uv.exe", "Scripts/uv.exe"] if (
+                config["system"] == "Windows") else ["bin/uv"]
+            found = [
+                str(self.clean_dest_path / name) for name in names
+                if (self.clean_dest_path / name).exists()
+            ]
+            self._uv_path = found[0] if found else (shutil.which("uv") or "")
+            if not self._uv_path:
+                msg = "uv not found, using pip instead"
+                if self.verbose:
+                    print(msg)
+                self.log("# %s" % msg)
+        return self._uv_path or None
+
+    def install_pip(
+        self,
+        dependencies: Optional[List[str]] = None,
+        dependencies_path: Optional[str] = None,
+        index_url: Optional[str] = None,
+        extra_index_url: Optional[List[str]] = None,
+        batch: bool = False,
+        find_links: Optional[str] = None,
+    ):
+        """Pip-install dependencies.
+
+        Dependencies can be specified in a list of package names or
+        a dependencies file.
+
+        In batch mode the list and the file are installed with a single
+        ``pip install`` call, i.e. one resolver run. If that fails, the
+        dependencies are installed one by one to show which one is broken.
+        Dependencies already satisfied are left out, see
+        ``missing_requirements()``.
+
+        :param dependencies: A list of dependency names.
+        :param dependencies_path: A file path with one dependency name per line.
+        :param index_url: URL for package index.
+        :param extra_index_url: Additional URL for package index.
+        :param batch: Install all dependencies with a single pip call.
+        :param find_links: Install from this local directory only (e.g. a
+            wheelhouse filled by ``prefetch_pip()``), ignoring the indexes.
+        """
+        dependencies, dependencies_path = self.missing_requirements(
+            "pip", dependencies, dependencies_path)
+        if not (dependencies or dependencies_path):
+            return
+        dep_path = dependencies_path
+        pip_cmd = "pip install"
+        if not find_links:
+            index_url = self._pip_index(index_url)
+        if find_links:
+            pip_cmd = r"%s --no-index --find-links %s" % (pip_cmd, find_links)
+        elif index_url:
+            pip_cmd = r"%s --index-url %s" % (pip_cmd, index_url)
+        if extra_index_url and not find_links:
+            extra_index_urls = extra_index_url.split(",")
+            print(str(extra_index_urls))
+            for url in extra_index_urls:
+                pip_cmd = r"%s --extra-index-url %s" % (pip_cmd, url)
+
+        if batch:
+            args = list(dependencies or [])
+            if dependencies_path:
+                args += ["-r", dep_path]
+            try:
+                self._run_pip(pip_cmd, " ".join(args))
+                return
+            except CommandError:
+                msg = "Batched pip install failed, installing one by one ..."
+                print(msg)
+                self.log("# %s" % msg)
+
+        for dep in dependencies or []:
+            # This will give output earlier when installed individually.
+            self._run_pip(pip_cmd, dep)
+
+        if dependencies_path:
+            self._run_pip(pip_cmd, "-r %s" % dep_path)
+
+    def prefetch_pip(
+        self,
+        dependencies: Optional[List[str]] = None,
+        dependencies_path: Optional[str] = None,
+        index_url: Optional[str] = None,
+        extra_index_url: Optional[List[str]] = None,
+    ):
+        """Download pip dependencies into ``wheelhouse_path`` without installing.
+
+        The build requirements ``setuptools`` and ``wheel`` are downloaded,
+        too, so source distributions can be built offline later.
+
+        :param dependencies: A list of dependency names.
+        :param dependencies_path: A file path with one dependency name per line.
+        :param index_url: URL for package index.
+        :param extra_index_url: Additional URL for package index.
+        """
+        dependencies, dependencies_path = self.missing_requirements(
+            "pip", dependencies, dependencies_path)
+        if not (dependencies or dependencies_path):
+            return
+        pip_cmd = "pip download -d %s" % self.wheelhouse_path
+        index_url = self._pip_index(index_url)
+        if index_url:
+            pip_cmd = r"%s --index-url %s" % (pip_cmd, index_url)
+        if extra_index_url:
+            for url in extra_index_url.split(","):
+                pip_cmd = r"%s --extra-index-url %s" % (pip_cmd, url)
+        args = ["setuptools", "wheel"] + list(dependencies or [])
+        if dependencies_path:
+            args += ["-r", dependencies_path]
+        self._run_pip(pip_cmd, " ".join(args))
+
+    def prefetch_conda(
+        self,
+        channel: str = "conda-forge",
+        dependencies: Optional[List[str]] = None,
+        dependencies_path: Optional[str] = None,
+    ):
+        """Download conda dependencies into the package cache only.
+
+        :param channel: The conda channel to fetch the packages from.
+        :param dependencies: A list of dependency names.
+        :param dependencies_path: A file path with one dependency name per line.
+        """
+        specs, dependencies_path = self.missing_requirements(
+            "conda", dependencies, dependencies_path)
+        if dependencies_path:
+            specs += ["--file", dependencies_path]
+        if specs:
+            self._run_conda(" ".join(
+                ["install", "-y", "--download-only"]
+                + self._conda_channel_args(channel) + specs))
+
+    def install_conda(
+        self,
+        channel: Optional[str] = "conda-forge",
+        dependencies: Optional[List[str]] = None,
+        dependencies_path: Optional[str] = None,
+        environment_path: Optional[str] = None,
+        offline: bool = False,
+    ):
+        """Conda-install dependencies.
+
+        Dependencies can be specified in a list of package names or
+        a dependencies file or a conda environment file (which will
+        create a new environment). Dependencies already satisfied are left
+        out, see ``missing_requirements()``.
+
+        :param channel: The conda channel to fetch the packages from, none
+            for explicit package lists.
+        :param dependencies: A list of dependency names.
+        :param dependencies_path: A file path with one dependency name per line.
+        :param environment_path: A file path for a conda environment file.
+        :param offline: Install the dependencies (but not the environment)
+            from the package cache only, e.g. as filled by
+            ``prefetch_conda()`` with the same channel.
+        """
+        dependencies, dependencies_path = self.missing_requirements(
+            "conda", dependencies, dependencies_path)
+        install = ["install", "--offline", "-y"] if offline else [
+            "install", "-y"]
+        if dependencies or dependencies_path:
+            install += self._conda_channel_args(channel)
+        for dep in dependencies or []:
+            # This will give output earlier when installed individually.
+            self._run_conda(" ".join(install + [dep]))
+
+        if dependencies_path:
+            self._run_conda(" ".join(install + ["--file", dependencies_path]))
+
+        if environment_path:
+            self._run_conda("env create --file %s" % environment_path)
+
+    def provision_conda(
+        self,
+        channel: str = "conda-forge",
+        dependencies: Optional[List[str]] = None,
+        dependencies_path: Optional[str] = None,
+        update_base: bool = True,
+    ):
+        """Conda-install dependencies and update conda in a single solve.
+
+        This merges what ``update_miniconda_base()`` and ``install_conda()``
+        do with separate solves into one transaction on the base environment,
+        honouring ``channel`` on all platforms (``defaults`` is added with a
+        lower priority when updating conda itself).
+
+        :param channel: The conda channel to fetch the packages from.
+        :param dependencies: A list of dependency names.
+        :param dependencies_path: A file path with one dependency name per line.
+        :param update_base: Also update ``conda`` itself in the transaction.
+        """
+        args = ["install", "-y", "-n", "base", "-c", channel]
+        specs, dependencies_path = self.missing_requirements(
+            "conda", dependencies, dependencies_path)
+        if update_base and not self.conda_backend.standalone:
+            if channel != "defaults":
+                args += ["-c", "defaults"]
+            args.append("--update-specs")
+            specs[:0] = ["conda"] + self.conda_backend.base_packages
+        if dependencies_path:
+            specs += ["--file", dependencies_path]
+        if not specs:
+            return
+        args[args.index(channel)] = self._conda_channel(channel)
+        self._run_conda(" ".join(args + specs))
+
+    def python_path(self) -> str:
+        """Return the path of the Python interpreter of the installation.
+        """
+        if config["system"] == "Windows":
+            return r"%s\python.exe" % self.clean_dest_path
+        return "%s/bin/python" % self.clean_dest_path
+
+    def site_packages_dirs(self) -> List[Path]:
+        """Return the ``site-packages`` directories of the installation.
+        """
+        prefix = self.clean_dest_path
+        return list(prefix.glob("lib/python*/site-packages")) + list(
+            prefix.glob("Lib/site-packages"))
+
+    def pip_installed(self) -> List[Tuple[str, str]]:
+        """Return the names and versions of packages installed by pip or uv.
+
+        This reads the ``INSTALLER`` files of the ``.dist-info`` directories
+        in the installation, so packages installed by conda are left out.
+        """
+        packages = []
+        for site_dir in self.site_packages_dirs():
+            for info_dir in sorted(site_dir.glob("*.dist-info")):
+                try:
+                    installer = (info_dir / "INSTALLER").read_text().strip()
+                    metadata = (info_dir / "METADATA").read_text("utf8")
+                except OSError:
+                    continue
+                if installer not in ("pip", "uv"):
+                    continue
+                name = re.search(r"^Name:\s*(\S+)", metadata, re.M)
+                version = re.search(r"^Version:\s*(\S+)", metadata, re.M)
+                if name and version:
+                    packages.append((name.group(1), version.group(1)))
+        return packages
+
+    def installed_versions(self, tool: str) -> dict:
+        """Return the versions of all packages installed in the installation.
+
+        For ``"pip"`` the interpreter of the installation dumps the
+        distributions on its path with ``importlib.metadata`` (or
+        ``pkg_resources`` before Python 3.8) in a single call, for
+        ``"conda"`` the ``conda-meta`` records are read directly.
+
+        :param tool: ``"pip"`` or ``"conda"``.
+        :returns: The versions by canonical (pip) or package (conda) name,
+            empty if they cannot be found.
+        """
+        if tool == "conda":
+            return dict(
+                (record["name"].lower(), record["version"])
+                for record in self._conda_records().values()
+                if "name" in record and "version" in record
+            )
+        if not Path(self.python_path()).exists():
+            return {}
+        script = (
+            "import json\n"
+            "try:\n"
+            "    from importlib.metadata import distributions\n"
+            "    dists = [(d.metadata['Name'], d.version)"
+            " for d in distributions()]\n"
+            "except ImportError:\n"
+            "    import pkg_resources\n"
+            "    dists = [(d.project_name, d.version)"
+            " for d in pkg_resources.working_set]\n"
+            "print(json.dumps(dists))\n"
+        )
+        lines = []
+
+        def collect(line, stream):
+            if stream == "stdout":
+                lines.append(line)
+
+        try:
+            self.measure(
+                "query",
+                "pip",
+                run_command,
+                [self.python_path(), "-c", script],
+                env=self._child_env(),
+                timeout=self.command_timeout,
+                on_line=collect,
+                tail_lines=1,
+            )
+            dists = json.loads(lines[-1]) if lines else []
+        except (CommandError, TimeoutExpired, OSError, ValueError):
+            return {}
+        versions = {}
+        for name, version in dists:
+            # The first distribution on the path is the one imported.
+            if name:
+                versions.setdefault(_canonical_name(name), version)
+        return versions
+
+    def missing_requirements(
+        self,
+        tool: str,
+        dependencies: Optional[List[str]] = None,
+        dependencies_path: Optional[str] = None,
+    ) -> Tuple[List[str], Optional[str]]:
+        """Leave out requirements already satisfied by the installation.
+
+        The installed versions are queried once with
+        ``installed_versions()`` and compared with ``pip_satisfied()`` or
+        ``conda_satisfied()``. Requirements these cannot check count as
+        missing. A dependencies file is left out only if all its
+        requirements are satisfied, else it is kept as it is.
+
+        :param tool: ``"pip"`` or ``"conda"``.
+        :param dependencies: A list of dependency names.
+        :param dependencies_path: A file path with one dependency name per line.
+        :returns: The missing dependencies and the dependencies file, or
+            ``None`` if it is satisfied.
+        """
+        dependencies = list(dependencies or [])
+        if not self.skip_satisfied or not (dependencies or dependencies_path):
+            return dependencies, dependencies_path
+        installed = self.installed_versions(tool)
+        if not installed:
+            return dependencies, dependencies_path
+        satisfied = pip_satisfied if tool == "pip" else conda_satisfied
+        missing = [
+            dep for dep in dependencies if not satisfied(dep, installed)
+        ]
+        skipped = [dep for dep in dependencies if dep not in missing]
+        if dependencies_path:
+            lines = [
+                line.split("#", 1)[0].strip()
+                for line in Path(dependencies_path).read_text().splitlines()
+            ]
+            if all(satisfied(line, installed) for line in lines if line):
+                skipped.append(dependencies_path)
+                dependencies_path = None
+        if skipped:
+            msg = "Already satisfied, not installing with %s: %s" % (
+                tool, ", ".join(skipped))
+            print(msg)
+            self.log("# %s" % msg)
+        return missing, dependencies_path
+
+    def slim(self, extras: Sequence[str] = ()) -> dict:
+        """Reduce the disk footprint of the installation.
+
+        This removes all conda packages and index caches with
+        ``conda clean -afy`` and purges the pip cache, unless these are
+        in the shared cache, and replaces identical files by hardlinks, see
+        ``dedup_hardlinks()``. The bytes saved per category are logged.
+
+        :param extras: What else to remove: ``"tests"`` for ``tests``
+            and ``test`` directories of Python packages and ``"static-libs"``
+            for static libraries (``lib/*.a``).
+        :returns: The bytes saved per category.
+        :raises ValueError: Is raised for unknown extras.
+        """
+        unknown = set(extras) - {"tests", "static-libs"}
+        if unknown:
+            raise ValueError("Unknown --slim extras: %s" % ", ".join(
+                sorted(unknown)))
+        prefix = self.clean_dest_path
+        saved = OrderedDict()
+        started = time.monotonic()
+        if self.shared_cache_path:
+            self.log("# keeping conda and pip caches in the shared cache")
+        else:
+            size = tree_size(prefix / "pkgs")
+            self._run_conda("clean -afy")
+            saved["conda-pkgs"] = size - tree_size(prefix / "pkgs")
+            lines = []
+            try:
+                self.run("%s -m pip cache dir" % self.python_path(),
+                         on_line=lines.append)
+                pip_cache = Path(lines[-1].strip())
+                size = tree_size(pip_cache)
+                self.run("%s -m pip cache purge" % self.python_path())
+                saved["pip-cache"] = size - tree_size(pip_cache)
+            except (CommandError, IndexError, OSError):
+                self.log("# no pip cache to purge")
+
+        removals = []
+        if "tests" in extras:
+            for site_dir in self.site_packages_dirs():
+                removals += [
+                    ("tests", path) for path in site_dir.glob("**/test*")
+                    if path.name in ("test", "tests") and path.is_dir()
+                    and not path.is_symlink()
+                ]
+        if "static-libs" in extras:
+            removals += [
+                ("static-libs", path) for path in prefix.glob("lib/**/*.a")
+                if path.is_file() and not path.is_symlink()
+            ]
+        for category, path in removals:
+            if not os.path.lexists(str(path)):
+                continue  # In a directory removed before.
+            if path.is_dir():
+                size = tree_size(path)
+                shutil.rmtree(str(path))
+            else:
+                size = path.lstat().st_size if path.lstat().st_nlink == 1 else 0
+                path.unlink()
+            saved[category] = saved.get(category, 0) + size
+
+        counts = dedup_hardlinks(prefix)
+        saved["hardlinks"] = counts["bytes"]
+        msg = "Slimmed %s in %.1f s, saved %.1f MiB: %s" % (
+            prefix,
+            time.monotonic() - started,
+            sum(saved.values()) / 2 ** 20,
+            ", ".join(
+                "%s %.1f MiB" % (k, v / 2 ** 20) for k, v in saved.items()
+            ),
+        )
+        if self.verbose:
+            print(msg)
+        self.log("# %s" % msg)
+        return saved
+
+    def precompile(self, mode: str = "timestamp", jobs: int = 0):
+        """Compile all modules in ``site-packages`` to bytecode up front.
+
+        The interpreter of the installation first lists the modules whose
+        ``.pyc`` files are missing or stale, i.e. have another magic number
+        or ``mode`` flags, or do not match the source by its modification
+        time and size (``"timestamp"``) or its hash (the hash modes). Only
+        those are compiled, by ``compileall`` on up to ``jobs`` worker
+        processes (all cores for 0), so ``.pyc`` files written by pip and
+        conda are replaced in the hash modes, and files compiled before in
+        the same mode are skipped. With ``mode`` ``"unchecked-hash"`` the
+        ``.pyc`` files are never checked against their sources, which suits
+        read-only deployments. The number of files compiled is logged.
+
+        :param mode: The ``.pyc`` invalidation mode, ``"timestamp"``,
+            ``"checked-hash"`` or ``"unchecked-hash"``.
+        :param jobs: The number of worker processes.
+        """
+        site_dirs = self.site_packages_dirs()
+        if not site_dirs:
+            return
+        python = self.python_path()
+        script = (
+            "import importlib.util, json, os, sys\n"
+            "flags = dict(timestamp=0)\n"
+            "flags.update({'checked-hash': 3, 'unchecked-hash': 1})\n"
+            "flags = flags[sys.argv[1]].to_bytes(4, 'little')\n"
+            "sources, stale = 0, []\n"
+            "for site_dir in sys.argv[2:]:\n"
+            "    for root, _, files in os.walk(site_dir):\n"
+            "        for name in files:\n"
+            "            if not name.endswith('.py'):\n"
+            "                continue\n"
+            "            sources += 1\n"
+            "            path = os.path.join(root, name)\n"
+            "            try:\n"
+            "                pyc = importlib.util.cache_from_source(path)\n"
+            "                with open(pyc, 'rb') as f:\n"
+            "                    header = f.read(16)\n"
+            "                with open(path, 'rb') as f:\n"
+            "                    data = f.read()\n"
+            "                st = os.stat(path)\n"
+            "            except OSError:\n"
+            "                stale.append(path)\n"
+            "                continue\n"
+            "            if flags == bytes(4):\n"
+            "                check = (int(st.st_mtime) & 0xFFFFFFFF).to_bytes(\n"
+            "                    4, 'little') + len(data).to_bytes(4, 'little')\n"
+            "            else:\n"
+            "                check = importlib.util.source_hash(data)\n"
+            "            if header != importlib.util.MAGIC_NUMBER + flags + check:\n"
+            "                stale.append(path)\n"
+            "print(json.dumps(dict(sources=sources, stale=stale)))\n"
+        )
+        lines = []
+
+        def collect(line, stream):
+            if stream == "stdout":
+                lines.append(line)
+
+        def handle_line(line, stream):
+            print(line)
+            self.log("# | %s" % line)
+
+        started = time.monotonic()
+        self.measure(
+            "query",
+            "pyc",
+            run_command,
+            [python, "-c", script, mode] + [str(d) for d in site_dirs],
+            env=self._child_env(),
+            timeout=self.command_timeout,
+            on_line=collect,
+            tail_lines=1,
+        )
+        found = json.loads(lines[-1])
+        stale = found["stale"]
+        workers = min(jobs or os.cpu_count() or 1, len(stale))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            def compile_files(index):
+                # Listed files are compiled one by one, so use a process
+                # per chunk of them.
+                list_path = os.path.join(tmp_dir, "files-%d.txt" % index)
+                with open(list_path, "w") as f:
+                    f.write("\n".join(stale[index::workers]) + "\n")
+                cmd = [python, "-m", "compileall", "-q", "-f", "-i", list_path]
+                if mode != "timestamp":
+                    cmd[4:4] = ["--invalidation-mode", mode]
+                self.log(" ".join(cmd))
+                self.measure(
+                    "compile",
+                    mode,
+                    run_command,
+                    cmd,
+                    env=self._child_env(),
+                    timeout=self.command_timeout,
+                    on_line=handle_line,
+                )
+
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                list(pool.map(compile_files, range(workers)))
+        msg = "Precompiled %d of %d modules (%s) in %.1f s" % (
+            len(stale), found["sources"], mode, time.monotonic() - started)
+        if self.verbose:
+            print(msg)
+        self.log("# %s" % msg)
+
+    def top_level_modules(self) -> List[str]:
+        """Return the names of all installed top-level modules and packages.
+
+        They are read from the ``top_level.txt`` files of the distributions
+        in ``site-packages`` or, if missing, from their ``RECORD``. Private
+        names starting with an underscore and test packages are left out.
+        """
+        names = set()
+        for site_dir in self.site_packages_dirs():
+            for info_dir in site_dir.glob("*.*-info"):
+                try:
+                    text = (info_dir / "top_level.txt").read_text()
+                except OSError:
+                    try:
+                        record = (info_dir / "RECORD").read_text()
+                    except OSError:
+                        continue
+                    text = "\n".join(
+                        re.split(r"[/,]|\.py,", line, 1)[0]
+                        for line in record.splitlines()
+                        if re.match(r"[^/,]+(/__init__)?\.py,", line)
+                    )
+                names.update(name.strip() for name in text.split())
+        return sorted(
+            name for name in names
+            if name.isidentifier()
+            and not name.startswith("_")
+            and name not in ("test", "tests")
+        )
+
+    def verify_imports(
+        self, modules: Optional[List[str]] = None, jobs: int = 4
+    ) -> List[dict]:
+        """Import all top-level modules with interpreters of the installation.
+
+        Each module is imported by its own ``python -X importtime``, so its
+        cold-start import time is measured without modules cached by
+        others, with up to ``jobs`` interpreters running at a time. Each
+        import is recorded as an ``"import"`` event, see ``measure()``, and
+        a report of the failures and the ``verify_report`` slowest imports
+        from ``config`` is printed and logged.
+
+        :param modules: The modules to import, by default all found by
+            ``top_level_modules()``.
+        :param jobs: The number of interpreters running at a time.
+        :returns: For each module a dict with its ``name``, ``ok``, the
+            ``error`` of failed imports, the ``cumulative`` import time in
+            seconds and the ``heaviest`` module imported with it by self
+            time.
+        :raises ValueError: Is raised if any import fails.
+        """
+        if modules is None:
+            modules = self.top_level_modules()
+        python = self.python_path()
+
+        def verify(name):
+            lines = []
+            result = dict(name=name, ok=False, error=None)
+            try:
+                self.measure(
+                    "import",
+                    name,
+                    run_command,
+                    [python, "-X", "importtime", "-c", "import %s" % name],
+                    env=self._child_env(),
+                    timeout=self.command_timeout,
+                    on_line=lambda line, stream: lines.append(line),
+                    tail_lines=1,
+                )
+                result["ok"] = True
+            except (CommandError, TimeoutExpired) as err:
+                errors = [
+                    line for line in lines if not line.startswith("import time:")
+                ]
+                result["error"] = errors[-1] if errors else str(err)
+            times = parse_importtime(lines)
+            result["cumulative"] = next(
+                (t[2] for t in times if t[0] == name), None)
+            heaviest = max(times, key=lambda t: t[1], default=None)
+            result["heaviest"] = heaviest[:2] if heaviest else None
+            return result
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            results = list(pool.map(verify, modules))
+        failed = [r for r in results if not r["ok"]]
+        lines = ["Verified %d imports in %.1f s, %d failed." % (
+            len(results), time.monotonic() - started, len(failed))]
+        lines += ["  FAIL %s: %s" % (r["name"], r["error"]) for r in failed]
+        timed = sorted(
+            (r for r in results if r["cumulative"] is not None),
+            key=lambda r: -r["cumulative"],
+        )
+        if timed:
+            lines.append("Slowest imports:")
+        for r in timed[:config["verify_report"]]:
+            line = "  %7.3f s  %s" % (r["cumulative"], r["name"])
+            if r["heaviest"] and r["heaviest"][0] != r["name"]:
+                line += " (heaviest %s %.3f s)" % r["heaviest"]
+            lines.append(line)
+        for line in lines:
+            print(line)
+            self.log("# %s" % line)
+        if failed:
+            raise ValueError("Importing failed for %s." % ", ".join(
+                r["name"] for r in failed))
+        return results
+
+    def explicit_packages(self) -> Tuple[Optional[str], List[str]]:
+        """Return the platform and explicit package list of the base env.
+
+        :returns: The conda platform name, if given, and the lines of
+            ``conda list --explicit --md5``, i.e. comments, ``@EXPLICIT``
+            and package URLs with MD5 digests as fragments.
+        """
+        explicit = []
+        self._run_conda("list --explicit --md5", on_line=explicit.append)
+        explicit = [
+            line for line in explicit
+            if line.startswith(("#", "@EXPLICIT", "http", "file:"))
+        ]
+        platform_name = None
+        for line in explicit:
+            m = re.match(r"#\s*platform:\s*(\S+)", line)
+            if m:
+                platform_name = m.group(1)
+        return platform_name, explicit
+
+    def pip_archives(
+        self,
+        index_url: Optional[str] = None,
+        extra_index_url: Optional[str] = None,
+    ) -> List[Tuple[str, List[Path]]]:
+        """Download the archives of all packages installed by pip or uv.
+
+        The archives are downloaded with ``pip download --no-deps`` into
+        ``wheelhouse_path``, see ``pip_installed()``.
+
+        :param index_url: URL for package index.
+        :param extra_index_url: Additional URL for package index.
+        :returns: The pinned requirements with the paths of their archives.
+        :raises ValueError: Is raised if an archive is missing.
+        """
+        pins = ["%s==%s" % item for item in self.pip_installed()]
+        if not pins:
+            return []
+        self.wheelhouse_path.mkdir(parents=True, exist_ok=True)
+        pip_cmd = "pip download --no-deps -d %s" % self.wheelhouse_path
+        index_url = self._pip_index(index_url)
+        if index_url:
+            pip_cmd = r"%s --index-url %s" % (pip_cmd, index_url)
+        if extra_index_url:
+            for url in extra_index_url.split(","):
+                pip_cmd = r"%s --extra-index-url %s" % (pip_cmd, url)
+        self._run_pip(pip_cmd, " ".join(pins))
+        archives = {}
+        for archive in sorted(self.wheelhouse_path.iterdir()):
+            key = _archive_name_version(archive.name)
+            if key:
+                archives.setdefault(key, []).append(archive)
+        result = []
+        for pin in pins:
+            name, version = pin.split("==")
+            key = (_canonical_name(name), version)
+            if key not in archives:
+                raise ValueError("No archive downloaded for %s." % pin)
+            result.append((pin, archives[key]))
+        return result
+
+    def write_lock(
+        self,
+        path: str,
+        index_url: Optional[str] = None,
+        extra_index_url: Optional[str] = None,
+    ):
+        """Write a lockfile pinning all packages of the installation.
+
+        The lockfile is a JSON object with the explicit conda package list
+        with MD5 digests, see ``explicit_packages()``, and the packages
+        installed by pip as fully pinned requirements with SHA-256 digests
+        of their archives, see ``pip_archives()``.
+
+        :param path: The path of the lockfile.
+        :param index_url: URL for package index.
+        :param extra_index_url: Additional URL for package index.
+        """
+        platform_name, explicit = self.explicit_packages()
+        requirements = [
+            "%s %s" % (pin, " ".join(
+                "--hash=sha256:%s" % _file_digest(str(archive))
+                for archive in archives
+            ))
+            for pin, archives in self.pip_archives(index_url, extra_index_url)
+        ]
+
+        lock = dict(
+            mcinstall=__version__,
+            created=time.time(),
+            platform=platform_name,
+            conda=explicit,
+            pip=requirements,
+        )
+        lock_path = Path(path).expanduser().absolute()
+        lock_path.write_text(json.dumps(lock, indent=2) + "\n")
+        msg = "Wrote lockfile %s with %d conda and %d pip packages" % (
+            lock_path,
+            len([line for line in explicit if not line.startswith(("#", "@"))]),
+            len(requirements),
+        )
+        if self.verbose:
+            print(msg)
+        self.log("# %s" % msg)
+
+    def install_from_lock(self, path: str):
+        """Install exactly the packages of a lockfile, without solving.
+
+        The conda packages are installed from the explicit list of
+        URLs, and the pip packages with ``--no-deps --require-hashes``.
+
+        :param path: The path of a lockfile written by ``write_lock()``.
+        :raises ValueError: Is raised for a lockfile of another platform.
+        """
+        lock_path = Path(path).expanduser().absolute()
+        lock = json.loads(lock_path.read_text())
+        _check_platform(lock.get("platform"), "Lockfile %s" % lock_path)
+        self.download_path.mkdir(parents=True, exist_ok=True)
+        name = hashlib.sha256(lock_path.read_bytes()).hexdigest()[:16]
+        if any(not line.startswith(("#", "@")) for line in lock["conda"]):
+            explicit_path = self.download_path / ("lock-%s-conda.txt" % name)
+            explicit_path.write_text("\n".join(lock["conda"]) + "\n")
+            self._run_conda("install -y -n base --file %s" % explicit_path)
+        if lock["pip"]:
+            reqs_path = self.download_path / ("lock-%s-pip.txt" % name)
+            reqs_path.write_text("\n".join(lock["pip"]) + "\n")
+            self._run_pip(
+                "pip install --no-deps --require-hashes", "-r %s" % reqs_path
+            )
+
+    def _conda_package_path(self, url: str, md5: Optional[str] = None) -> Path:
+        """Return a local copy of a conda package, downloading it if needed.
+
+        The package caches of the installation and of the shared cache are
+        looked up first.
+
+        :param url: The package URL.
+        :param md5: The expected hex MD5 digest of the package, if known.
+        :raises ValueError: Is raised if the package does not match ``md5``.
+        """
+        if url.startswith("file:"):
+            return Path(request.url2pathname(urlparse(url).path))
+        fn = url.rsplit("/", 1)[-1]
+        pkgs_dirs = [self.clean_dest_path / "pkgs"]
+        if self.shared_cache_path:
+            pkgs_dirs.insert(0, self.shared_cache_path / "pkgs")
+        pkgs_dirs.append(self.download_path / config["bundles_dir_name"] / "pkgs")
+        for pkgs_dir in pkgs_dirs:
+            path = pkgs_dir / fn
+            if path.is_file() and md5 in (None, _file_digest(str(path), "md5")):
+                return path
+        path = pkgs_dirs[-1] / fn
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.download_file(url, path)
+        if md5 not in (None, _file_digest(str(path), "md5")):
+            path.unlink()
+            raise ValueError("Checksum mismatch for %s." % url)
+        return path
+
+    def _conda_records(self) -> dict:
+        """Return the ``repodata.json`` records of the installed conda packages.
+
+        :returns: The records read from ``conda-meta`` by package file name.
+        """
+        records = {}
+        meta_dir = self.clean_dest_path / "conda-meta"
+        for meta_path in sorted(meta_dir.glob("*.json")):
+            try:
+                meta = json.loads(meta_path.read_text())
+            except ValueError:
+                continue
+            fn = meta.get("fn") or meta.get("url", "").rsplit("/", 1)[-1]
+            records[fn] = dict(
+                (key, meta[key]) for key in REPODATA_KEYS if key in meta
+            )
+        return records
+
+    def build_bundle(
+        self,
+        path: str,
+        index_url: Optional[str] = None,
+        extra_index_url: Optional[str] = None,
+    ) -> Path:
+        """Write a bundle to provision a copy of the installation offline.
+
+        A bundle is a tar stream starting with a ``manifest.json``, followed
+        by the installer (or micromamba archive), all conda packages of the
+        base environment as a local channel in ``channel/`` with a
+        ``repodata.json`` per platform, and the archives of all packages
+        installed by pip in ``wheels/``. The manifest lists the SHA-256
+        digest of every file. It is not compressed, as the packages are.
+
+        :param path: The path of the bundle.
+        :param index_url: URL for package index.
+        :param extra_index_url: Additional URL for package index.
+        :returns: The path of the bundle.
+        """
+        blob_path = self.mc_blob_path or self.fetch_base()
+        if self.conda_backend.standalone:
+            installer = "installer/micromamba-%s.tar.bz2" % (
+                MicromambaBackend.platform())
+        else:
+            installer = "installer/%s" % self.mc_blob_name
+        files = OrderedDict([(installer, blob_path)])
+        platform_name, explicit = self.explicit_packages()
+        records = self._conda_records()
+        repodata = OrderedDict()
+        conda = []
+        for line in explicit:
+            if line.startswith(("#", "@")):
+                continue
+            url, _, md5 = line.partition("#")
+            subdir, fn = url.rsplit("/", 2)[-2:]
+            arcname = "channel/%s/%s" % (subdir, fn)
+            files[arcname] = self._conda_package_path(url, md5 or None)
+            conda.append(arcname)
+            key = "packages.conda" if fn.endswith(".conda") else "packages"
+            repodata.setdefault(subdir, {"packages": {}, "packages.conda": {}})
+            repodata[subdir][key][fn] = records.get(fn, {})
+        pip = []
+        for pin, archives in self.pip_archives(index_url, extra_index_url):
+            pip.append(pin)
+            for archive in archives:
+                files["wheels/%s" % archive.name] = archive
+
+        blobs = OrderedDict()
+        repodata.setdefault("noarch", {"packages": {}, "packages.conda": {}})
+        for subdir, data in repodata.items():
+            data.update(info=dict(subdir=subdir), repodata_version=1)
+            blobs["channel/%s/repodata.json" % subdir] = json.dumps(
+                data, indent=2, sort_keys=True).encode("utf8")
+        digests = OrderedDict(
+            (name, hashlib.sha256(data).hexdigest())
+            for name, data in blobs.items()
+        )
+        digests.update(
+            (name, _file_digest(str(src))) for name, src in files.items()
+        )
+        manifest = dict(
+            id=_fingerprint(digests)[:16],
+            mcinstall=__version__,
+            created=time.time(),
+            platform=platform_name,
+            conda_backend=self.conda_backend.name,
+            standalone=self.conda_backend.standalone,
+            installer=installer,
+            conda=conda,
+            pip=pip,
+            files=digests,
+        )
+
+        bundle_path = Path(path).expanduser().absolute()
+        part_path = bundle_path.with_name(bundle_path.name + ".part")
+        blobs["manifest.json"] = json.dumps(manifest, indent=2).encode("utf8")
+        blobs.move_to_end("manifest.json", last=False)
+        with tarfile.open(str(part_path), "w|") as tar:
+            for name, data in blobs.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = int(manifest["created"])
+                tar.addfile(info, io.BytesIO(data))
+            for name, src in files.items():
+                tar.add(str(src), arcname=name)
+        part_path.replace(bundle_path)
+        msg = "Wrote bundle %s (%.1f MiB) with %d conda and %d pip packages" % (
+            bundle_path, bundle_path.stat().st_size / 2 ** 20, len(conda),
+            len(pip))
+        if self.verbose:
+            print(msg)
+        self.log("# %s" % msg)
+        return bundle_path
+
+    def unpack_bundle(self, path: str) -> dict:
+        """Unpack a bundle written by ``build_bundle()`` in a streaming pass.
+
+        The bundle is read sequentially, from stdin for ``-``, and each file
+        is checked against its digest in the manifest while it is written.
+        Bundles are unpacked below ``download_path``, named by their
+        manifest ``id``, and reused if unpacked before. The installer in
+        the bundle is then used by ``install_miniconda()``.
+
+        :param path: The path of the bundle, or ``-``.
+        :returns: The manifest with the unpacked ``root`` directory added.
+        :raises ValueError: Is raised for invalid or incomplete bundles.
+        """
+        if path == "-":
+            fin = sys.stdin.buffer
+        else:
+            fin = Path(path).expanduser().open("rb")
+        try:
+            with tarfile.open(fileobj=fin, mode="r|*") as tar:
+                member = tar.next()
+                if member is None or member.name != "manifest.json":
+                    raise ValueError("No manifest in bundle %s." % path)
+                manifest = json.loads(
+                    tar.extractfile(member).read().decode("utf8"))
+                _check_platform(manifest["platform"], "Bundle %s" % path)
+                if not re.match(r"^[0-9a-f]+$", str(manifest["id"])):
+                    raise ValueError("Invalid bundle id %r." % manifest["id"])
+                for name in [manifest["installer"]] + manifest["conda"] + (
+                    list(manifest["files"])
+                ):
+                    _relative_path(name, "bundle")
+                if manifest["installer"] not in manifest["files"]:
+                    raise ValueError("No installer in bundle %s." % path)
+                if manifest["standalone"] != self.conda_backend.standalone:
+                    raise ValueError(
+                        "Bundle %s needs --conda-backend %s." % (
+                            path, manifest["conda_backend"]))
+                root = self.download_path / config["bundles_dir_name"] / (
+                    manifest["id"])
+                root.parent.mkdir(parents=True, exist_ok=True)
+                with FileLock(root.with_name(root.name + ".lock")):
+                    if root.exists():
+                        self.log("# bundle %s unpacked already" % root)
+                    else:
+                        started = time.monotonic()
+                        self._unpack_bundle_files(tar, manifest, root)
+                        self.log("# unpacked bundle %s to %s in %.1f s" % (
+                            path, root, time.monotonic() - started))
+        finally:
+            if fin is not sys.stdin.buffer:
+                fin.close()
+        manifest["root"] = str(root)
+        self.bundle = manifest
+        self.mc_blob_path = root / manifest["installer"]
+        self.mc_blob_sha256 = manifest["files"][manifest["installer"]]
+        return manifest
+
+    def _unpack_bundle_files(self, tar, manifest: dict, root: Path):
+        """Unpack and verify the files of a bundle after its manifest.
+
+        The files are written to a ``.part`` directory renamed to ``root``
+        when complete, together with the manifest and an explicit package
+        list of the local channel, ``conda-explicit.txt``.
+        """
+        part_path = root.with_name(root.name + ".part")
+        if part_path.exists():
+            shutil.rmtree(str(part_path))
+        chunk_size = config["download_chunk_size"]
+        expected = manifest["files"]
+        seen = set()
+        for member in tar:
+            if member.name == "manifest.json" or member.isdir():
+                continue
+            if member.name not in expected or not member.isfile():
+                raise ValueError("Unexpected %s in bundle." % member.name)
+            target = part_path / os.path.normpath(member.name)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            digest = hashlib.sha256()
+            src = tar.extractfile(member)
+            with target.open("wb") as fout:
+                for chunk in iter(lambda: src.read(chunk_size), b""):
+                    fout.write(chunk)
+                    digest.update(chunk)
+            if digest.hexdigest() != expected[member.name]:
+                raise ValueError("Checksum mismatch for %s in bundle." % (
+                    member.name))
+            seen.add(member.name)
+        missing = sorted(set(expected) - seen)
+        if missing:
+            raise ValueError("Bundle is incomplete, missing %s." % ", ".join(
+                missing))
+        (part_path / "conda-explicit.txt").write_text("\n".join(
+            ["@EXPLICIT"] + [(root / name).as_uri() for name in manifest["conda"]]
+        ) + "\n")
+        (part_path / "manifest.json").write_text(json.dumps(manifest, indent=2))
+        part_path.replace(root)
+
+    def install_bundle(self):
+        """Install the packages of the bundle unpacked by ``unpack_bundle()``.
+
+        The conda packages are installed offline from the explicit list of
+        the local channel (standalone backends did that when creating the
+        installation), and the pip packages with ``--no-index --find-links``
+        from the archives in the bundle.
+        """
+        root = Path(self.bundle["root"])
+        if self.bundle["conda"] and not self.conda_backend.standalone:
+            self.install_conda(
+                channel=None,
+                dependencies_path=str(root / "conda-explicit.txt"),
+                offline=True,
+            )
+        if self.bundle["pip"]:
+            self.install_pip(
+                dependencies=self.bundle["pip"],
+                batch=True,
+                find_links=str(root / "wheels"),
+            )
+
+
+class StepScheduler:
+    """Run named steps in dependency order, concurrently where possible.
+
+    Steps are callables registered with the names of the steps they
+    require, which must have been registered before. A step starts as soon
+    as all its requirements have finished, on a thread pool of
+    ``max_workers`` threads. With one worker, steps run in the order they
+    were added.
+
+    Steps are called through ``measure(name, func)`` if given, like
+    ``partial(MinicondaInstaller.measure, "step")``.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 1,
+        verbose: bool = False,
+        measure: Optional[Callable] = None,
+    ):
+        self.max_workers = max(1, max_workers)
+        self.verbose = verbose
+        self.measure = measure
+        self.steps = OrderedDict()
+        self.timings = OrderedDict()
+
+    def add(self, name: str, func: Callable, requires: Sequence[str] = ()):
+        """Register a step.
+
+        :param name: The unique name of the step.
+        :param func: The callable to run, without arguments.
+        :param requires: The names of the steps to finish before this one.
+        :raises ValueError: Is raised for unknown requirements.
+        """
+        unknown = [r for r in requires if r not in self.steps]
+        if unknown:
+            raise ValueError("Step %s requires unknown steps: %s" % (
+                name, ", ".join(unknown)))
+        self.steps[name] = (func, tuple(requires))
+
+    def _run_step(self, name: str, func: Callable):
+        if self.verbose:
+            print("Starting step %s." % name)
+        started = time.monotonic()
+        if self.measure:
+            self.measure(name, func)
+        else:
+            func()
+        self.timings[name] = time.monotonic() - started
+        if self.verbose:
+            print("Finished step %s in %.1f s." % (name, self.timings[name]))
+
+    def run(self) -> dict:
+        """Run all steps and return their durations in seconds by name.
+
+        If a step fails, no further steps are started and the exception is
+        re-raised once the running steps have finished.
+        """
+        pending = OrderedDict(self.steps)
+        running = {}
+        done = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                for name, (func, requires) in list(pending.items()):
+                    if len(running) >= self.max_workers:
+                        break
+                    if done.issuperset(requires):
+                        del pending[name]
+                        future = pool.submit(self._run_step, name, func)
+                        running[future] = name
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        pending.clear()
+                        wait(running)
+                        raise future.exception()
+                    done.add(name)
+        return self.timings
+
+
+def make_parser(
+    fleet: bool = False, bundle: bool = False
+) -> argparse.ArgumentParser:
+    """Make the parser for the command-line arguments of ``main()``.
+
+    :param fleet: Make the parser for ``mcinstall fleet`` instead, taking
+        any number of destination directories and a manifest.
+    :param bundle: Make the parser for ``mcinstall bundle`` instead, taking
+        a staging directory and the output path.
+    """
+    systems = ", ".join(known_systems)
+    if fleet:
+        desc = (
+            "Quick-install/provision many fresh Miniconda installations "
+            "in parallel for %s." % systems
+        )
+        p = argparse.ArgumentParser(prog="mcinstall fleet", description=desc)
+        p.add_argument(
+            "paths",
+            metavar="DEST_DIR",
+            nargs="*",
+            help="The destination directories, all using the options below.",
+        )
+        p.add_argument(
+            "--manifest",
+            metavar="PATH",
+            help=(
+                "Path of a JSON file with a list of specs, objects with a "
+                '"path" and any options below (like "pip-dependencies") '
+                "overriding those given on the command-line."
+            ),
+        )
+        p.add_argument(
+            "--jobs",
+            metavar="N",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Number of installations to provision in parallel.",
+        )
+        p.add_argument(
+            "--max-network",
+            metavar="N",
+            type=int,
+            default=4,
+            help="Maximum number of network-bound steps running at a time.",
+        )
+        p.add_argument(
+            "--max-disk",
+            metavar="N",
+            type=int,
+            default=2,
+            help="Maximum number of CPU/disk-bound steps running at a time.",
+        )
+    elif bundle:
+        desc = (
+            "Provision a staging Miniconda installation and bundle all it "
+            "needs to be provisioned again offline, for %s." % systems
+        )
+        p = argparse.ArgumentParser(prog="mcinstall bundle", description=desc)
+        p.add_argument(
+            "path",
+            metavar="STAGE_DIR",
+            help="The staging directory (will be created if needed).",
+        )
+        p.add_argument(
+            "--output",
+            metavar="PATH",
+            required=True,
+            help="Path of the bundle to write.",
+        )
+    else:
+        desc = "Quick-install/provision a fresh Miniconda for %s." % systems
+        p = argparse.ArgumentParser(description=desc)
+        p.add_argument(
+            "path",
+            metavar="DEST_DIR",
+            help="The destination directory (will be created if needed).",
+        )
+    p.add_argument(
+        "--verbose", action="store_true", help="Output additional information."
+    )
+    if not (fleet or bundle):
+        p.add_argument(
+            "--server",
+            metavar="ADDRESS",
+            help=(
+                "Provision with the daemon started by 'mcinstall serve' at "
+                "this Unix socket path or [HOST:]PORT, like %s."
+                % config["serve_address"]
+            ),
+        )
+    p.add_argument(
+        "--profile",
+        action="store_true",
+        help=(
+            "Print a breakdown of the time spent per step and package at the "
+            "end (timing events are always appended to %s)."
+            % config["events_path"]
+        ),
+    )
+    p.add_argument(
+        "--step-timeout",
+        metavar="SECONDS",
+        type=float,
+        help="Kill installer, pip and conda commands running longer than this.",
+    )
+    p.add_argument(
+        "--download-connections",
+        metavar="N",
+        type=int,
+        default=1,
+        help=(
+            "Number of parallel connections for downloading the installer "
+            "(needs a server supporting byte ranges)."
+        ),
+    )
+    p.add_argument(
+        "--cache-max-bytes",
+        metavar="SIZE",
+        type=parse_size,
+        help=(
+            "Size budget of the installer cache, e.g. 500M or 2G "
+            "(default: %d bytes)." % config["cache_max_bytes"]
+        ),
+    )
+    p.add_argument(
+        "--mirrors",
+        metavar="LIST",
+        default="",
+        help=(
+            "Comma-separated base URLs of mirrors of %s to download the "
+            "installer from, probing for the fastest and failing over to the "
+            "others." % config["mc_base_url"]
+        ),
+    )
+    p.add_argument(
+        "--pip-index-mirrors",
+        metavar="LIST",
+        default="",
+        help=(
+            "Comma-separated URLs of mirrors of the pip index, the fastest "
+            "of them and --pip-index-url (or PyPI) is used."
+        ),
+    )
+    p.add_argument(
+        "--conda-channel-mirrors",
+        metavar="LIST",
+        default="",
+        help=(
+            "Comma-separated URLs of mirrors of --conda-channel, the fastest "
+            "of them and the channel is used."
+        ),
+    )
+    p.add_argument(
+        "--mirror-ttl",
+        metavar="SECONDS",
+        type=float,
+        help=(
+            "How long to reuse mirror rankings before probing again "
+            "(default: %d)." % config["mirror_ttl"]
+        ),
+    )
+    p.add_argument(
+        "--repo-index",
+        metavar="PATH_OR_URL",
+        help=(
+            "Local copy or URL of the Miniconda repository listing, used to "
+            "resolve latest to a version and verify checksums (default: %s)."
+            % config["mc_index_url"]
+        ),
+    )
+    p.add_argument(
+        "--no-revalidate",
+        dest="revalidate",
+        action="store_false",
+        help="Use a cached latest installer without checking for a newer one.",
+    )
+    p.add_argument(
+        "--shared-cache",
+        metavar="DIR",
+        help=(
+            "Host-wide cache directory for conda packages (pkgs_dirs), pip "
+            "downloads and wheels, shared by all installations using it."
+        ),
+    )
+    p.add_argument(
+        "--golden-dir",
+        metavar="DIR",
+        help=(
+            "Keep a provisioned golden installation per spec in this "
+            "directory and create the destination as a relocated clone of it, "
+            "using reflinks or hardlinks where possible."
+        ),
+    )
+    p.add_argument(
+        "--snapshot-dir",
+        metavar="DIR",
+        help=(
+            "Restore the destination from a compressed snapshot of an earlier "
+            "run with the same spec in this directory if there is one, "
+            "else save one after provisioning."
+        ),
+    )
+    p.add_argument(
+        "--bundle",
+        metavar="PATH",
+        help=(
+            "Provision from a bundle written by 'mcinstall bundle' (or '-' "
+            "to read it from stdin) without network access, instead of "
+            "downloading the installer and dependencies."
+        ),
+    )
+    p.add_argument(
+        "--force",
+        action="store_true",
+        help=(
+            "Run all steps, even those recorded as done with the same inputs "
+            "in the state file of an existing installation."
+        ),
+    )
+    p.add_argument(
+        "--no-skip-satisfied",
+        dest="skip_satisfied",
+        action="store_false",
+        help=(
+            "Pass all pip and conda requirements to pip and conda, even "
+            "those already satisfied by the installed versions."
+        ),
+    )
+    p.add_argument(
+        "--pip-dependencies",
+        metavar="LIST",
+        default="",
+        help="Comma-separated list of pip requirements.",
+    )
+    p.add_argument(
+        "--pip-dependencies-path",
+        metavar="PATH",
+        help="Path of a pip requirements file, usually named requirements.txt.",
+    )
+    p.add_argument(
+        "--pip-index-url",
+        metavar="URL",
+        help="Base URL of the Python Package Index",
+    )
+    p.add_argument(
+        "--pip-extra-index-url",
+        metavar="URL",
+        help="Extra URLs of package indexes to use in addition to --pip-index-url",
+    )
+    p.add_argument(
+        "--pip-batch",
+        action="store_true",
+        default=True,
+        help=(
+            "Install all pip dependencies with a single pip call, falling "
+            "back to one call per dependency on failure (default)."
+        ),
+    )
+    p.add_argument(
+        "--no-pip-batch",
+        dest="pip_batch",
+        action="store_false",
+        help="Install pip dependencies with one pip call per dependency.",
+    )
+    p.add_argument(
+        "--pip-backend",
+        choices=["pip", "uv"],
+        default="pip",
+        help=(
+            "Install pip dependencies with pip or, if found in the "
+            "installation or on the PATH, with uv (parallel downloads and a "
+            "global cache hardlinked into the installation)."
+        ),
+    )
+    p.add_argument(
+        "--conda-dependencies",
+        metavar="LIST",
+        default="",
+        help="Comma-separated list of conda requirements.",
+    )
+    p.add_argument(
+        "--conda-dependencies-path",
+        metavar="PATH",
+        help=(
+            "Path of a conda dependencies file, usually named requirements.txt. "
+            "(This is not for creating a conda environment "
+            "with something like environment.yml!)"
+        ),
+    )
+    p.add_argument(
+        "--conda-environment-path",
+        metavar="PATH",
+        help="Path of a conda environment file, usually named environment.yml.",
+    )
+    p.add_argument(
+        "--conda-channel",
+        metavar="NAME",
+        default="conda-forge",
+        help="Conda channel to install conda dependencies from.",
+    )
+    p.add_argument(
+        "--conda-backend",
+        choices=list(CONDA_BACKENDS),
+        default="classic",
+        help=(
+            "How to run conda steps: classic conda, conda with the libmamba "
+            "solver, mamba, or a standalone micromamba creating the "
+            "installation without the Miniconda installer."
+        ),
+    )
+    p.add_argument(
+        "--conda-single-solve",
+        action="store_true",
+        help=(
+            "Update conda and install all conda dependencies in a single "
+            "transaction (before any pip dependencies)."
+        ),
+    )
+    p.add_argument(
+        "--slim",
+        action="store_true",
+        help=(
+            "Finally remove conda packages, index caches and the pip cache "
+            "(unless in --shared-cache) and hardlink identical files, "
+            "reporting the bytes saved."
+        ),
+    )
+    p.add_argument(
+        "--slim-extras",
+        metavar="LIST",
+        default="",
+        help=(
+            "Comma-separated list of what --slim removes in addition: tests "
+            "(test directories of Python packages), static-libs (lib/*.a)."
+        ),
+    )
+    p.add_argument(
+        "--precompile",
+        action="store_true",
+        help=(
+            "Finally compile all modules in site-packages to bytecode on all "
+            "cores, skipping compiled ones, so first imports are fast."
+        ),
+    )
+    p.add_argument(
+        "--pyc-invalidation-mode",
+        choices=["timestamp", "checked-hash", "unchecked-hash"],
+        default="timestamp",
+        help=(
+            "How --precompile makes .pyc files be checked against their "
+            "sources, unchecked-hash suits read-only deployments "
+            "(default: timestamp)."
+        ),
+    )
+    p.add_argument(
+        "--verify",
+        action="store_true",
+        help=(
+            "Finally import every installed top-level module in fresh "
+            "interpreters of the installation, failing if any import fails, "
+            "and report the slowest imports (measured with -X importtime)."
+        ),
+    )
+    p.add_argument(
+        "--verify-jobs",
+        metavar="N",
+        type=int,
+        default=4,
+        help="Number of interpreters importing modules at a time for --verify.",
+    )
+    p.add_argument(
+        "--write-lock",
+        metavar="PATH",
+        help=(
+            "After provisioning, write a lockfile pinning the explicit conda "
+            "package URLs and the pip packages with their hashes."
+        ),
+    )
+    p.add_argument(
+        "--from-lock",
+        metavar="PATH",
+        help=(
+            "Install exactly the packages of a lockfile written with "
+            "--write-lock, without solving, instead of the dependencies."
+        ),
+    )
+    p.add_argument(
+        "--parallel",
+        metavar="N",
+        type=int,
+        default=1,
+        help=(
+            "Run up to N independent steps concurrently, prefetching pip and "
+            "conda packages while other steps run (default: 1, sequential)."
+        ),
+    )
+
+    return p
+
+
+def make_installer(args: argparse.Namespace, **kwargs) -> MinicondaInstaller:
+    """Make an installer from parsed command-line arguments.
+
+    :param kwargs: More arguments for ``MinicondaInstaller``.
+    """
+    return MinicondaInstaller(
+        dest_path=args.path,
+        verbose=args.verbose,
+        download_connections=args.download_connections,
+        cache_max_bytes=args.cache_max_bytes,
+        shared_cache=args.shared_cache,
+        revalidate=args.revalidate,
+        command_timeout=args.step_timeout,
+        mirrors=[u for u in args.mirrors.split(",") if u],
+        pip_index_mirrors=[u for u in args.pip_index_mirrors.split(",") if u],
+        conda_channel_mirrors=[
+            u for u in args.conda_channel_mirrors.split(",") if u
+        ],
+        mirror_ttl=args.mirror_ttl,
+        repo_index=args.repo_index,
+        conda_backend=args.conda_backend,
+        pip_backend=args.pip_backend,
+        skip_satisfied=args.skip_satisfied,
+        **kwargs
+    )
+
+
+def _version_key(version: str) -> tuple:
+    """Return a sort key for a version, ordered mostly like PEP 440.
+
+    Releases are compared numerically, with development releases before
+    pre-releases (``a``, ``b``, ``rc``) before the final release before
+    post-releases. Local version labels are ignored.
+
+    :raises ValueError: Is raised for versions not looking like PEP 440.
+    """
+    m = re.match(
+        r"^v?(?:(\d+)!)?(\d+(?:\.\d+)*)"
+        r"(?:[-_.]?(a|b|c|rc|alpha|beta|pre|preview)[-_.]?(\d*))?"
+        r"(?:[-_.]?(?:post|rev|r)[-_.]?(\d*)|-(\d+))?"
+        r"(?:[-_.]?dev[-_.]?(\d*))?(?:\+[a-z0-9.]*)?$",
+        version.strip().lower(),
+    )
+    if not m:
+        raise ValueError("Invalid version: %s" % version)
+    epoch, release, pre, pre_n, post_n, post_implicit, dev_n = m.groups()
+    release = [int(part) for part in release.split(".")]
+    while len(release) > 1 and release[-1] == 0:
+        release.pop()
+    post = post_n if post_n is not None else post_implicit
+    if pre:
+        rank = {"a": 0, "alpha": 0, "b": 1, "beta": 1}.get(pre, 2)
+        pre_key = (0, rank, int(pre_n or 0))
+    elif dev_n is not None and post is None:
+        pre_key = (-1,)
+    else:
+        pre_key = (1,)
+    return (
+        int(epoch or 0),
+        tuple(release),
+        pre_key,
+        (int(post or 0),) if post is not None else (-1,),
+        (0, int(dev_n or 0)) if dev_n is not None else (1,),
+    )
+
+
+def _version_matches(version: str, op: str, wanted: str) -> bool:
+    """Return if a version matches one comparison of a specifier.
+
+    :param op: One of ``==``, ``!=``, ``>=``, ``<=``, ``>``, ``<``, ``~=``
+        and ``===``, where ``==`` and ``!=`` support ``.*`` wildcards.
+    :raises ValueError: Is raised for invalid versions.
+    """
+    if op == "===":
+        return version == wanted
+    if op in ("==", "!=") and wanted.endswith(".*"):
+        prefix = tuple(int(part) for part in wanted[:-2].split("."))
+        release = list(_version_key(version)[1])
+        release += [0] * (len(prefix) - len(release))
+        matches = tuple(release[:len(prefix)]) == prefix
+        return matches if op == "==" else not matches
+    if op == "~=":
+        parts = wanted.split(".")
+        return _version_matches(version, ">=", wanted) and _version_matches(
+            version, "==", ".".join(parts[:-1]) + ".*")
+    key, wanted_key = _version_key(version), _version_key(wanted)
+    if key[:2] == wanted_key[:2]:
+        # Of the same release, see PEP 440: >V excludes post-releases of V
+        # unless V is one, and <V pre-releases unless V is one.
+        is_post, wanted_post = key[3] != (-1,), wanted_key[3] != (-1,)
+        is_pre = key[2] != (1,) or key[4] != (1,)
+        wanted_pre = wanted_key[2] != (1,) or wanted_key[4] != (1,)
+        if op == ">" and is_post and not wanted_post:
+            return False
+        if op == "<" and is_pre and not wanted_pre:
+            return False
+    return {
+        "==": key == wanted_key,
+        "!=": key != wanted_key,
+        ">=": key >= wanted_key,
+        "<=": key <= wanted_key,
+        ">": key > wanted_key,
+        "<": key < wanted_key,
+    }[op]
+
+
+def pip_satisfied(requirement: str, installed: dict) -> bool:
+    """Return if a pip requirement is satisfied by the installed versions.
+
+    Only plain requirements like ``geopy`` or ``geopy>=2,<3`` are checked,
+    others with extras, environment markers, URLs or options count as not
+    satisfied.
+
+    :param requirement: The requirement.
+    :param installed: The installed versions by canonical name, see
+        ``_canonical_name()``.
+    """
+    m = re.match(
+        r"^([A-Za-z0-9][A-Za-z0-9._-]*)\s*((?:===?|!=|[<>]=?|~=)\s*"
+        r"[^,;\s]+(?:\s*,\s*(?:===?|!=|[<>]=?|~=)\s*[^,;\s]+)*)?\s*$",
+        requirement,
+    )
+    if not m:
+        return False
+    version = installed.get(_canonical_name(m.group(1)))
+    if version is None:
+        return False
+    try:
+        return all(
+            _version_matches(version, op, wanted)
+            for op, wanted in re.findall(
+                r"(===?|!=|[<>]=?|~=)\s*([^,\s]+)", m.group(2) or "")
+        )
+    except ValueError:
+        return False
+
+
+def conda_satisfied(spec: str, installed: dict) -> bool:
+    """Return if a conda match spec is satisfied by the installed versions.
+
+    Specs like ``numpy``, ``numpy=1.21``, ``numpy 1.21.*`` and
+    ``numpy>=1.20,<2|>=3`` are checked, others with channels, build
+    strings or brackets count as not satisfied.
+
+    :param spec: The match spec.
+    :param installed: The installed versions by package name.
+    """
+    m = re.match(
+        r"^([A-Za-z0-9_][A-Za-z0-9._-]*)\s*([^\s:\[]*)$", spec.strip()
+    )
+    if not m:
+        return False
+    name, constraint = m.groups()
+    version = installed.get(name.lower())
+    if version is None:
+        return False
+    if not constraint:
+        return True
+    if constraint.startswith("=") and not constraint.startswith("=="):
+        constraint = constraint[1:]
+        if "=" in constraint:
+            return False  # With a build string.
+        constraint = constraint.rstrip("*").rstrip(".") + ".*"
+    try:
+        return any(
+            all(
+                _conda_version_matches(version, part)
+                for part in alternative.split(",")
+            )
+            for alternative in constraint.split("|")
+        )
+    except ValueError:
+        return False
+
+
+def _conda_version_matches(version: str, constraint: str) -> bool:
+    """Return if a version matches a conda constraint like ``>=1.2``.
+    """
+    m = re.match(r"^(===?|!=|[<>]=?|~=)?(.+)$", constraint)
+    op, wanted = m.groups()
+    if "*" in wanted and not wanted.endswith(".*"):
+        return fnmatch(version, wanted)
+    return _version_matches(version, op or "==", wanted)
+
+
+def _canonical_name(name: str) -> str:
+    """Return the normalized form of a Python package name (PEP 503).
+    """
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _archive_name_version(filename: str) -> Optional[Tuple[str, str]]:
+    """Return the canonical name and version of a wheel or sdist filename.
+    """
+    if filename.endswith(".whl"):
+        parts = filename.split("-")
+        if len(parts) >= 5:
+            return _canonical_name(parts[0]), parts[1]
+        return None
+    m = re.match(r"^(.+)-([^-]+)\.(?:tar\.gz|tar\.bz2|zip)$", filename)
+    if m:
+        return _canonical_name(m.group(1)), m.group(2)
+    return None
+
+
+def parse_importtime(lines: Sequence[str]) -> List[Tuple[str, float, float]]:
+    """Parse the output of ``python -X importtime``.
+
+    :param lines: The output lines, others than import times are ignored.
+    :returns: The imported modules with their self and cumulative import
+        times in seconds, in the order they finished importing.
+    """
+    times = []
+    for line in lines:
+        m = re.match(
+            r"import time:\s*(\d+)\s*\|\s*(\d+)\s*\|\s*(\S+)", line
+        )
+        if m:
+            times.append((
+                m.group(3), int(m.group(1)) / 1e6, int(m.group(2)) / 1e6
+            ))
+    return times
+
+
+def _check_platform(platform_name: Optional[str], what: str):
+    """Check that something made for a conda platform fits this host.
+
+    :param platform_name: The conda platform name, like ``linux-64``.
+    :param what: What was made for it, for the error message.
+    :raises ValueError: Is raised if the platform is not the one of this host.
+    """
+    try:
+        host_platform = MicromambaBackend.platform()
+    except ValueError:
+        return
+    if platform_name and platform_name != host_platform:
+        raise ValueError("%s is for %s, not %s." % (
+            what, platform_name, host_platform))
+
+
+def _fingerprint(obj) -> str:
+    """Return the SHA-256 digest of a JSON-serializable object.
+    """
+    data = json.dumps(obj, sort_keys=True).encode("utf8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def _file_digest(path: Optional[str], algorithm: str = "sha256") -> Optional[str]:
+    """Return the digest of a file's content, if a path is given.
+    """
+    if not path:
+        return None
+    digest = hashlib.new(algorithm)
+    with Path(path).expanduser().open("rb") as f:
+        for chunk in iter(lambda: f.read(config["download_chunk_size"]), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def spec_fingerprint(
+    args: argparse.Namespace, installer_sha256: Optional[str] = None
+) -> str:
+    """Return a fingerprint of the provisioning spec given by ``args``.
+
+    This is a SHA-256 digest over the installer URL (and its digest, if
+    given), the pip and conda dependency lists, the contents of the
+    dependency and environment files, the pip index URLs and the conda
+    channel, and the ``--slim`` and ``--precompile`` options, as snapshots
+    and golden installations are saved after these final steps.
+
+    :param args: The parsed command-line arguments.
+    :param installer_sha256: The SHA-256 digest of the installer blob.
+    """
+    spec = dict(
+        installer=config["mc_base_url"] + config["mc_blob_name"],
+        pip_dependencies=args.pip_dependencies,
+        pip_index_url=args.pip_index_url,
+        pip_extra_index_url=args.pip_extra_index_url,
+        conda_dependencies=args.conda_dependencies,
+        conda_channel=args.conda_channel,
+        conda_single_solve=args.conda_single_solve,
+    )
+    if args.conda_backend != "classic":
+        spec["conda_backend"] = args.conda_backend
+    if args.slim:
+        spec["slim"] = sorted(e for e in args.slim_extras.split(",") if e)
+    if args.precompile:
+        spec["precompile"] = args.pyc_invalidation_mode
+    if installer_sha256:
+        spec["installer_sha256"] = installer_sha256
+    for name in [
+        "pip_dependencies_path",
+        "conda_dependencies_path",
+        "conda_environment_path",
+        "from_lock",
+    ]:
+        if getattr(args, name):
+            spec[name] = _file_digest(getattr(args, name))
+    return _fingerprint(spec)
+
+
+def ensure_golden_prefix(args: argparse.Namespace) -> Path:
+    """Return the golden installation for a spec, provisioning it if needed.
+
+    Golden installations live in ``args.golden_dir``, named by their
+    ``spec_fingerprint()``, and are complete when a JSON file of the same
+    name exists next to them. A lock file makes concurrent callers wait
+    for the one provisioning it.
+
+    :param args: The parsed command-line arguments.
+    :returns: The path of the golden installation.
+    """
+    root = Path(args.golden_dir).expanduser().absolute()
+    fingerprint = spec_fingerprint(args)
+    golden_path = root / fingerprint
+    marker_path = root / (fingerprint + ".json")
+    with FileLock(root / (fingerprint + ".lock")):
+        if not marker_path.exists():
+            if golden_path.exists():
+                # Left over by a failed run.
+                shutil.rmtree(str(golden_path))
+            golden_args = argparse.Namespace(**vars(args))
+            golden_args.path = str(golden_path)
+            golden_args.golden_dir = None
+            # Written for the destination, not the golden installation.
+            golden_args.write_lock = None
+            golden_args.snapshot_dir = None
+            inst = make_installer(golden_args)
+            plan_provisioning(inst, golden_args).run()
+            inst.installed_ok = False
+            marker_path.write_text(json.dumps(dict(
+                prefix=str(golden_path), created=time.time())))
+    return golden_path
+
+
+def plan_provisioning(
+    inst: MinicondaInstaller, args: argparse.Namespace
+) -> StepScheduler:
+    """Plan the provisioning steps for parsed command-line arguments.
+
+    With a golden directory and nothing installed at the destination yet,
+    the golden installation for the spec is cloned, see
+    ``ensure_golden_prefix()``, followed by the final steps and writing a
+    lockfile only. An existing installation, e.g. cloned
+    before, is updated by the steps below, using the state file cloned
+    with it.
+
+    With a bundle, everything is installed from the files in it, see
+    ``MinicondaInstaller.unpack_bundle()``, without using the network.
+
+    With ``args.slim``, ``args.precompile`` and ``args.verify``, final
+    steps reduce the footprint, see ``MinicondaInstaller.slim()``, compile
+    all modules to bytecode, see ``MinicondaInstaller.precompile()``, and
+    import all installed top-level modules, see
+    ``MinicondaInstaller.verify_imports()``, before a lockfile or snapshot
+    is written.
+
+    With a snapshot directory and nothing installed at the destination yet,
+    the installer is fetched right away to compute the
+    ``spec_fingerprint()``. If a snapshot exists for it, the only step is
+    restoring it, else a final step saves one. An existing installation is
+    updated by the steps below instead.
+
+    When running in parallel, pip and conda packages are prefetched with
+    ``pip download`` and ``conda install --download-only`` as soon as the
+    base is updated, and the install steps then run offline. The pip and
+    conda prefetches overlap with each other and the conda prefetch
+    overlaps with the pip install. The pip prefetch waits for the update,
+    which may replace the ``python`` and ``pip`` it runs.
+
+    With a lockfile to install from, its packages are installed in a single
+    step instead of updating the base and installing the dependencies.
+
+    Steps changing the installation record a fingerprint of their inputs
+    in its state file when done, and are left out if it is unchanged,
+    unless ``args.force`` is set.
+
+    :returns: The scheduler holding the steps, ready to ``run()``.
+    """
+    sched = StepScheduler(
+        max_workers=args.parallel,
+        verbose=args.verbose,
+        measure=partial(inst.measure, "step"),
+    )
+    parallel = args.parallel > 1
+
+    def add_write_lock():
+        if args.write_lock:
+            sched.add(
+                "write-lock",
+                partial(
+                    inst.write_lock,
+                    args.write_lock,
+                    index_url=args.pip_index_url,
+                    extra_index_url=args.pip_extra_index_url,
+                ),
+                list(sched.steps),
+            )
+
+    def add_final_steps():
+        if args.slim:
+            sched.add("slim", partial(
+                inst.slim, [e for e in args.slim_extras.split(",") if e]
+            ), list(sched.steps))
+        if args.precompile:
+            sched.add("precompile", partial(
+                inst.precompile, mode=args.pyc_invalidation_mode
+            ), list(sched.steps))
+        if args.verify:
+            sched.add("verify", partial(
+                inst.verify_imports, jobs=args.verify_jobs
+            ), list(sched.steps))
+
+    if args.golden_dir and not inst.is_installed():
+        sched.add("clone", lambda: inst.clone_from(ensure_golden_prefix(args)))
+        add_final_steps()
+        add_write_lock()
+        return sched
+    if args.bundle:
+        sched.add("download", inst.download)
+        sched.add("unpack", partial(inst.unpack_bundle, args.bundle),
+                  ["download"])
+        sched.add("install", inst.install_miniconda, ["unpack"])
+        sched.add("bundle-install", inst.install_bundle, ["install"])
+        add_final_steps()
+        return sched
+
+    snapshot_path = None
+    if args.snapshot_dir and not inst.is_installed():
+        # The installer digest is part of the fingerprint, so fetch it now.
+        inst.download()
+        inst.fetch_base()
+        fingerprint = spec_fingerprint(args, inst.mc_blob_sha256)
+        snapshot_dir = Path(args.snapshot_dir).expanduser().absolute()
+        snapshot_path = snapshot_dir / fingerprint
+        meta = find_snapshot(snapshot_path)
+        if meta:
+            sched.add("restore", partial(inst.restore_from, meta))
+            add_final_steps()
+            return sched
+
+    pip_dependencies = (
+        args.pip_dependencies.split(",") if args.pip_dependencies else None
+    )
+    conda_dependencies = (
+        args.conda_dependencies.split(",") if args.conda_dependencies else None
+    )
+    pip_path = args.pip_dependencies_path
+    conda_path = args.conda_dependencies_path
+    env_path = args.conda_environment_path
+
+    def add_step(name, func, requires=(), inputs=None):
+        """Add a step unless its inputs are unchanged since the last run.
+        """
+        requires = [r for r in requires if r in sched.steps]
+        if inputs is not None:
+            fingerprint = _fingerprint(inputs)
+            if not args.force and inst.is_step_current(name, fingerprint):
+                if args.verbose:
+                    print("Skipping step %s, its inputs are unchanged." % name)
+                inst.log("# skipped %s, inputs unchanged" % name)
+                return False
+            func = partial(inst.run_recorded, name, fingerprint, func)
+        sched.add(name, func, requires)
+        return True
+
+    sched.add("download", inst.download)
+    if not inst.is_installed():
+        sched.add("fetch", inst.fetch_base, ["download"])
+    add_step("install", inst.install_miniconda, ["download", "fetch"])
+    installed = "install"
+    if inst.shared_cache_path:
+        sched.add("shared-cache", inst.configure_shared_cache, ["install"])
+        installed = "shared-cache"
+
+    if args.from_lock:
+        # The lockfile pins everything, so there is nothing to solve.
+        add_step("from-lock", partial(inst.install_from_lock, args.from_lock),
+                 [installed], dict(lock=_file_digest(args.from_lock)))
+    else:
+        conda_inputs = dict(
+            channel=args.conda_channel,
+            dependencies=conda_dependencies,
+            dependencies_file=_file_digest(conda_path),
+        )
+        # The backend installs its packages into base when updating it.
+        base_packages = inst.conda_backend.base_packages
+        if args.conda_single_solve:
+            add_step("update", partial(
+                inst.provision_conda,
+                channel=args.conda_channel,
+                dependencies=conda_dependencies,
+                dependencies_path=conda_path,
+            ), [installed], dict(
+                conda_inputs, single_solve=True, base_packages=base_packages
+            ))
+            has_conda = False
+        else:
+            add_step("update", inst.update_miniconda_base, [installed],
+                     dict(base_packages=base_packages))
+            has_conda = bool(conda_dependencies or conda_path)
+
+        pip_inputs = dict(
+            dependencies=pip_dependencies,
+            dependencies_file=_file_digest(pip_path),
+            index_url=args.pip_index_url,
+            extra_index_url=args.pip_extra_index_url,
+        )
+        run_pip = bool(pip_dependencies or pip_path) and (
+            args.force or not inst.is_step_current("pip", _fingerprint(pip_inputs))
+        )
+        if run_pip and parallel:
+            add_step("prefetch-pip", partial(
+                inst.prefetch_pip,
+                dependencies=pip_dependencies,
+                dependencies_path=pip_path,
+                index_url=args.pip_index_url,
+                extra_index_url=args.pip_extra_index_url,
+            ), [installed, "update"])
+        if pip_dependencies or pip_path:
+            add_step("pip", partial(
+                inst.install_pip,
+                dependencies=pip_dependencies,
+                dependencies_path=pip_path,
+                index_url=args.pip_index_url,
+                extra_index_url=args.pip_extra_index_url,
+                batch=args.pip_batch,
+                find_links=str(inst.wheelhouse_path) if parallel else None,
+            ), [installed, "update", "prefetch-pip"], pip_inputs)
+
+        conda_inputs["environment_file"] = _file_digest(env_path)
+        if not has_conda:
+            conda_inputs.update(dependencies=None, dependencies_file=None)
+        run_conda = bool(has_conda or env_path) and (
+            args.force
+            or not inst.is_step_current("conda", _fingerprint(conda_inputs))
+        )
+        if run_conda and has_conda and parallel:
+            add_step("prefetch-conda", partial(
+                inst.prefetch_conda,
+                channel=args.conda_channel,
+                dependencies=conda_dependencies,
+                dependencies_path=conda_path,
+            ), [installed, "update"])
+        if has_conda or env_path:
+            add_step("conda", partial(
+                inst.install_conda,
+                channel=args.conda_channel,
+                dependencies=conda_dependencies if has_conda else None,
+                dependencies_path=conda_path if has_conda else None,
+                environment_path=env_path,
+                offline=parallel,
+            ), [installed, "update", "pip", "prefetch-conda"], conda_inputs)
+    add_final_steps()
+    add_write_lock()
+    if snapshot_path:
+        sched.add(
+            "snapshot",
+            partial(inst.save_snapshot, snapshot_path),
+            list(sched.steps),
+        )
+    return sched
+
+
+def format_profile(events: List[dict]) -> str:
+    """Format a breakdown of timing events, longest first, for ``--profile``.
+
+    Events with the same kind and name, e.g. of several installations, are
+    summed up.
+
+    :param events: The events as collected by ``MinicondaInstaller.measure()``.
+    :returns: The report as a multi-line string.
+    """
+    totals = OrderedDict()
+    for event in events:
+        key = (event["kind"], event["name"])
+        total = totals.setdefault(key, dict(
+            count=0, duration=0.0, bytes=0, peak_rss=0, failed=0))
+        total["count"] += 1
+        total["duration"] += event["duration"]
+        total["bytes"] += event["bytes"]
+        total["peak_rss"] = max(total["peak_rss"], event["peak_rss"] or 0)
+        total["failed"] += 1 if event["status"] else 0
+    step_time = sum(
+        total["duration"] for (kind, _), total in totals.items()
+        if kind == "step"
+    )
+    lines = ["Profile (%.1f s in steps):" % step_time]
+    for (kind, name), total in sorted(
+        totals.items(), key=lambda item: -item[1]["duration"]
+    ):
+        line = "  %-7s %7.1f s %5.1f%%  %-30s" % (
+            kind,
+            total["duration"],
+            100 * total["duration"] / step_time if step_time else 0,
+            name if len(name) <= 30 else name[:27] + "...",
+        )
+        if total["count"] > 1:
+            line += "  x%d" % total["count"]
+        if total["bytes"]:
+            line += "  %.1f MiB at %.1f MiB/s" % (
+                total["bytes"] / 2 ** 20,
+                total["bytes"] / 2 ** 20 / max(total["duration"], 1e-6),
+            )
+        if total["peak_rss"]:
+            line += "  peak RSS %.0f MiB" % (total["peak_rss"] / 2 ** 20)
+        if total["failed"]:
+            line += "  (%d failed)" % total["failed"]
+        lines.append(line.rstrip())
+    return "\n".join(lines)
+
+
+# Steps mostly waiting for the network, the others mostly use CPU and disk.
+NETWORK_STEPS = {"fetch", "update", "prefetch-pip", "prefetch-conda"}
+
+
+def _with_semaphore(semaphore, func: Callable):
+    with semaphore:
+        func()
+
+
+def _provision_worker(args: argparse.Namespace, network, disk) -> dict:
+    """Provision one installation of a fleet, in a worker process.
+
+    :param args: The parsed command-line arguments of this installation.
+    :param network: A semaphore limiting network-bound steps.
+    :param disk: A semaphore limiting CPU/disk-bound steps.
+    :returns: A dict with ``path``, ``ok``, ``error``, ``duration``, step
+        ``timings`` and timing ``events``.
+    """
+    started = time.monotonic()
+    result = dict(path=args.path, ok=False, error=None, timings={}, events=[])
+    inst = None
+    try:
+        inst = make_installer(args)
+        sched = plan_provisioning(inst, args)
+        for name, (func, requires) in list(sched.steps.items()):
+            semaphore = network if name in NETWORK_STEPS else disk
+            sched.steps[name] = (
+                partial(_with_semaphore, semaphore, func), requires
+            )
+        result["timings"] = dict(sched.run())
+        result["ok"] = True
+    except Exception as err:
+        result["error"] = "%s: %s" % (type(err).__name__, err)
+    if inst is not None:
+        result["events"] = inst.events
+        inst.close()
+    result["duration"] = time.monotonic() - started
+    return result
+
+
+def fleet_specs(args: argparse.Namespace) -> List[argparse.Namespace]:
+    """Return the arguments for each installation of a fleet.
+
+    :param args: The parsed arguments of ``mcinstall fleet``.
+    :raises ValueError: Is raised for invalid manifest entries.
+    """
+    specs = []
+    for path in args.paths:
+        spec = argparse.Namespace(**vars(args))
+        spec.path = path
+        specs.append(spec)
+    if args.manifest:
+        manifest = json.loads(Path(args.manifest).expanduser().read_text())
+        for entry in manifest:
+            spec = argparse.Namespace(**vars(args))
+            for key, value in entry.items():
+                key = key.replace("-", "_")
+                if key != "path" and (
+                    not hasattr(spec, key) or key in ("paths", "manifest")
+                ):
+                    raise ValueError("Unknown manifest option: %s" % key)
+                if isinstance(value, list):
+                    value = ",".join(value)
+                setattr(spec, key, value)
+            if not getattr(spec, "path", None):
+                raise ValueError("Manifest entry without path: %s" % entry)
+            specs.append(spec)
+    return specs
+
+
+def fleet_main(argv: List[str]) -> int:
+    """Provision many installations in parallel, for ``mcinstall fleet``.
+
+    The installer is fetched once up front (it only depends on the host),
+    and the installations are then provisioned on a process pool, using the
+    cached installer without revalidation. A summary of timings and
+    failures per installation is printed at the end.
+
+    :param argv: The command-line arguments after ``fleet``.
+    :returns: The exit status, non-zero if any installation failed.
+    """
+    p = make_parser(fleet=True)
+    args = p.parse_args(argv)
+    try:
+        specs = fleet_specs(args)
+    except (OSError, ValueError) as err:
+        p.error(str(err))
+    if not specs:
+        p.error("No destination directories given.")
+
+    # Fetch the installer (or micromamba) once for all needing it.
+    fetchers = {}
+    for spec in specs:
+        inst = make_installer(spec)
+        if not (spec.golden_dir or spec.bundle or inst.is_installed()):
+            fetchers.setdefault(inst.conda_backend.standalone, inst)
+    for inst in fetchers.values():
+        inst.download()
+        inst.fetch_base()
+    for spec in specs:
+        spec.revalidate = False
+
+    results = []
+    started = time.monotonic()
+    manager = multiprocessing.Manager()
+    network = manager.Semaphore(max(1, args.max_network))
+    disk = manager.Semaphore(max(1, args.max_disk))
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = [
+            pool.submit(_provision_worker, spec, network, disk)
+            for spec in specs
+        ]
+        for future in futures:
+            results.append(future.result())
+    manager.shutdown()
+
+    print("Provisioned %d installations in %.1f s:" % (
+        len(results), time.monotonic() - started))
+    for result in results:
+        if result["ok"]:
+            steps = ", ".join(
+                "%s %.1f s" % item for item in result["timings"].items()
+            )
+            print("  ok   %7.1f s  %s (%s)" % (
+                result["duration"], result["path"], steps))
+        else:
+            print("  FAIL %7.1f s  %s: %s" % (
+                result["duration"], result["path"], result["error"]))
+    if args.profile:
+        print(format_profile(
+            [event for result in results for event in result["events"]]
+        ))
+    return 1 if any(not r["ok"] for r in results) else 0
+
+
+def bundle_main(argv: List[str]) -> int:
+    """Provision a staging installation and bundle it, for ``mcinstall bundle``.
+
+    The staging installation is provisioned like by ``main()``, and then
+    the installer, conda packages and pip archives it needs are written
+    to the ``--output`` bundle, see ``MinicondaInstaller.build_bundle()``.
+
+    :param argv: The command-line arguments after ``bundle``.
+    :returns: The exit status.
+    """
+    args = make_parser(bundle=True).parse_args(argv)
+    inst = make_installer(args)
+    sched = plan_provisioning(inst, args)
+    sched.add("bundle", partial(
+        inst.build_bundle,
+        args.output,
+        index_url=args.pip_index_url,
+        extra_index_url=args.pip_extra_index_url,
+    ), list(sched.steps))
+    try:
+        sched.run()
+    finally:
+        if args.profile:
+            print(format_profile(inst.events))
+    return 0
+
+
+# Options holding paths, made absolute by clients of ``mcinstall serve``.
+PATH_OPTIONS = [
+    "path",
+    "pip_dependencies_path",
+    "conda_dependencies_path",
+    "conda_environment_path",
+    "shared_cache",
+    "golden_dir",
+    "snapshot_dir",
+    "repo_index",
+    "bundle",
+    "from_lock",
+    "write_lock",
+]
+
+# Options of a job not changing what it provisions.
+OUTPUT_OPTIONS = {"verbose", "profile", "server"}
+
+
+class ProvisionDaemon:
+    """Run provisioning jobs in the background, for ``mcinstall serve``.
+
+    Jobs run on a pool of ``jobs`` threads, with their installers sharing
+    caches and metadata in memory, see ``MinicondaInstaller``. A job
+    submitted while an identical one is queued or running is not run
+    again, the identical one is returned instead. Jobs for the same
+    destination run one after the other.
+
+    :param jobs: The number of jobs running at a time.
+    """
+
+    def __init__(self, jobs: int = 2):
+        self.jobs = OrderedDict()
+        self.in_flight = {}
+        self.shared = {}
+        self.lock = threading.Lock()
+        self.path_locks = {}
+        self.pool = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self.count = 0
+
+    def submit(self, options: dict) -> Tuple[dict, bool]:
+        """Submit a job provisioning an installation.
+
+        :param options: The options of the job, by attribute name of the
+            arguments parsed by ``make_parser()``, with ``path`` required.
+        :returns: The job and if it was in flight already.
+        :raises ValueError: Is raised for invalid options.
+        """
+        if not options.get("path"):
+            raise ValueError("Job without path.")
+        args = make_parser().parse_args([options["path"]])
+        for key, value in options.items():
+            if not hasattr(args, key):
+                raise ValueError("Unknown option: %s" % key)
+            setattr(args, key, value)
+        if args.bundle == "-":
+            raise ValueError("Cannot read a bundle from stdin of a daemon.")
+        key = _fingerprint(dict(
+            (k, v) for k, v in vars(args).items() if k not in OUTPUT_OPTIONS
+        ))
+        with self.lock:
+            if key in self.in_flight:
+                return self.jobs[self.in_flight[key]], True
+            self.count += 1
+            job = dict(
+                id=str(self.count),
+                path=args.path,
+                state="queued",
+                created=time.time(),
+                started=None,
+                ended=None,
+                steps=[],
+                error=None,
+                lines=[],
+                events=[],
+            )
+            self.jobs[job["id"]] = job
+            self.in_flight[key] = job["id"]
+            finished = [
+                j["id"] for j in self.jobs.values()
+                if j["state"] in ("done", "failed")
+            ]
+            for job_id in finished[:-config["serve_keep_jobs"] or None]:
+                del self.jobs[job_id]
+        self.pool.submit(self._run, job, args, key)
+        return job, False
+
+    def _run(self, job: dict, args: argparse.Namespace, key: str):
+        """Run a job, see ``submit()``.
+        """
+        path = os.path.realpath(os.path.expanduser(args.path))
+        with self.lock:
+            path_lock = self.path_locks.setdefault(path, threading.Lock())
+        with path_lock:
+            job.update(state="running", started=time.time())
+            inst = None
+            try:
+                inst = make_installer(
+                    args, shared=self.shared, on_log=job["lines"].append
+                )
+                job["events"] = inst.events
+                sched = plan_provisioning(inst, args)
+                job["steps"] = list(sched.steps)
+                sched.run()
+                job["state"] = "done"
+            except Exception as err:
+                job.update(state="failed", error="%s: %s" % (
+                    type(err).__name__, err))
+            finally:
+                if inst is not None:
+                    inst.close()
+                job["ended"] = time.time()
+                with self.lock:
+                    del self.in_flight[key]
+
+    def status(self, job_id: str, since: int = 0) -> Optional[dict]:
+        """Return the status of a job, ``None`` if there is no such job.
+
+        :param job_id: The job ID.
+        :param since: Leave out the log ``lines`` before this one.
+        :returns: The job with the ``done`` steps and their durations, the
+            ``duration`` so far, the log lines from ``since`` and the
+            index of the ``next`` line. Timing events are only included
+            when the job has ended.
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        status = dict(job)
+        status["done"] = OrderedDict(
+            (e["name"], e["duration"]) for e in job["events"]
+            if e["kind"] == "step" and not e["status"]
+        )
+        status["duration"] = (job["ended"] or time.time()) - (
+            job["started"] or time.time())
+        status["lines"] = job["lines"][since:]
+        status["next"] = since + len(status["lines"])
+        if not job["ended"]:
+            status["events"] = []
+        return status
+
+    def shutdown(self):
+        """Wait for all jobs to end.
+        """
+        self.pool.shutdown()
+
+
+class _DaemonHandler(BaseHTTPRequestHandler):
+    """The JSON API of ``mcinstall serve``.
+
+    ``POST /jobs`` with ``{"options": {...}}`` submits a job,
+    ``GET /jobs`` lists the jobs and ``GET /jobs/<id>?since=N`` returns the
+    status of one, see ``ProvisionDaemon``.
+
+    Requests from browsers, i.e. with an ``Origin`` or a ``Host`` other
+    than a loopback one (as after DNS rebinding), are refused, and so are
+    ``POST`` requests without a JSON body. Over TCP, requests must carry
+    the token of the daemon, see ``daemon_token()``, as a bearer token.
+    """
+
+    def _reply(self, code: int, obj):
+        data = json.dumps(obj).encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _refuse(self) -> bool:
+        """Reply with an error and return ``True`` for refused requests.
+        """
+        host = self.headers.get("Host", "")
+        host = re.sub(r":\d+$", "", host).strip("[]")
+        try:
+            loopback = host == "localhost" or ipaddress.ip_address(
+                host).is_loopback
+        except ValueError:
+            loopback = False
+        if self.headers.get("Origin") is not None or not loopback:
+            self._reply(403, dict(error="Forbidden."))
+            return True
+        token = self.server.token
+        if token and not hmac.compare_digest(
+            self.headers.get("Authorization", ""), "Bearer %s" % token
+        ):
+            self._reply(401, dict(error="Missing or wrong token."))
+            return True
+        return False
+
+    def do_GET(self):
+        if self._refuse():
+            return
+        daemon = self.server.daemon
+        url = urlparse(self.path)
+        if url.path == "/jobs":
+            self._reply(200, [
+                dict((k, job[k]) for k in ("id", "path", "state", "created"))
+                for job in list(daemon.jobs.values())
+            ])
+            return
+        m = re.match(r"^/jobs/(\w+)$", url.path)
+        since = re.search(r"\bsince=(\d+)", url.query)
+        status = m and daemon.status(
+            m.group(1), int(since.group(1)) if since else 0)
+        if status:
+            self._reply(200, status)
+        else:
+            self._reply(404, dict(error="No such job."))
+
+    def do_POST(self):
+        if self._refuse():
+            return
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.split(";")[0].strip().lower() != "application/json":
+            self._reply(415, dict(error="Expected application/json."))
+            return
+        if self.path != "/jobs":
+            self._reply(404, dict(error="Not found."))
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length).decode("utf8"))
+            job, deduped = self.server.daemon.submit(body["options"])
+        except (ValueError, KeyError, TypeError, SystemExit) as err:
+            self._reply(400, dict(error="Invalid job: %s" % err))
+            return
+        self._reply(202, dict(id=job["id"], deduped=deduped))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            print("%s %s" % (time.strftime("%H:%M:%S"), format % args))
+
+
+class _DaemonHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+if UnixStreamServer is not None:
+
+    class _DaemonUnixServer(ThreadingMixIn, UnixStreamServer):
+        daemon_threads = True
+
+
+class _UnixHTTPConnection(HTTPConnection):
+    """An HTTP connection over a Unix socket.
+    """
+
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _parse_address(address: str) -> Tuple[Optional[str], str, int]:
+    """Split a daemon address into a Unix socket path or a host and port.
+
+    Addresses with a ``/`` are socket paths, others are ``[HOST:]PORT``.
+    """
+    if "/" in address or "\\" in address:
+        return str(Path(address).expanduser()), "", 0
+    host, _, port = address.rpartition(":")
+    return None, host or "127.0.0.1", int(port)
+
+
+def daemon_token(create: bool = False) -> Optional[str]:
+    """Return the secret token of daemons listening on TCP.
+
+    It is read from ``serve_token_path`` from ``config``, which is created
+    readable and writable by its owner only if needed.
+
+    :param create: Create the token file if missing.
+    :returns: The token, ``None`` if there is no token file.
+    """
+    path = Path(config["serve_token_path"]).expanduser()
+    if create and not path.exists():
+        try:
+            fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32) + "\n")
+    try:
+        return path.read_text().strip() or None
+    except OSError:
+        return None
+
+
+def make_daemon_server(address: str, daemon: ProvisionDaemon, verbose=False):
+    """Make the HTTP server of ``mcinstall serve`` for an address.
+
+    A Unix socket is created readable and writable by its owner only,
+    replacing one left at the path only if no daemon is listening on it.
+    TCP addresses must be loopback ones, and requests to them carry the
+    ``daemon_token()``.
+
+    :param address: A Unix socket path or ``[HOST:]PORT``.
+    :param daemon: The daemon running the jobs.
+    :param verbose: Print each request.
+    :returns: The server, ready to ``serve_forever()``.
+    """
+    socket_path, host, port = _parse_address(address)
+    if socket_path:
+        if UnixStreamServer is None:
+            raise ValueError("No Unix sockets on this system.")
+        try:
+            mode = os.lstat(socket_path).st_mode
+        except FileNotFoundError:
+            mode = None
+        if mode is not None:
+            if not S_ISSOCK(mode):
+                raise ValueError(
+                    "Refusing to replace %s, which is not a socket."
+                    % socket_path)
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                os.unlink(socket_path)  # Left by a daemon not running.
+            else:
+                raise ValueError(
+                    "A daemon is listening on %s already." % socket_path)
+            finally:
+                probe.close()
+        umask = os.umask(0o177)
+        try:
+            server = _DaemonUnixServer(socket_path, _DaemonHandler)
+        finally:
+            os.umask(umask)
+        server.token = None  # Only its owner can connect.
+    else:
+        try:
+            addresses = [
+                info[4][0] for info in socket.getaddrinfo(
+                    host, port, 0, socket.SOCK_STREAM)
+            ]
+            loopback = all(
+                ipaddress.ip_address(a.split("%")[0]).is_loopback
+                for a in addresses
+            )
+        except (OSError, ValueError):
+            loopback = False
+        if not loopback:
+            raise ValueError(
+                "Refusing to listen on %s, which is not a loopback address."
+                % host)
+        server = _DaemonHTTPServer((host, port), _DaemonHandler)
+        server.token = daemon_token(create=True)
+        if not server.token:
+            server.server_close()
+            raise ValueError("Cannot read the token from %s." % (
+                config["serve_token_path"]))
+    server.daemon = daemon
+    server.verbose = verbose
+    return server
+
+
+def daemon_request(
+    address: str, method: str, path: str, body: Optional[dict] = None
+):
+    """Send a request to the JSON API of ``mcinstall serve``.
+
+    :param address: A Unix socket path or ``[HOST:]PORT``.
+    :param method: The HTTP method.
+    :param path: The path, like ``/jobs``.
+    :param body: The JSON body.
+    :returns: The JSON response.
+    :raises ValueError: Is raised for error responses.
+    """
+    socket_path, host, port = _parse_address(address)
+    timeout = config["download_timeout"]
+    if socket_path:
+        conn = _UnixHTTPConnection(socket_path, timeout=timeout)
+    else:
+        conn = HTTPConnection(host, port, timeout=timeout)
+    headers = {"Content-Type": "application/json"}
+    if not socket_path:
+        headers["Authorization"] = "Bearer %s" % daemon_token()
+    try:
+        data = json.dumps(body).encode("utf8") if body is not None else None
+        conn.request(method, path, data, headers)
+        resp = conn.getresponse()
+        result = json.loads(resp.read().decode("utf8"))
+    finally:
+        conn.close()
+    if resp.status >= 400:
+        raise ValueError(result.get("error", "HTTP error %d" % resp.status))
+    return result
+
+
+def serve_main(argv: List[str]) -> int:
+    """Run a provisioning daemon, for ``mcinstall serve``.
+
+    :param argv: The command-line arguments after ``serve``.
+    :returns: The exit status.
+    """
+    p = argparse.ArgumentParser(
+        prog="mcinstall serve",
+        description=(
+            "Run a daemon provisioning installations for 'mcinstall "
+            "--server', keeping caches and metadata in memory."
+        ),
+    )
+    p.add_argument(
+        "--listen",
+        metavar="ADDRESS",
+        default=config["serve_address"],
+        help=(
+            "Unix socket path or [HOST:]PORT to listen on, with a loopback "
+            "HOST only (default: %s)." % config["serve_address"]
+        ),
+    )
+    p.add_argument(
+        "--jobs",
+        metavar="N",
+        type=int,
+        default=2,
+        help="Number of jobs running at a time.",
+    )
+    p.add_argument(
+        "--verbose", action="store_true", help="Print each request."
+    )
+    args = p.parse_args(argv)
+    daemon = ProvisionDaemon(jobs=args.jobs)
+    try:
+        server = make_daemon_server(args.listen, daemon, verbose=args.verbose)
+    except (OSError, ValueError) as err:
+        p.error(str(err))
+    print("Serving on %s with %d jobs at a time." % (args.listen, args.jobs))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.shutdown()
+    return 0
+
+
+def client_main(args: argparse.Namespace) -> int:
+    """Provision with a daemon, for ``mcinstall --server ADDRESS``.
+
+    The job is submitted to the daemon started with ``mcinstall serve``,
+    and its log lines are printed while it runs, like they are logged by
+    ``main()``.
+
+    :param args: The parsed command-line arguments.
+    :returns: The exit status, non-zero if the job failed.
+    """
+    options = dict(
+        (k, v) for k, v in vars(args).items() if k not in OUTPUT_OPTIONS
+    )
+    for name in PATH_OPTIONS:
+        value = options.get(name)
+        if value and value != "-" and "://" not in value:
+            options[name] = str(Path(value).expanduser().absolute())
+    job = daemon_request(args.server, "POST", "/jobs", dict(options=options))
+    if job["deduped"]:
+        print("Joining job %s in flight with the same spec." % job["id"])
+    since = 0
+    while True:
+        status = daemon_request(
+            args.server, "GET", "/jobs/%s?since=%d" % (job["id"], since)
+        )
+        for line in status["lines"]:
+            print(line)
+        since = status["next"]
+        if status["state"] in ("done", "failed"):
+            break
+        time.sleep(config["serve_poll_interval"])
+    print("Job %s %s in %.1f s: %s" % (
+        job["id"],
+        status["state"],
+        status["duration"],
+        ", ".join("%s %.1f s" % item for item in status["done"].items()),
+    ))
+    if status["error"]:
+        print(status["error"])
+    if args.profile:
+        print(format_profile(status["events"]))
+    return 0 if status["state"] == "done" else 1
+
+
+def main(argv: Optional[List[str]] = None):
+    """Main function called when used on the command-line.
+
+    Use ``mcinstall fleet ...`` to provision many installations at once,
+    see ``fleet_main()``, ``mcinstall bundle ...`` to build a bundle for
+    offline installations, see ``bundle_main()``, and ``mcinstall serve``
+    to run a daemon, see ``serve_main()``, used with ``--server``.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if config["system"] not in known_systems:
+        msg = (
+            """Don't know how to handle operating system %s'. Want to provide a patch?"""
+            % config["system"]
+        )
+        print(msg)
+        sys.exit(0)
+
+    if argv[:1] == ["fleet"]:
+        sys.exit(fleet_main(argv[1:]))
+    if argv[:1] == ["bundle"]:
+        sys.exit(bundle_main(argv[1:]))
+    if argv[:1] == ["serve"]:
+        sys.exit(serve_main(argv[1:]))
+
+    p = make_parser()
+    args = p.parse_args(argv)
+    if args.server:
+        sys.exit(client_main(args))
+
+    if args.path:
+        inst = make_installer(args)
+        try:
+            plan_provisioning(inst, args).run()
+        finally:
+            if args.profile:
+                print(format_profile(inst.events))
 
 
 if __name__ == "__main__":
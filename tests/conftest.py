@@ -0,0 +1,24 @@
+"""
+Fixtures shared by the tests.
+"""
+
+import pytest
+
+from mcinstall import config
+
+
+@pytest.fixture
+def isolated_config(tmp_path, monkeypatch):
+    """Keep the files written by ``mcinstall`` below ``tmp_path``.
+
+    Logs, events, downloads and the daemon token go there, and the
+    repository listing is not fetched.
+    """
+    monkeypatch.setitem(config, "log_path", str(tmp_path / "mcinstall.log"))
+    monkeypatch.setitem(
+        config, "events_path", str(tmp_path / "events.jsonl")
+    )
+    monkeypatch.setitem(config, "downloads_dir", str(tmp_path / "dl"))
+    monkeypatch.setitem(config, "mc_index_url", None)
+    monkeypatch.setitem(config, "serve_token_path", str(tmp_path / "token"))
+    return config
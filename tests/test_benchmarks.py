@@ -0,0 +1,47 @@
+"""
+Smoke-test the offline benchmark suite with a tiny configuration.
+"""
+
+import json
+import platform
+import runpy
+from pathlib import Path
+
+import pytest
+
+import mcinstall
+
+
+BENCH_PATH = Path(__file__).absolute().parent.parent / "benchmarks" / (
+    "bench_mcinstall.py"
+)
+
+
+@pytest.mark.skipif(
+    platform.system() == "Windows", reason="The fake installer needs bash."
+)
+def test_bench_mcinstall_reports_json(tmp_path, monkeypatch):
+    # The benchmark changes the global config, restore it afterwards.
+    monkeypatch.setattr(mcinstall, "config", dict(mcinstall.config))
+    bench = runpy.run_path(str(BENCH_PATH))
+    output = tmp_path / "bench.json"
+    bench["main"]([
+        "--size", "300K",
+        "--bandwidth", "10M",
+        "--connections", "1,2",
+        "--stub-delay", "0",
+        "--packages", "2",
+        "--parallel", "2",
+        "--repeat", "1",
+        "--output", str(output),
+    ])
+    report = json.loads(output.read_text())
+    results = report["results"]
+    assert [r["benchmark"] for r in results] == [
+        "download", "download", "revalidate", "provision", "provision",
+    ]
+    assert results[0]["bytes"] == 300 * 1024
+    assert results[0]["throughput_mib_s"] > 0
+    assert results[0]["python_peak_bytes"] > 0
+    assert results[3]["overhead_seconds"] >= 0
+    assert set(results[4]["steps"]) >= {"fetch", "install", "pip", "conda"}
@@ -0,0 +1,450 @@
+"""
+Test downloading installer blobs from a local HTTP server (no internet needed).
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from mcinstall import (
+    InstallerCache,
+    MinicondaInstaller,
+    config,
+    parse_repo_index,
+    resolve_installer,
+)
+
+
+BLOB = os.urandom(3 * 1024 * 1024 + 123)
+
+LISTING = """<table>
+<tr><th>Filename</th><th>Size</th><th>Last Modified</th><th>SHA256</th></tr>
+<tr>
+  <td><a href="Miniconda3-latest-Linux-x86_64.sh">Miniconda3-latest-Linux-x86_64.sh</a></td>
+  <td class="s">3.0M</td>
+  <td>2020-11-23 14:40:28</td>
+  <td>%(sha256)s</td>
+</tr>
+<tr>
+  <td><a href="Miniconda3-py39_4.9.2-Linux-x86_64.sh">Miniconda3-py39_4.9.2-Linux-x86_64.sh</a></td>
+  <td class="s">3.0M</td>
+  <td>2020-11-23 14:40:28</td>
+  <td>%(sha256)s</td>
+</tr>
+<tr>
+  <td><a href="Miniconda3-4.7.12-Linux-x86_64.sh">Miniconda3-4.7.12-Linux-x86_64.sh</a></td>
+  <td class="s">71.0M</td>
+  <td>2019-10-24 17:50:45</td>
+  <td>0dba759b8ecfc8948f626fa18785e3d8</td>
+</tr>
+</table>
+""" % dict(sha256=hashlib.sha256(BLOB).hexdigest())
+
+
+class BlobHandler(BaseHTTPRequestHandler):
+    """Serve ``BLOB`` for any path, honouring ``Range`` if enabled."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        if self.server.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(BLOB)))
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers, path=self.path))
+        time.sleep(server.latency)
+        if server.error:
+            self.send_error(server.error)
+            return
+        if self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        data = BLOB
+        rng = self.headers.get("Range")
+        if self.headers.get("If-Range", server.etag) != server.etag:
+            rng = None  # Changed since, send all of it.
+        if rng and server.accept_ranges:
+            start, _, end = rng.split("=")[1].partition("-")
+            end = int(end) if end else len(data) - 1
+            data = data[int(start):end + 1]
+            self.send_response(206)
+            self.send_header(
+                "Content-Range",
+                "bytes %s-%d/%d" % (start, end, len(BLOB)),
+            )
+        else:
+            self.send_response(200)
+        if server.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", server.etag)
+        if server.last_modified:
+            self.send_header("Last-Modified", server.last_modified)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if server.stall_after is not None:
+            self.wfile.write(data[:server.stall_after])
+            self.wfile.flush()
+            time.sleep(2)
+            return
+        self.wfile.write(data)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), BlobHandler)
+    httpd.requests = []
+    httpd.accept_ranges = True
+    httpd.etag = '"v1"'
+    httpd.last_modified = None
+    httpd.error = None
+    httpd.latency = 0
+    httpd.stall_after = None
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = "http://127.0.0.1:%d/" % httpd.server_port
+    return httpd
+
+
+def stop_server(httpd):
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    httpd = start_server()
+    yield httpd
+    stop_server(httpd)
+
+
+@pytest.fixture
+def mirror():
+    httpd = start_server()
+    yield httpd
+    stop_server(httpd)
+
+
+@pytest.fixture
+def installer(isolated_config, tmp_path, monkeypatch):
+    monkeypatch.setitem(config, "download_chunk_size", 64 * 1024)
+    return MinicondaInstaller(str(tmp_path / "mc3"))
+
+
+def test_download_file_streams_and_hashes(server, installer, tmp_path):
+    path = tmp_path / "blob.sh"
+    digest = installer.download_file(server.url + "blob.sh", path)
+    assert path.read_bytes() == BLOB
+    assert digest == hashlib.sha256(BLOB).hexdigest()
+    assert not Path(str(path) + ".part").exists()
+    log = (tmp_path / "mcinstall.log").read_text()
+    assert "# sha256 %s blob.sh" % digest in log
+    assert "MiB/s" in log
+
+
+def test_download_file_resumes_part_file(server, installer, tmp_path):
+    path = tmp_path / "blob.sh"
+    Path(str(path) + ".part").write_bytes(BLOB[:1000])
+    Path(str(path) + ".part.json").write_text(json.dumps(dict(
+        url=server.url + "blob.sh", validator='"v1"')))
+    digest = installer.download_file(server.url + "blob.sh", path)
+    assert server.requests[-1]["Range"] == "bytes=1000-"
+    assert server.requests[-1]["If-Range"] == '"v1"'
+    assert path.read_bytes() == BLOB
+    assert digest == hashlib.sha256(BLOB).hexdigest()
+    assert not Path(str(path) + ".part.json").exists()
+
+
+@pytest.mark.parametrize("validator", ['"v0"', None])
+def test_download_file_restarts_changed_part_file(
+    server, installer, tmp_path, validator
+):
+    path = tmp_path / "blob.sh"
+    Path(str(path) + ".part").write_bytes(b"old release" * 100)
+    if validator:
+        Path(str(path) + ".part.json").write_text(json.dumps(dict(
+            url=server.url + "blob.sh", validator=validator)))
+    digest = installer.download_file(server.url + "blob.sh", path)
+    assert path.read_bytes() == BLOB
+    assert digest == hashlib.sha256(BLOB).hexdigest()
+    # Without a validator, the part file is not resumed at all.
+    assert ("Range" in server.requests[-1]) is bool(validator)
+
+
+def test_download_file_restarts_without_range_support(
+    server, installer, tmp_path
+):
+    server.accept_ranges = False
+    path = tmp_path / "blob.sh"
+    Path(str(path) + ".part").write_bytes(b"garbage")
+    digest = installer.download_file(server.url + "blob.sh", path)
+    assert path.read_bytes() == BLOB
+    assert digest == hashlib.sha256(BLOB).hexdigest()
+
+
+def test_download_file_segmented(server, installer, tmp_path):
+    installer.download_connections = 4
+    path = tmp_path / "blob.sh"
+    digest = installer.download_file(server.url + "blob.sh", path)
+    ranges = sorted(r["Range"] for r in server.requests if "Range" in r)
+    assert len(ranges) == 4
+    assert path.read_bytes() == BLOB
+    assert digest == hashlib.sha256(BLOB).hexdigest()
+
+
+def test_download_file_segmented_falls_back(server, installer, tmp_path):
+    server.accept_ranges = False
+    installer.download_connections = 4
+    path = tmp_path / "blob.sh"
+    digest = installer.download_file(server.url + "blob.sh", path)
+    assert len(server.requests) == 1
+    assert "Range" not in server.requests[0]
+    assert digest == hashlib.sha256(BLOB).hexdigest()
+
+
+def test_fetch_installer_revalidates_latest(
+    server, installer, tmp_path, monkeypatch
+):
+    monkeypatch.setitem(config, "mc_base_url", server.url)
+    monkeypatch.setitem(config, "mc_blob_name", "Miniconda3-latest-Linux.sh")
+    path = installer.fetch_installer()
+    assert path.read_bytes() == BLOB
+    assert path.name == hashlib.sha256(BLOB).hexdigest() + ".sh"
+
+    # Unchanged: a single conditional request answered with 304.
+    del server.requests[:]
+    assert installer.fetch_installer() == path
+    assert len(server.requests) == 1
+    assert server.requests[0]["If-None-Match"] == '"v1"'
+
+    # Changed: downloaded again.
+    server.etag = '"v2"'
+    del server.requests[:]
+    installer.fetch_installer()
+    assert len(server.requests) == 2
+
+
+@pytest.mark.parametrize("error, cached", [
+    (503, True), (403, True), (404, False), (410, False),
+])
+def test_fetch_installer_revalidation_errors(
+    server, installer, monkeypatch, error, cached
+):
+    monkeypatch.setitem(config, "mc_base_url", server.url)
+    monkeypatch.setitem(config, "mc_blob_name", "Miniconda3-latest-Linux.sh")
+    path = installer.fetch_installer()
+    server.error = error
+    if cached:
+        assert installer.fetch_installer() == path
+    else:
+        with pytest.raises(ValueError, match="Cannot revalidate"):
+            installer.fetch_installer()
+
+
+def test_fetch_installer_pinned_skips_revalidation(
+    server, installer, monkeypatch
+):
+    monkeypatch.setitem(config, "mc_base_url", server.url)
+    monkeypatch.setitem(config, "mc_blob_name", "Miniconda3-4.7.12-Linux.sh")
+    installer.fetch_installer()
+    del server.requests[:]
+    installer.fetch_installer()
+    assert server.requests == []
+
+
+def test_fetch_installer_concurrently_downloads_once(
+    server, installer, tmp_path, monkeypatch
+):
+    monkeypatch.setitem(config, "mc_base_url", server.url)
+    monkeypatch.setitem(config, "mc_blob_name", "Miniconda3-4.7.12-Linux.sh")
+    server.latency = 0.3
+    installers = [installer, MinicondaInstaller(str(tmp_path / "other"))]
+    results = []
+    threads = [
+        threading.Thread(target=lambda i=i: results.append(i.fetch_installer()))
+        for i in installers
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 2 and results[0] == results[1]
+    assert results[0].read_bytes() == BLOB
+    assert len(server.requests) == 1
+
+
+def test_installer_cache_evicts_least_recently_used(tmp_path):
+    cache = InstallerCache(tmp_path, max_bytes=250)
+    for i, name in enumerate(["a.sh", "b.sh", "c.sh"]):
+        blob = tmp_path / name
+        blob.write_bytes(bytes([i]) * 100)
+        digest = hashlib.sha256(blob.read_bytes()).hexdigest()
+        cache.add(name, blob, dict(sha256=digest))
+    assert cache.get("a.sh") is None
+    assert cache.get("b.sh") is not None
+    assert cache.get("c.sh") is not None
+    assert len(list((tmp_path / "blobs").iterdir())) == 2
+
+
+def test_rank_mirrors_by_latency_and_cache(server, mirror, installer):
+    server.latency = 0.3
+    urls = [server.url, mirror.url]
+    assert installer.rank_mirrors(urls, "blob.sh") == [mirror.url, server.url]
+    assert mirror.requests[0]["Range"] == "bytes=0-%d" % (
+        config["mirror_probe_bytes"] - 1
+    )
+    # The ranking is cached.
+    del server.requests[:], mirror.requests[:]
+    assert installer.rank_mirrors(urls, "blob.sh") == [mirror.url, server.url]
+    assert server.requests == mirror.requests == []
+
+    installer.mirror_ranking.ttl = 0
+    stop_server(mirror)
+    assert installer.rank_mirrors(urls, "blob.sh") == [server.url, mirror.url]
+
+
+def test_download_file_fails_over_to_mirror(
+    server, mirror, installer, tmp_path, monkeypatch
+):
+    monkeypatch.setitem(config, "stall_timeout", 0.5)
+    server.stall_after = 1000
+    # Mirrors have their own ETags, but the same date.
+    mirror.etag = '"m1"'
+    server.last_modified = mirror.last_modified = (
+        "Mon, 23 Nov 2020 14:40:28 GMT"
+    )
+    path = tmp_path / "blob.sh"
+    digest = installer.download_file(
+        server.url + "blob.sh", path, mirrors=[mirror.url + "blob.sh"]
+    )
+    assert path.read_bytes() == BLOB
+    assert digest == hashlib.sha256(BLOB).hexdigest()
+    assert len(server.requests) == 1
+    assert mirror.requests[0]["Range"] == "bytes=1000-"
+    assert "If-Range" not in mirror.requests[0]
+    log = (tmp_path / "mcinstall.log").read_text()
+    assert "# download interrupted: " in log
+
+
+@pytest.mark.parametrize("checksum", [None, "good", "bad"])
+def test_download_file_fails_over_to_other_mirror_file(
+    server, mirror, installer, tmp_path, monkeypatch, checksum
+):
+    monkeypatch.setitem(config, "stall_timeout", 0.5)
+    server.stall_after = 1000
+    mirror.etag = '"m1"'
+    server.last_modified = "Mon, 23 Nov 2020 14:40:28 GMT"
+    mirror.last_modified = "Tue, 24 Nov 2020 09:12:00 GMT"
+    path = tmp_path / "blob.sh"
+    if checksum == "good":
+        checksum = hashlib.sha256(BLOB).hexdigest()
+    elif checksum == "bad":
+        # The resumed file does not match, so it is fetched again.
+        checksum = hashlib.sha256(b"other").hexdigest()
+    digest = installer.download_file(
+        server.url + "blob.sh",
+        path,
+        mirrors=[mirror.url + "blob.sh"],
+        checksum=checksum,
+    )
+    assert path.read_bytes() == BLOB
+    assert digest == hashlib.sha256(BLOB).hexdigest()
+    ranges = [r.get("Range") for r in mirror.requests]
+    if checksum == digest:
+        assert ranges == ["bytes=1000-"]
+    else:
+        # Another date without a checksum or a mismatch, it starts over.
+        assert ranges == ["bytes=1000-", None]
+
+
+def test_fetch_installer_from_fastest_mirror(
+    server, mirror, installer, monkeypatch
+):
+    monkeypatch.setitem(config, "mc_base_url", server.url)
+    monkeypatch.setitem(config, "mc_blob_name", "Miniconda3-4.7.12-Linux.sh")
+    server.latency = 0.3
+    installer.mirrors = [mirror.url]
+    path = installer.fetch_installer()
+    assert path.read_bytes() == BLOB
+    assert "Range" not in mirror.requests[-1]
+    assert len(server.requests) == 1
+    entry = installer.cache.get("Miniconda3-4.7.12-Linux.sh")
+    assert entry["url"] == server.url + "Miniconda3-4.7.12-Linux.sh"
+    assert entry["source"] == mirror.url + "Miniconda3-4.7.12-Linux.sh"
+
+
+def test_pip_index_and_conda_channel_mirrors(
+    server, mirror, installer, monkeypatch
+):
+    monkeypatch.setitem(config, "pypi_index_url", server.url + "simple")
+    monkeypatch.setitem(config, "conda_channel_url", server.url)
+    assert installer._pip_index(None) is None
+    server.latency = 0.3
+    installer.pip_index_mirrors = [mirror.url + "pypi"]
+    installer.conda_channel_mirrors = [mirror.url + "conda-forge/"]
+    assert installer._pip_index(None) == mirror.url + "pypi"
+    assert installer._conda_channel("conda-forge") == mirror.url + "conda-forge"
+    paths = sorted(r["path"] for r in mirror.requests)
+    assert paths == ["/conda-forge/noarch/repodata.json", "/pypi/pip/"]
+
+
+def test_parse_repo_index_and_resolve_latest():
+    index = parse_repo_index(LISTING)
+    assert index["Miniconda3-4.7.12-Linux-x86_64.sh"] == dict(
+        version="4.7.12",
+        size=71 * 2 ** 20,
+        modified="2019-10-24 17:50:45",
+        md5="0dba759b8ecfc8948f626fa18785e3d8",
+    )
+    name, entry = resolve_installer(index, "Miniconda3-latest-Linux-x86_64.sh")
+    assert name == "Miniconda3-py39_4.9.2-Linux-x86_64.sh"
+    assert entry["version"] == "py39_4.9.2"
+    assert entry["sha256"] == hashlib.sha256(BLOB).hexdigest()
+    assert resolve_installer(index, "Miniconda3-nope.sh") == (
+        "Miniconda3-nope.sh", None
+    )
+
+
+def test_fetch_installer_resolves_latest_and_verifies(
+    server, installer, tmp_path, monkeypatch
+):
+    monkeypatch.setitem(config, "mc_base_url", server.url)
+    monkeypatch.setitem(
+        config, "mc_blob_name", "Miniconda3-latest-Linux-x86_64.sh"
+    )
+    listing = tmp_path / "listing.html"
+    listing.write_text(LISTING)
+    installer.repo_index = str(listing)
+    path = installer.fetch_installer()
+    assert installer.mc_blob_name == "Miniconda3-py39_4.9.2-Linux-x86_64.sh"
+    assert server.requests[0]["path"] == "/" + installer.mc_blob_name
+    assert path.read_bytes() == BLOB
+
+    # Pinned now, so neither revalidated nor is the listing read again.
+    listing.unlink()
+    del server.requests[:]
+    assert installer.fetch_installer() == path
+    assert server.requests == []
+
+    # A download not matching the published checksum is rejected.
+    installer.repo_index_cache.ttl = 0
+    listing.write_text(LISTING.replace(
+        hashlib.sha256(BLOB).hexdigest(), "0" * 64))
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        installer.fetch_installer()
+    assert not list(installer.cache.path.glob("*.sh"))
@@ -0,0 +1,146 @@
+"""
+Test cloning, snapshotting and relocating installation prefixes (no internet
+needed).
+"""
+
+import io
+import json
+import os
+import platform
+import tarfile
+
+import pytest
+
+import mcinstall
+from mcinstall import (
+    _binary_replace,
+    clone_prefix,
+    find_snapshot,
+    restore_snapshot,
+    save_snapshot,
+)
+
+
+def make_prefix(prefix):
+    """Make a tiny fake conda installation at ``prefix``.
+    """
+    (prefix / "bin").mkdir(parents=True)
+    (prefix / "lib").mkdir()
+    (prefix / "conda-meta").mkdir()
+    script = prefix / "bin" / "tool"
+    script.write_text("#!%s/bin/python\nprint('hi')\n" % prefix)
+    script.chmod(0o755)
+    lib = prefix / "lib" / "libfoo.so"
+    lib.write_bytes(
+        b"\x7fELF\0" + str(prefix).encode() + b"/lib\0" + b"\0" * 64 + b"end"
+    )
+    (prefix / "lib" / "data.bin").write_bytes(b"\0plain data")
+    meta = dict(paths_data=dict(paths=[
+        dict(_path="lib/libfoo.so", file_mode="binary"),
+    ]))
+    (prefix / "conda-meta" / "foo-1.0-0.json").write_text(json.dumps(meta))
+    return prefix
+
+
+def test_binary_replace_pads_with_nuls():
+    data = b"x/old/prefix/lib\0\0\0y"
+    assert _binary_replace(data, b"/old/prefix", b"/new") == (
+        b"x/new/lib\0\0\0\0\0\0\0\0\0\0y"
+    )
+    longer = _binary_replace(data, b"/old/prefix", b"/old/prefix12")
+    assert longer == b"x/old/prefix12/lib\0y"
+    with pytest.raises(ValueError):
+        _binary_replace(data, b"/old/prefix", b"/old/prefix123")
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="Needs symlinks.")
+def test_clone_prefix_relocates(tmp_path):
+    src = make_prefix(tmp_path / "golden")
+    os.symlink(str(src / "bin" / "tool"), str(src / "bin" / "tool-link"))
+    dest = tmp_path / "clone"
+    counts = clone_prefix(src, dest)
+
+    script = dest / "bin" / "tool"
+    assert script.read_text().startswith("#!%s/bin/python\n" % dest)
+    assert os.access(str(script), os.X_OK)
+    lib = (dest / "lib" / "libfoo.so").read_bytes()
+    assert str(dest).encode() + b"/lib\0" in lib
+    assert str(src).encode() not in lib
+    assert len(lib) == len((src / "lib" / "libfoo.so").read_bytes())
+    assert os.readlink(str(dest / "bin" / "tool-link")) == str(
+        dest / "bin" / "tool"
+    )
+    assert counts["relocated"] == 2
+    assert counts["reflinked"] + counts["hardlinked"] + counts["copied"] == 2
+    # The golden installation is untouched.
+    assert (src / "bin" / "tool").read_text().startswith("#!%s" % src)
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="Needs symlinks.")
+@pytest.mark.parametrize("codecs", [None, []])
+def test_snapshot_roundtrip_relocates(tmp_path, monkeypatch, codecs):
+    if codecs is not None:
+        # Force the single-core gzip fallback.
+        monkeypatch.setattr(mcinstall, "SNAPSHOT_CODECS", codecs)
+    src = make_prefix(tmp_path / "orig")
+    os.symlink("tool", str(src / "bin" / "tool-link"))
+    snapshot = save_snapshot(src, tmp_path / "snapshots" / "abc")
+    assert snapshot.name.startswith("abc.tar.")
+
+    meta = find_snapshot(tmp_path / "snapshots" / "abc")
+    assert meta["prefix"] == str(src)
+    dest = tmp_path / "restored"
+    counts = restore_snapshot(meta, dest)
+    assert counts == dict(files=4, relocated=2)
+    assert (dest / "bin" / "tool").read_text().startswith("#!%s/" % dest)
+    assert os.access(str(dest / "bin" / "tool"), os.X_OK)
+    assert os.readlink(str(dest / "bin" / "tool-link")) == "tool"
+    assert (dest / "lib" / "data.bin").read_bytes() == b"\0plain data"
+    assert str(src).encode() not in (dest / "lib" / "libfoo.so").read_bytes()
+
+
+def test_find_snapshot_missing(tmp_path):
+    assert find_snapshot(tmp_path / "nope") is None
+
+
+def write_tar(path, members):
+    """Write a gzipped tar of ``(name, linkname or data, type)`` tuples.
+    """
+    with tarfile.open(str(path), "w:gz") as tar:
+        for name, value, kind in members:
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            if kind == tarfile.REGTYPE:
+                info.size = len(value)
+                tar.addfile(info, io.BytesIO(value))
+            else:
+                info.linkname = value
+                tar.addfile(info)
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="Needs symlinks.")
+@pytest.mark.parametrize("members", [
+    [("../x", b"data", tarfile.REGTYPE)],
+    [("lib", "{outside}", tarfile.SYMTYPE)],
+    [("lib", "../../outside", tarfile.SYMTYPE)],
+    [("x", "../outside/secret", tarfile.LNKTYPE)],
+])
+def test_restore_snapshot_rejects_unsafe_members(
+    tmp_path, monkeypatch, members
+):
+    monkeypatch.setattr(mcinstall, "SNAPSHOT_CODECS", [])
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "secret").write_text("secret")
+    members = [
+        (name, value.format(outside=outside), kind)
+        if kind != tarfile.REGTYPE else (name, value, kind)
+        for name, value, kind in members
+    ]
+    snapshot = tmp_path / "evil.tar.gz"
+    write_tar(snapshot, members)
+    meta = dict(prefix="/orig", path=str(snapshot))
+    with pytest.raises(ValueError, match="Unsafe"):
+        restore_snapshot(meta, tmp_path / "restored")
+    assert os.listdir(str(outside)) == ["secret"]
+    assert (outside / "secret").read_text() == "secret"
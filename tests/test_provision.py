@@ -0,0 +1,1089 @@
+"""
+Test provisioning commands against stub ``pip`` and ``conda`` executables.
+"""
+
+import hashlib
+import io
+import json
+import platform
+import re
+import shutil
+import sys
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from pathlib import Path
+from subprocess import CalledProcessError, TimeoutExpired
+
+import pytest
+
+import mcinstall
+from mcinstall import (
+    CONDA_BACKENDS,
+    CommandError,
+    MinicondaInstaller,
+    ProvisionDaemon,
+    StepScheduler,
+    clone_prefix,
+    conda_satisfied,
+    config,
+    daemon_request,
+    ensure_golden_prefix,
+    fleet_main,
+    format_profile,
+    main,
+    make_daemon_server,
+    make_parser,
+    pip_satisfied,
+    plan_provisioning,
+    run_command,
+    spec_fingerprint,
+)
+
+
+pytestmark = pytest.mark.skipif(
+    platform.system() == "Windows", reason="Stub executables need a POSIX shell."
+)
+
+STUB = """#!%s
+import sys
+with open(%r, "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+if any("broken" in arg for arg in sys.argv[1:]):
+    sys.exit(1)
+"""
+
+
+def make_stub(prefix, name):
+    """Create ``<prefix>/bin/<name>`` logging its arguments to ``<name>.calls``.
+    """
+    bin_dir = prefix / "bin"
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    calls_path = prefix / ("%s.calls" % name)
+    stub = bin_dir / name
+    stub.write_text(STUB % (sys.executable, str(calls_path)))
+    stub.chmod(0o755)
+    return calls_path
+
+
+@pytest.fixture
+def installer(isolated_config, tmp_path):
+    return MinicondaInstaller(str(tmp_path / "mc3"))
+
+
+def test_install_pip_batch(installer, tmp_path):
+    calls = make_stub(installer.clean_dest_path, "pip")
+    reqs = tmp_path / "requirements.txt"
+    reqs.write_text("six\n")
+    installer.install_pip(
+        dependencies=["geopy", "attrs"], dependencies_path=str(reqs), batch=True
+    )
+    assert calls.read_text().splitlines() == [
+        "install geopy attrs -r %s" % reqs
+    ]
+
+
+def test_install_pip_batch_falls_back(installer):
+    calls = make_stub(installer.clean_dest_path, "pip")
+    with pytest.raises(CalledProcessError):
+        installer.install_pip(dependencies=["geopy", "broken"], batch=True)
+    assert calls.read_text().splitlines() == [
+        "install geopy broken",
+        "install geopy",
+        "install broken",
+    ]
+
+
+def test_provision_conda_single_solve(installer, tmp_path):
+    calls = make_stub(installer.clean_dest_path, "conda")
+    reqs = tmp_path / "conda-requirements.txt"
+    reqs.write_text("numpy\n")
+    installer.provision_conda(
+        channel="conda-forge",
+        dependencies=["pyyaml", "six"],
+        dependencies_path=str(reqs),
+    )
+    assert calls.read_text().splitlines() == [
+        "install -y -n base -c conda-forge -c defaults --update-specs "
+        "conda pyyaml six --file %s" % reqs
+    ]
+
+
+def test_step_scheduler_runs_independent_steps_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    order = []
+    sched = StepScheduler(max_workers=2)
+    sched.add("a", lambda: order.append("a"))
+    sched.add("b", lambda: (barrier.wait(), order.append("b")), ["a"])
+    sched.add("c", lambda: (barrier.wait(), order.append("c")), ["a"])
+    sched.add("d", lambda: order.append("d"), ["b", "c"])
+    timings = sched.run()
+    assert order[0] == "a" and order[-1] == "d"
+    assert set(timings) == {"a", "b", "c", "d"}
+
+
+def test_step_scheduler_rejects_unknown_requirements():
+    sched = StepScheduler()
+    with pytest.raises(ValueError):
+        sched.add("b", lambda: None, ["a"])
+
+
+def test_plan_provisioning_parallel_prefetches(installer, tmp_path):
+    # With stub executables the installation counts as installed already.
+    conda_calls = make_stub(installer.clean_dest_path, "conda")
+    pip_calls = make_stub(installer.clean_dest_path, "pip")
+    args = make_parser().parse_args([
+        str(tmp_path / "mc3"),
+        "--parallel", "4",
+        "--pip-dependencies", "geopy",
+        "--conda-dependencies", "pyyaml",
+    ])
+    sched = plan_provisioning(installer, args)
+    requires = dict((name, set(req)) for name, (_, req) in sched.steps.items())
+    assert "fetch" not in requires
+    assert requires["prefetch-pip"] == {"install", "update"}
+    assert requires["pip"] == {"install", "update", "prefetch-pip"}
+    assert requires["prefetch-conda"] == {"install", "update"}
+    assert requires["conda"] == {"install", "update", "pip", "prefetch-conda"}
+
+    sched.run()
+    assert pip_calls.read_text().splitlines() == [
+        "download -d %s setuptools wheel geopy" % installer.wheelhouse_path,
+        "install --no-index --find-links %s geopy" % installer.wheelhouse_path,
+    ]
+    assert conda_calls.read_text().splitlines() == [
+        "update -y -n base -c defaults conda",
+        "install -y --download-only -c conda-forge pyyaml",
+        "install --offline -y -c conda-forge pyyaml",
+    ]
+
+
+def test_prefetch_and_offline_install_use_same_channels(installer, tmp_path):
+    conda_calls = make_stub(installer.clean_dest_path, "conda")
+    reqs = tmp_path / "conda-requirements.txt"
+    reqs.write_text("numpy\n")
+    args = make_parser().parse_args([
+        str(tmp_path / "mc3"),
+        "--parallel", "2",
+        "--conda-channel", "bioconda",
+        "--conda-dependencies", "pyyaml",
+        "--conda-dependencies-path", str(reqs),
+    ])
+    plan_provisioning(installer, args).run()
+    calls = conda_calls.read_text().splitlines()
+    assert calls[1:] == [
+        "install -y --download-only -c bioconda pyyaml --file %s" % reqs,
+        "install --offline -y -c bioconda pyyaml",
+        "install --offline -y -c bioconda --file %s" % reqs,
+    ]
+
+
+def test_plan_provisioning_skips_unchanged_steps(installer, tmp_path):
+    make_stub(installer.clean_dest_path, "conda")
+    pip_calls = make_stub(installer.clean_dest_path, "pip")
+    reqs = tmp_path / "requirements.txt"
+    reqs.write_text("six\n")
+    argv = [str(tmp_path / "mc3"), "--pip-dependencies-path", str(reqs)]
+    plan_provisioning(installer, make_parser().parse_args(argv)).run()
+    assert installer.state_path.exists()
+
+    sched = plan_provisioning(installer, make_parser().parse_args(argv))
+    assert "update" not in sched.steps and "pip" not in sched.steps
+    # Another backend needs its packages installed by the update.
+    other = MinicondaInstaller(
+        str(installer.clean_dest_path), conda_backend="libmamba"
+    )
+    sched = plan_provisioning(other, make_parser().parse_args(
+        argv + ["--conda-backend", "libmamba"]
+    ))
+    assert "update" in sched.steps and "pip" not in sched.steps
+
+    reqs.write_text("six\nattrs\n")
+    sched = plan_provisioning(installer, make_parser().parse_args(argv))
+    assert "update" not in sched.steps and "pip" in sched.steps
+    sched.run()
+    assert len(pip_calls.read_text().splitlines()) == 2
+
+    sched = plan_provisioning(
+        installer, make_parser().parse_args(argv + ["--force"])
+    )
+    assert "update" in sched.steps and "pip" in sched.steps
+
+
+def test_step_and_package_events(installer, tmp_path):
+    make_stub(installer.clean_dest_path, "conda")
+    make_stub(installer.clean_dest_path, "pip")
+    args = make_parser().parse_args([
+        str(tmp_path / "mc3"), "--pip-dependencies", "geopy,broken",
+    ])
+    with pytest.raises(CalledProcessError):
+        plan_provisioning(installer, args).run()
+    installer.close()
+    lines = (tmp_path / "events.jsonl").read_text().splitlines()
+    events = [json.loads(line) for line in lines]
+    assert events == installer.events
+    names = [(e["kind"], e["name"], e["status"]) for e in events]
+    assert names == [
+        ("step", "download", 0),
+        ("step", "install", 0),
+        ("conda", "update -y -n base -c defaults conda", 0),
+        ("step", "update", 0),
+        ("pip", "geopy broken", 1),
+        ("pip", "geopy", 0),
+        ("pip", "broken", 1),
+        ("step", "pip", 1),
+    ]
+    for event in events:
+        assert event["end"] - event["start"] == pytest.approx(
+            event["duration"], abs=1e-3
+        )
+        assert event["prefix"] == str(installer.clean_dest_path)
+    assert events[2]["peak_rss"] > 0
+    assert events[3]["peak_rss"] >= events[2]["peak_rss"]
+
+    report = format_profile(events).splitlines()
+    assert report[0].startswith("Profile (")
+    assert len(report) == 1 + len(names)
+    assert len([line for line in report if "(1 failed)" in line]) == 3
+
+
+def test_shared_cache(isolated_config, tmp_path):
+    inst = MinicondaInstaller(
+        str(tmp_path / "mc3"), shared_cache=str(tmp_path / "shared")
+    )
+    inst.clean_dest_path.mkdir()
+    inst.configure_shared_cache()
+    condarc = (inst.clean_dest_path / ".condarc").read_text()
+    assert "  - %s" % (tmp_path / "shared" / "pkgs") in condarc
+    pip_conf = (inst.clean_dest_path / "pip.conf").read_text()
+    assert "cache-dir = %s" % (tmp_path / "shared" / "pip") in pip_conf
+
+    # The stub "links" two packages, one of them already in the cache.
+    (tmp_path / "shared" / "pkgs" / "six-1.0-0").mkdir()
+    conda_stub = make_stub(inst.clean_dest_path, "conda")
+    with conda_stub.parent.joinpath("bin", "conda").open("a") as f:
+        f.write(
+            "import os, pathlib\n"
+            "meta = pathlib.Path(%r)\n"
+            "meta.mkdir(exist_ok=True)\n"
+            "assert os.environ['CONDA_PKGS_DIRS'].endswith('pkgs')\n"
+            "(meta / 'six-1.0-0.json').write_text('{}')\n"
+            "(meta / 'attrs-2.0-0.json').write_text('{}')\n"
+            % str(inst.clean_dest_path / "conda-meta")
+        )
+    inst.install_conda(dependencies=["six"])
+    assert inst.cache_stats["conda"] == [1, 2]
+    log = (tmp_path / "mcinstall.log").read_text()
+    assert "# conda cache: 1 of 2 packages cached (50%)" in log
+
+
+def test_fleet_main_summary(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    paths = []
+    for name in ["a", "b", "c"]:
+        prefix = tmp_path / name
+        make_stub(prefix, "conda")
+        make_stub(prefix, "pip")
+        paths.append(str(prefix))
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps([
+        {"path": paths[2], "pip-dependencies": ["six", "broken"]},
+    ]))
+    status = fleet_main(
+        paths[:2] + ["--manifest", str(manifest), "--jobs", "2"]
+    )
+    out = capsys.readouterr().out
+    assert status == 1
+    assert "Provisioned 3 installations" in out
+    assert re.search(r"ok .* %s \(.*update" % re.escape(paths[0]), out)
+    assert re.search(r"FAIL .* %s: CommandError" % re.escape(paths[2]), out)
+    assert not (tmp_path / "a" / "pip.calls").exists()
+
+
+def test_run_command_streams_lines():
+    lines = []
+    code = "import sys; print('out'); print('err', file=sys.stderr)"
+    result = run_command(
+        [sys.executable, "-c", code], on_line=lambda *a: lines.append(a)
+    )
+    assert result.returncode == 0
+    assert sorted(lines) == [("err", "stderr"), ("out", "stdout")]
+    assert sorted(result.tail) == ["err", "out"]
+
+
+def test_run_command_in_threads():
+    code = "import sys; print(sys.argv[1])"
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(
+            lambda i: run_command([sys.executable, "-c", code, str(i)]),
+            range(8),
+        ))
+    assert [r.tail for r in results] == [[str(i)] for i in range(8)]
+
+
+def test_run_command_fails_and_times_out():
+    code = "import sys; print('boom'); sys.exit(3)"
+    with pytest.raises(CommandError) as info:
+        run_command([sys.executable, "-c", code])
+    assert info.value.returncode == 3
+    assert info.value.result.tail == ["boom"]
+    with pytest.raises(TimeoutExpired):
+        run_command(
+            [sys.executable, "-c", "import time; time.sleep(30)"], timeout=0.5
+        )
+
+
+def test_conda_backend_commands(tmp_path):
+    prefix = tmp_path / "mc3"
+    classic = CONDA_BACKENDS["classic"](prefix)
+    assert classic.command("install -y six") == "%s/bin/conda install -y six" % (
+        prefix
+    )
+    assert classic.update_args() == "update -y -n base -c defaults conda"
+    libmamba = CONDA_BACKENDS["libmamba"](prefix)
+    assert libmamba.command("install -y six") == (
+        "%s/bin/conda install --solver=libmamba -y six" % prefix
+    )
+    assert libmamba.command("env create --file e.yml").endswith(
+        "conda env create --file e.yml"
+    )
+    assert libmamba.update_args() == (
+        "install -y -n base -c defaults --update-specs conda "
+        "conda-libmamba-solver"
+    )
+    mamba = CONDA_BACKENDS["mamba"](prefix)
+    assert mamba.command("install -y six") == "%s/bin/mamba install -y six" % (
+        prefix
+    )
+    micromamba = CONDA_BACKENDS["micromamba"](prefix)
+    assert micromamba.command("install -y --update-specs six") == (
+        "%s/bin/micromamba install -y six -r %s -n base" % (prefix, prefix)
+    )
+    assert micromamba.command("env create --file e.yml") == (
+        "%s/bin/micromamba create -y --file e.yml -r %s" % (prefix, prefix)
+    )
+    assert micromamba.update_args() is None
+    with pytest.raises(ValueError):
+        MinicondaInstaller(str(prefix), conda_backend="nope")
+
+
+@pytest.mark.parametrize("backend", ["libmamba", "mamba"])
+def test_conda_backend_installed_by_update(
+    isolated_config, tmp_path, backend
+):
+    inst = MinicondaInstaller(str(tmp_path / "mc3"), conda_backend=backend)
+    conda_calls = make_stub(inst.clean_dest_path, "conda")
+    inst.update_miniconda_base()
+    assert conda_calls.read_text().splitlines() == [
+        "install -y -n base -c defaults --update-specs conda %s"
+        % inst.conda_backend.base_packages[0]
+    ]
+    # What the update installed.
+    if backend == "mamba":
+        calls = make_stub(inst.clean_dest_path, "mamba")
+    else:
+        calls = conda_calls
+        calls.write_text("")
+        meta = inst.clean_dest_path / "conda-meta"
+        meta.mkdir()
+        (meta / "conda-libmamba-solver-23.1.0-0.json").write_text("{}")
+    inst.install_conda(dependencies=["pyyaml"])
+    expected = "install -y -c conda-forge pyyaml"
+    if backend == "libmamba":
+        expected = "install --solver=libmamba -y -c conda-forge pyyaml"
+    assert calls.read_text().splitlines() == [expected]
+
+
+def test_micromamba_bootstrap(isolated_config, tmp_path):
+    # An archive with a stub micromamba logging its arguments.
+    stub_dir = tmp_path / "stub"
+    calls = make_stub(stub_dir, "micromamba")
+    archive = tmp_path / "micromamba.tar.bz2"
+    with tarfile.open(str(archive), "w:bz2") as tar:
+        tar.add(str(stub_dir / "bin" / "micromamba"), "bin/micromamba")
+
+    inst = MinicondaInstaller(str(tmp_path / "mc3"), conda_backend="micromamba")
+    inst.mc_blob_path = archive
+    assert not inst.is_installed()
+    inst.install_miniconda()
+    assert inst.is_installed()
+    inst.update_miniconda_base()
+    inst.provision_conda(dependencies=["pyyaml"])
+    prefix = inst.clean_dest_path
+    assert calls.read_text().splitlines() == [
+        "create -y -p %s -r %s -c conda-forge python pip" % (prefix, prefix),
+        "install -y -n base -c conda-forge pyyaml -r %s" % prefix,
+    ]
+
+
+def test_install_pip_with_uv(isolated_config, tmp_path):
+    inst = MinicondaInstaller(str(tmp_path / "mc3"), pip_backend="uv")
+    prefix = inst.clean_dest_path
+    pip_calls = make_stub(prefix, "pip")
+    uv_calls = make_stub(prefix, "uv")
+    inst.install_pip(
+        dependencies=["geopy", "attrs"],
+        index_url="https://pypi.example.org/simple",
+        extra_index_url="https://a.example.org,https://b.example.org",
+        batch=True,
+    )
+    assert uv_calls.read_text().splitlines() == [
+        "pip install --python %s/bin/python "
+        "--index-url https://pypi.example.org/simple "
+        "--extra-index-url https://a.example.org "
+        "--extra-index-url https://b.example.org geopy attrs" % prefix
+    ]
+    assert not pip_calls.exists()
+
+
+def test_install_pip_with_uv_falls_back_to_pip(installer, monkeypatch):
+    monkeypatch.setattr(shutil, "which", lambda name: None)
+    installer.pip_backend = "uv"
+    calls = make_stub(installer.clean_dest_path, "pip")
+    installer.install_pip(dependencies=["geopy"], batch=True)
+    assert calls.read_text().splitlines() == ["install geopy"]
+    log = Path(config["log_path"]).read_text()
+    assert "# uv not found, using pip instead" in log
+
+
+LOCK_CONDA_STUB = """#!%s
+import sys
+with open(%r, "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+if sys.argv[1] == "list":
+    print("# platform: linux-64")
+    print("@EXPLICIT")
+    print("https://conda.example.org/linux-64/six-1.16.0-0.conda#%s")
+"""
+
+SIX_MD5 = hashlib.md5(b"six").hexdigest()
+
+LOCK_PIP_STUB = """#!%s
+import os, sys
+with open(%r, "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+if sys.argv[1] == "download":
+    dest = sys.argv[sys.argv.index("-d") + 1]
+    with open(os.path.join(dest, "geopy-2.4.0-py3-none-any.whl"), "w") as f:
+        f.write("wheel")
+"""
+
+
+def make_locked_prefix(prefix):
+    """Make stubs and package metadata of a provisioned installation.
+
+    :returns: The paths of the files logging the conda and pip calls.
+    """
+    calls = {}
+    for name, stub in [("conda", LOCK_CONDA_STUB), ("pip", LOCK_PIP_STUB)]:
+        calls[name] = make_stub(prefix, name)
+        args = (sys.executable, str(calls[name]))
+        if name == "conda":
+            args += (SIX_MD5,)
+        (prefix / "bin" / name).write_text(stub % args)
+    site = prefix / "lib" / "python3.9" / "site-packages"
+    for name, version, by in [("geopy", "2.4.0", "pip"), ("six", "1.16", "conda")]:
+        info = site / ("%s-%s.dist-info" % (name, version))
+        info.mkdir(parents=True)
+        (info / "INSTALLER").write_text(by + "\n")
+        (info / "METADATA").write_text(
+            "Metadata-Version: 2.1\nName: %s\nVersion: %s\n" % (name, version))
+    return calls
+
+
+def test_write_lock_and_install_from_lock(installer, tmp_path, monkeypatch):
+    monkeypatch.setitem(config, "machine", "x86_64")
+    monkeypatch.setitem(config, "system", "Linux")
+    prefix = installer.clean_dest_path
+    calls = make_locked_prefix(prefix)
+
+    lock_path = tmp_path / "mcinstall.lock"
+    installer.write_lock(str(lock_path))
+    lock = json.loads(lock_path.read_text())
+    assert lock["platform"] == "linux-64"
+    assert lock["conda"] == [
+        "# platform: linux-64",
+        "@EXPLICIT",
+        "https://conda.example.org/linux-64/six-1.16.0-0.conda#%s" % SIX_MD5,
+    ]
+    digest = hashlib.sha256(b"wheel").hexdigest()
+    assert lock["pip"] == ["geopy==2.4.0 --hash=sha256:%s" % digest]
+
+    for path in calls.values():
+        path.unlink()
+    args = make_parser().parse_args([
+        str(prefix), "--pip-dependencies", "attrs", "--from-lock", str(lock_path)
+    ])
+    sched = plan_provisioning(installer, args)
+    assert "from-lock" in sched.steps
+    assert not {"update", "pip", "conda"} & set(sched.steps)
+    sched.run()
+    conda_call, = calls["conda"].read_text().splitlines()
+    assert conda_call.startswith("install -y -n base --file ")
+    pip_call, = calls["pip"].read_text().splitlines()
+    assert pip_call.startswith("install --no-deps --require-hashes -r ")
+
+    monkeypatch.setitem(config, "machine", "aarch64")
+    with pytest.raises(ValueError, match="linux-64"):
+        installer.install_from_lock(str(lock_path))
+
+
+INSTALLER = """#!/bin/bash
+mkdir -p "$4/bin"
+cp %s/bin/conda %s/bin/pip "$4/bin/"
+"""
+
+
+def test_bundle_roundtrip(installer, tmp_path, monkeypatch):
+    monkeypatch.setitem(config, "machine", "x86_64")
+    monkeypatch.setitem(config, "system", "Linux")
+    prefix = installer.clean_dest_path
+    calls = make_locked_prefix(prefix)
+    (prefix / "pkgs").mkdir()
+    (prefix / "pkgs" / "six-1.16.0-0.conda").write_bytes(b"six")
+    (prefix / "conda-meta").mkdir()
+    (prefix / "conda-meta" / "six-1.16.0-0.json").write_text(json.dumps(dict(
+        name="six", version="1.16.0", build="0", depends=["python"],
+        fn="six-1.16.0-0.conda", files=["lib/six.py"])))
+    blob = tmp_path / "Miniconda3-latest-Linux-x86_64.sh"
+    blob.write_text(INSTALLER % (prefix, prefix))
+    installer.mc_blob_path = blob
+    installer.mc_blob_name = blob.name
+    bundle = installer.build_bundle(str(tmp_path / "mc3.bundle"))
+
+    with tarfile.open(str(bundle)) as tar:
+        names = tar.getnames()
+        manifest = json.loads(tar.extractfile("manifest.json").read().decode())
+        repodata = json.loads(
+            tar.extractfile("channel/linux-64/repodata.json").read().decode())
+    assert names[0] == "manifest.json"
+    assert set(names[1:]) == set(manifest["files"]) == {
+        "installer/%s" % blob.name,
+        "channel/linux-64/repodata.json",
+        "channel/noarch/repodata.json",
+        "channel/linux-64/six-1.16.0-0.conda",
+        "wheels/geopy-2.4.0-py3-none-any.whl",
+    }
+    assert manifest["pip"] == ["geopy==2.4.0"]
+    assert repodata["packages.conda"]["six-1.16.0-0.conda"]["depends"] == [
+        "python"
+    ]
+
+    data = bundle.read_bytes()
+    tampered = tmp_path / "tampered.bundle"
+    tampered.write_bytes(data.replace(b"wheel\0", b"wheeL\0"))
+    inst = MinicondaInstaller(str(tmp_path / "target"))
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        inst.unpack_bundle(str(tampered))
+
+    for path in calls.values():
+        path.unlink()
+    args = make_parser().parse_args(
+        [str(inst.clean_dest_path), "--bundle", str(bundle)]
+    )
+    sched = plan_provisioning(inst, args)
+    assert list(sched.steps) == ["download", "unpack", "install", "bundle-install"]
+    sched.run()
+    root = Path(inst.bundle["root"])
+    assert (root / "conda-explicit.txt").read_text().splitlines() == [
+        "@EXPLICIT",
+        (root / "channel/linux-64/six-1.16.0-0.conda").as_uri(),
+    ]
+    assert calls["conda"].read_text().splitlines() == [
+        "install --offline -y --file %s" % (root / "conda-explicit.txt")
+    ]
+    assert calls["pip"].read_text().splitlines() == [
+        "install --no-index --find-links %s geopy==2.4.0" % (root / "wheels")
+    ]
+
+
+@pytest.mark.parametrize("change", [
+    dict(files={"../../evil": "0" * 64, "installer/x.sh": "0" * 64}),
+    dict(installer="/tmp/x.sh", files={"/tmp/x.sh": "0" * 64}),
+    dict(id="../../escape"),
+    dict(conda=["../channel/x.conda"]),
+])
+def test_unpack_bundle_rejects_unsafe_names(
+    installer, tmp_path, monkeypatch, change
+):
+    monkeypatch.setitem(config, "machine", "x86_64")
+    monkeypatch.setitem(config, "system", "Linux")
+    manifest = dict(
+        id="0123456789abcdef",
+        platform="linux-64",
+        conda_backend="classic",
+        standalone=False,
+        installer="installer/x.sh",
+        conda=[],
+        pip=[],
+        files={"installer/x.sh": "0" * 64},
+    )
+    manifest.update(change)
+    bundle = tmp_path / "evil.bundle"
+    with tarfile.open(str(bundle), "w") as tar:
+        data = json.dumps(manifest).encode("utf8")
+        info = tarfile.TarInfo("manifest.json")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    with pytest.raises(ValueError, match="Unsafe path|Invalid bundle id"):
+        installer.unpack_bundle(str(bundle))
+    assert not list(tmp_path.glob("**/evil")) and not (
+        tmp_path / "escape").exists()
+
+
+def make_python(prefix):
+    """Make ``<prefix>/bin/python`` run this Python with its site-packages.
+
+    :returns: The path of the site-packages directory.
+    """
+    site = prefix / "lib" / "python3.9" / "site-packages"
+    site.mkdir(parents=True)
+    python = prefix / "bin" / "python"
+    python.parent.mkdir(exist_ok=True)
+    python.write_text('#!/bin/sh\nPYTHONPATH=%s exec %s "$@"\n' % (
+        site, sys.executable))
+    python.chmod(0o755)
+    return site
+
+
+def test_verify_imports(installer, tmp_path):
+    site = make_python(installer.clean_dest_path)
+    modules = dict(
+        good="",
+        slow="import time\ntime.sleep(0.3)\n",
+        broken="raise ImportError('no luck')\n",
+    )
+    for name, code in modules.items():
+        (site / ("%s.py" % name)).write_text(code)
+        info = site / ("%s-1.0.dist-info" % name)
+        info.mkdir()
+        (info / "RECORD").write_text("%s.py,,\n%s-1.0.dist-info/RECORD,,\n" % (
+            name, name))
+    info = site / "pkg-1.0.dist-info"
+    info.mkdir()
+    (info / "top_level.txt").write_text("good\n_private\ntests\n")
+    assert installer.top_level_modules() == ["broken", "good", "slow"]
+
+    with pytest.raises(ValueError, match="Importing failed for broken"):
+        installer.verify_imports(jobs=2)
+    log = Path(config["log_path"]).read_text()
+    assert "# Verified 3 imports" in log
+    assert "#   FAIL broken: ImportError: no luck" in log
+    slowest = re.findall(r"#\s+([\d.]+) s  (\w+)", log)
+    assert [name for _, name in slowest][0] == "slow"
+    assert float(slowest[0][0]) >= 0.3
+    events = [e for e in installer.events if e["kind"] == "import"]
+    assert sorted(e["name"] for e in events) == ["broken", "good", "slow"]
+
+
+def test_precompile_unchecked_hash(installer):
+    site = make_python(installer.clean_dest_path)
+    (site / "one.py").write_text("x = 1\n")
+    (site / "pkg").mkdir()
+    (site / "pkg" / "__init__.py").write_text("")
+    installer.precompile(mode="unchecked-hash", jobs=2)
+    pycs = list(site.glob("**/__pycache__/*.pyc"))
+    assert len(pycs) == 2
+    for pyc in pycs:
+        # The flags: hash-based, not checked against the source.
+        assert pyc.read_bytes()[4:8] == b"\x01\0\0\0"
+    mtimes = [pyc.stat().st_mtime_ns for pyc in pycs]
+    installer.precompile(mode="unchecked-hash")
+    assert [pyc.stat().st_mtime_ns for pyc in pycs] == mtimes
+    (site / "one.py").write_text("x = 10\n")
+    installer.precompile(mode="unchecked-hash")
+    log = Path(config["log_path"]).read_text()
+    assert "# Precompiled 2 of 2 modules (unchecked-hash)" in log
+    assert "# Precompiled 0 of 2 modules (unchecked-hash)" in log
+    assert "# Precompiled 1 of 2 modules (unchecked-hash)" in log
+
+
+def test_precompile_timestamp_skips_current(installer):
+    site = make_python(installer.clean_dest_path)
+    (site / "one.py").write_text("x = 1\n")
+    (site / "two.py").write_text("x = 2\n")
+    run_command([sys.executable, "-m", "compileall", "-q", str(site / "one.py")])
+    installer.precompile()
+    installer.precompile()
+    log = Path(config["log_path"]).read_text()
+    assert "# Precompiled 1 of 2 modules (timestamp)" in log
+    assert "# Precompiled 0 of 2 modules (timestamp)" in log
+
+
+def test_precompile_replaces_timestamp_pycs(installer):
+    site = make_python(installer.clean_dest_path)
+    (site / "one.py").write_text("x = 1\n")
+    (site / "two.py").write_text("x = 2\n")
+    # Timestamp-based, like those written by pip and conda.
+    run_command([sys.executable, "-m", "compileall", "-q", str(site)])
+    pycs = sorted(site.glob("__pycache__/*.pyc"))
+    assert [pyc.read_bytes()[4:8] for pyc in pycs] == [b"\0\0\0\0"] * 2
+    installer.precompile(mode="unchecked-hash")
+    assert [pyc.read_bytes()[4:8] for pyc in pycs] == [b"\x01\0\0\0"] * 2
+    log = Path(config["log_path"]).read_text()
+    assert "# Precompiled 2 of 2 modules (unchecked-hash)" in log
+
+
+def test_snapshot_dir_rerun_is_incremental(installer, tmp_path, monkeypatch):
+    make_stub(installer.clean_dest_path, "conda")
+    # Planning must not fetch the installer for an existing installation.
+    monkeypatch.setattr(installer, "fetch_base", lambda: pytest.fail("fetched"))
+    args = make_parser().parse_args([
+        str(tmp_path / "mc3"), "--snapshot-dir", str(tmp_path / "snapshots"),
+    ])
+    steps = list(plan_provisioning(installer, args).steps)
+    assert "update" in steps
+    assert "restore" not in steps and "snapshot" not in steps
+
+
+def test_rerun_in_clone_keeps_golden_state(installer, tmp_path):
+    golden = MinicondaInstaller(str(tmp_path / "golden"))
+    make_stub(golden.clean_dest_path, "conda")
+    make_stub(golden.clean_dest_path, "pip")
+    argv = ["--pip-dependencies", "six"]
+    plan_provisioning(golden, make_parser().parse_args(
+        [str(golden.clean_dest_path)] + argv)).run()
+    state = golden.state_path.read_text()
+    clone_prefix(golden.clean_dest_path, installer.clean_dest_path)
+    assert installer.load_state() == golden.load_state()
+
+    sched = plan_provisioning(installer, make_parser().parse_args(
+        [str(installer.clean_dest_path), "--pip-dependencies", "six,attrs"]))
+    assert "pip" in sched.steps
+    sched.run()
+    assert golden.state_path.read_text() == state
+    assert installer.load_state()["pip"] != golden.load_state()["pip"]
+
+
+def test_golden_dir_rerun_is_incremental(installer, tmp_path):
+    make_stub(installer.clean_dest_path, "conda")
+    args = make_parser().parse_args([
+        str(tmp_path / "mc3"), "--golden-dir", str(tmp_path / "golden"),
+    ])
+    steps = list(plan_provisioning(installer, args).steps)
+    assert "update" in steps and "clone" not in steps
+    assert not (tmp_path / "golden").exists()
+
+
+def test_golden_dir_writes_lock_for_destination(
+    installer, tmp_path, monkeypatch
+):
+    args = make_parser().parse_args([
+        str(tmp_path / "mc3"), "--golden-dir", str(tmp_path / "golden"),
+        "--write-lock", str(tmp_path / "mc3.lock"),
+        "--snapshot-dir", str(tmp_path / "snapshots"),
+    ])
+    sched = plan_provisioning(installer, args)
+    assert list(sched.steps) == ["clone", "write-lock"]
+
+    golden_args = []
+
+    def plan(inst, args):
+        golden_args.append(args)
+        return StepScheduler()
+
+    monkeypatch.setattr(mcinstall, "plan_provisioning", plan)
+    ensure_golden_prefix(args)
+    assert golden_args[0].path != args.path
+    assert golden_args[0].write_lock is None
+    assert golden_args[0].snapshot_dir is None
+
+
+def test_precompile_options(installer, tmp_path):
+    make_stub(installer.clean_dest_path, "conda")
+    args = make_parser().parse_args(["--precompile", str(tmp_path / "mc3")])
+    assert args.precompile and args.pyc_invalidation_mode == "timestamp"
+    sched = plan_provisioning(installer, args)
+    assert list(sched.steps)[-1] == "precompile"
+
+
+SLIM_STUB = """#!%s
+import shutil, sys
+with open(%r, "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+if sys.argv[1:] == ["clean", "-afy"]:
+    shutil.rmtree(%r)
+elif sys.argv[1:] == ["-m", "pip", "cache", "dir"]:
+    print(%r)
+elif sys.argv[1:] == ["-m", "pip", "cache", "purge"]:
+    shutil.rmtree(%r)
+"""
+
+
+def test_slim(installer, tmp_path):
+    prefix = installer.clean_dest_path
+    pip_cache = tmp_path / "pip-cache"
+    for name in ["conda", "python"]:
+        calls = make_stub(prefix, name)
+        (prefix / "bin" / name).write_text(SLIM_STUB % (
+            sys.executable, str(calls), str(prefix / "pkgs"), str(pip_cache),
+            str(pip_cache)))
+    (prefix / "pkgs").mkdir()
+    (prefix / "pkgs" / "six-1.16.0-0.conda").write_bytes(b"x" * 3000)
+    pip_cache.mkdir()
+    (pip_cache / "blob").write_bytes(b"x" * 2000)
+    site = prefix / "lib" / "python3.9" / "site-packages"
+    (site / "pkg" / "tests").mkdir(parents=True)
+    (site / "pkg" / "tests" / "test_pkg.py").write_bytes(b"t" * 500)
+    (site / "pkg" / "testing.py").write_text("")
+    (prefix / "lib" / "libfoo.a").write_bytes(b"a" * 700)
+    for name in ["one", "two", "three"]:
+        (site / "pkg" / ("%s.so" % name)).write_bytes(b"\0" * 4096)
+
+    with pytest.raises(ValueError):
+        installer.slim(["docs"])
+    saved = installer.slim(["tests", "static-libs"])
+    assert saved == {
+        "conda-pkgs": 3000,
+        "pip-cache": 2000,
+        "tests": 500,
+        "static-libs": 700,
+        "hardlinks": 2 * 4096,
+    }
+    assert not (site / "pkg" / "tests").exists()
+    assert (site / "pkg" / "testing.py").exists()
+    inodes = set(
+        (site / "pkg" / ("%s.so" % name)).stat().st_ino
+        for name in ["one", "two", "three"]
+    )
+    assert len(inodes) == 1
+    log = Path(config["log_path"]).read_text()
+    assert "# Slimmed %s in " % prefix in log
+
+
+@pytest.mark.parametrize("options", [
+    ["--slim"],
+    ["--slim", "--slim-extras", "tests"],
+    ["--precompile"],
+    ["--precompile", "--pyc-invalidation-mode", "unchecked-hash"],
+])
+def test_spec_fingerprint_covers_final_steps(tmp_path, options):
+    argv = [str(tmp_path / "mc3"), "--pip-dependencies", "six"]
+    plain = spec_fingerprint(make_parser().parse_args(argv))
+    assert spec_fingerprint(make_parser().parse_args(argv + ["--verify"])) == (
+        plain)
+    assert spec_fingerprint(make_parser().parse_args(argv + options)) != (
+        plain)
+    if "--pyc-invalidation-mode" in options:
+        assert spec_fingerprint(make_parser().parse_args(argv + options)) != (
+            spec_fingerprint(make_parser().parse_args(argv + options[:1])))
+
+
+SLOW_STUB = """#!%s
+import sys, time
+with open(%r, "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+time.sleep(0.5)
+"""
+
+
+@pytest.mark.parametrize("address", ["0.0.0.0:0", "192.0.2.1:0"])
+def test_daemon_listens_on_loopback_only(isolated_config, address):
+    daemon = ProvisionDaemon(jobs=1)
+    with pytest.raises(ValueError, match="not a loopback address"):
+        make_daemon_server(address, daemon)
+    make_daemon_server("localhost:0", daemon).server_close()
+    daemon.shutdown()
+
+
+def test_daemon_refuses_foreign_requests(isolated_config):
+    token_path = Path(isolated_config["serve_token_path"])
+    daemon = ProvisionDaemon(jobs=1)
+    server = make_daemon_server("127.0.0.1:0", daemon)
+    assert token_path.stat().st_mode & 0o777 == 0o600
+    token = token_path.read_text().strip()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    address = "127.0.0.1:%d" % server.server_address[1]
+
+    def post(headers, body=b'{"options": {}}'):
+        conn = HTTPConnection("127.0.0.1", server.server_address[1])
+        conn.request("POST", "/jobs", body, headers)
+        status = conn.getresponse().status
+        conn.close()
+        return status
+
+    auth = "Bearer %s" % token
+    json_type = "application/json"
+    try:
+        assert daemon_request(address, "GET", "/jobs") == []
+        assert post({"Content-Type": json_type}) == 401
+        assert post({"Content-Type": json_type, "Authorization": "Bearer x"}) == 401
+        assert post({"Content-Type": "text/plain", "Authorization": auth}) == 415
+        assert post({
+            "Content-Type": json_type,
+            "Authorization": auth,
+            "Origin": "http://evil.example.org",
+        }) == 403
+        assert post({
+            "Content-Type": json_type,
+            "Authorization": auth,
+            "Host": "evil.example.org:8765",
+        }) == 403
+        # Valid, but a job without path.
+        assert post({"Content-Type": json_type, "Authorization": auth}) == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+        daemon.shutdown()
+
+
+def test_daemon_serializes_jobs_per_path(installer):
+    prefix = installer.clean_dest_path
+    calls = make_stub(prefix, "conda")
+    (prefix / "bin" / "conda").write_text(
+        SLOW_STUB % (sys.executable, str(calls)))
+    daemon = ProvisionDaemon(jobs=2)
+    first, _ = daemon.submit(dict(path=str(prefix)))
+    second, deduped = daemon.submit(dict(path=str(prefix) + "/", force=True))
+    assert not deduped
+    daemon.shutdown()
+    assert first["state"] == second["state"] == "done"
+    assert second["started"] >= first["ended"]
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="Unix sockets.")
+def test_daemon_replaces_stale_sockets_only(tmp_path):
+    daemon = ProvisionDaemon(jobs=1)
+    address = tmp_path / "important.txt"
+    address.write_text("keep me")
+    with pytest.raises(ValueError, match="not a socket"):
+        make_daemon_server(str(address), daemon)
+    assert address.read_text() == "keep me"
+
+    address = str(tmp_path / "mcinstall.sock")
+    server = make_daemon_server(address, daemon)
+    with pytest.raises(ValueError, match="listening on .* already"):
+        make_daemon_server(address, daemon)
+    server.server_close()
+    # The socket file is left behind, with no daemon listening.
+    make_daemon_server(address, daemon).server_close()
+    daemon.shutdown()
+
+
+def test_daemon_dedups_jobs_in_flight(installer, tmp_path, capsys):
+    prefix = installer.clean_dest_path
+    calls = make_stub(prefix, "conda")
+    (prefix / "bin" / "conda").write_text(
+        SLOW_STUB % (sys.executable, str(calls)))
+    address = str(tmp_path / "mcinstall.sock")
+    daemon = ProvisionDaemon(jobs=2)
+    server = make_daemon_server(address, daemon)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        job = daemon_request(
+            address, "POST", "/jobs", dict(options=dict(path=str(prefix))))
+        assert job == dict(id="1", deduped=False)
+        with pytest.raises(SystemExit) as exc_info:
+            main(["--server", address, "--profile", str(prefix)])
+        assert exc_info.value.code == 0
+        jobs = daemon_request(address, "GET", "/jobs")
+        with pytest.raises(ValueError, match="No such job"):
+            daemon_request(address, "GET", "/jobs/42")
+        with pytest.raises(ValueError, match="Unknown option"):
+            daemon_request(address, "POST", "/jobs", dict(
+                options=dict(path=str(prefix), frobnicate=True)))
+    finally:
+        server.shutdown()
+        server.server_close()
+        daemon.shutdown()
+    out = capsys.readouterr().out
+    assert "Joining job 1 in flight with the same spec." in out
+    assert "update -y -n base -c defaults conda" in out
+    assert re.search(r"Job 1 done in [\d.]+ s: download .*update", out)
+    assert "Profile (" in out
+    assert [(j["id"], j["state"]) for j in jobs] == [("1", "done")]
+    assert calls.read_text().splitlines() == [
+        "update -y -n base -c defaults conda"
+    ]
+
+
+@pytest.mark.parametrize("requirement, satisfied", [
+    ("GeoPy", True),
+    ("geopy>=2,<3", True),
+    ("geopy==2.4.*", True),
+    ("geopy==2.0.*", False),
+    ("geopy~=2.3", True),
+    ("geopy~=2.3.0", False),
+    ("geopy!=2.4.0", False),
+    ("geopy>2.4.0rc1", True),
+    ("geopy<2.4.0.post1", True),
+    ("geopy[aiohttp]", False),
+    ("geopy; python_version >= '3'", False),
+    ("attrs", False),
+    ("-e .", False),
+])
+def test_pip_satisfied(requirement, satisfied):
+    assert pip_satisfied(requirement, {"geopy": "2.4.0"}) is satisfied
+
+
+@pytest.mark.parametrize("version, requirement, satisfied", [
+    ("1.0.post1", "foo>1.0", False),
+    ("1.0.post1", "foo>1.0.post0", True),
+    ("1.0.post1", "foo>=1.0", True),
+    ("1.0", "foo>1.0rc1", True),
+    ("1.1", "foo>1.0", True),
+    ("2.0rc1", "foo<2", False),
+    ("2.0.dev1", "foo<2", False),
+    ("2.0rc1", "foo<2.0rc2", True),
+    ("2.0rc1", "foo<=2", True),
+    ("2.0", "foo<2.0.post1", True),
+    ("1.9", "foo<2", True),
+])
+def test_pip_satisfied_exclusive_comparisons(version, requirement, satisfied):
+    assert pip_satisfied(requirement, {"foo": version}) is satisfied
+
+
+@pytest.mark.parametrize("spec, satisfied", [
+    ("numpy", True),
+    ("numpy=1.21", True),
+    ("numpy=1.2", False),
+    ("numpy 1.21.*", True),
+    ("numpy>=1.22|1.21.5", True),
+    ("numpy>=1.20,<1.21", False),
+    ("numpy=1.21.5=py39_0", False),
+    ("conda-forge::numpy", False),
+    ("scipy", False),
+])
+def test_conda_satisfied(spec, satisfied):
+    assert conda_satisfied(spec, {"numpy": "1.21.5"}) is satisfied
+
+
+def test_install_skips_satisfied_requirements(installer, tmp_path):
+    prefix = installer.clean_dest_path
+    pip_calls = make_stub(prefix, "pip")
+    conda_calls = make_stub(prefix, "conda")
+    site = make_python(prefix)
+    info = site / "geopy-2.4.0.dist-info"
+    info.mkdir()
+    (info / "METADATA").write_text("Name: geopy\nVersion: 2.4.0\n")
+    (prefix / "conda-meta").mkdir()
+    (prefix / "conda-meta" / "numpy-1.21.5-py39_0.json").write_text(
+        json.dumps(dict(name="numpy", version="1.21.5")))
+    reqs = tmp_path / "requirements.txt"
+    reqs.write_text("# pinned\ngeopy==2.4.0\n")
+
+    installer.install_pip(
+        dependencies=["geopy>=2"], dependencies_path=str(reqs), batch=True)
+    installer.install_conda(dependencies=["numpy=1.21"])
+    assert not pip_calls.exists() and not conda_calls.exists()
+    installer.install_pip(
+        dependencies=["geopy>=3", "geopy"], dependencies_path=str(reqs),
+        batch=True)
+    installer.install_conda(dependencies=["numpy>=1.22", "numpy"])
+    assert pip_calls.read_text().splitlines() == ["install geopy>=3"]
+    assert conda_calls.read_text().splitlines() == [
+        "install -y -c conda-forge numpy>=1.22"
+    ]
+    log = Path(config["log_path"]).read_text()
+    assert "# Already satisfied, not installing with pip: geopy>=2, %s" % (
+        reqs) in log
+    assert [e["name"] for e in installer.events if e["kind"] == "query"] == [
+        "pip", "pip"]
+
+    installer.skip_satisfied = False
+    installer.install_conda(dependencies=["numpy"])
+    assert conda_calls.read_text().splitlines()[-1] == (
+        "install -y -c conda-forge numpy")